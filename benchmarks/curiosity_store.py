@@ -0,0 +1,95 @@
+"""
+Time reading links, page facts and sections for many entities from the
+wiki database, one call per entity as dialog simulation does, then in one
+batched call, then again from the entity cache:
+
+    python -m benchmarks.curiosity_store --entities 200
+"""
+import time
+from contextlib import contextmanager
+
+import typer
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, selectinload, sessionmaker
+from sqlalchemy.pool import NullPool
+
+from pedroai.io import eprint
+
+from explorer import paths
+from explorer.curiosity.wiki_db import CuriosityStore, EntityLink, Fact
+
+
+app = typer.Typer()
+
+
+class PerCallStore:
+    """
+    The access pattern CuriosityStore used before batching: a new session
+    and connection for every call, loading ORM objects
+    """
+
+    def __init__(self, sql_path: str) -> None:
+        self._engine = create_engine(f"sqlite:///{sql_path}", poolclass=NullPool)
+
+    @contextmanager
+    def _session_scope(self):
+        session = scoped_session(sessionmaker(bind=self._engine))
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def get_links(self, page_entity: str):
+        with self._session_scope() as session:
+            rows = (
+                session.query(Fact)
+                .filter_by(page=page_entity)
+                .options(selectinload(Fact.mentions))
+            )
+            return [
+                EntityLink(
+                    fact.page,
+                    m.title,
+                    fact.section_title,
+                    m.pageviews,
+                    fact.text,
+                    m.is_location,
+                    fact.id,
+                    m.id,
+                )
+                for fact in rows
+                for m in fact.mentions
+            ]
+
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+@app.command()
+def main(wiki_db: str = paths.WIKI_DB, entities: int = 200):
+    store = CuriosityStore(wiki_db)
+    cached = CuriosityStore(wiki_db, cache_size=entities)
+    pages = store.get_focus_entities()[:entities]
+    per_call = PerCallStore(wiki_db)
+    results = {
+        "per call, new session": timed(lambda: [per_call.get_links(p) for p in pages]),
+        "per call, shared pool": timed(lambda: [store.get_links(p) for p in pages]),
+        "batched": timed(lambda: store.get_links_batch(pages)),
+    }
+    cached.get_links_batch(pages)
+    results["cached"] = timed(lambda: [cached.get_links(p) for p in pages])
+    for name, seconds in results.items():
+        eprint(f"get_links {name}: {seconds * 1000:.1f}ms for {len(pages)} entities")
+    for method in ["get_page_facts", "get_sections"]:
+        single = timed(lambda m=method: [getattr(store, m)(p) for p in pages])
+        batch = timed(lambda m=method: getattr(store, f"{m}_batch")(pages))
+        eprint(
+            f"{method}: {single * 1000:.1f}ms per call, {batch * 1000:.1f}ms batched"
+        )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,58 @@
+"""
+CPU time per /curiosity/dialogs page, comparing the stored JSON spliced
+into the response with parsing each dialog into pydantic models that
+FastAPI serializes again. Run from the directory with data/, after populate:
+
+    python -m benchmarks.dialog_pages --limit 100
+"""
+import time
+
+import typer
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from pedroai.io import eprint
+
+from explorer.curiosity.api import get_dialog_page
+from explorer.curiosity.data import CuriosityDialog
+from explorer.database import CuriosityDbDialog, get_db_context
+
+
+app = typer.Typer()
+
+
+def parsed_page(db, limit: int, page: int):
+    dialogs = (
+        db.query(CuriosityDbDialog.data)
+        .order_by(CuriosityDbDialog.dialog_id)
+        .offset((page - 1) * limit)
+        .limit(limit)
+        .all()
+    )
+    content = {"dialogs": [CuriosityDialog.parse_raw(d.data) for d in dialogs]}
+    return JSONResponse(jsonable_encoder(content))
+
+
+def spliced_page(db, limit: int, page: int):
+    return get_dialog_page(db, None, limit, page, None)
+
+
+def cpu_per_request(fn, db, limit: int, pages: int, repeats: int) -> float:
+    start = time.process_time()
+    for _ in range(repeats):
+        for page in range(1, pages + 1):
+            fn(db, limit, page)
+    return (time.process_time() - start) / (repeats * pages)
+
+
+@app.command()
+def main(limit: int = 100, pages: int = 5, repeats: int = 10):
+    with get_db_context() as db:
+        for name, fn in [("pydantic", parsed_page), ("spliced", spliced_page)]:
+            fn(db, limit, 1)
+            seconds = cpu_per_request(fn, db, limit, pages, repeats)
+            eprint(f"{name}: {seconds * 1000:.2f}ms CPU per page of {limit}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,352 @@
+"""
+Load test a running server with a mix of routes shaped like real traffic,
+reporting throughput and p50/p95/p99 latency per route. With --serve the
+server is started here like the Dockerfile does, uvicorn with two workers.
+Ids are sampled from the local database, so run it where populate was run:
+
+    python -m benchmarks.loadtest --serve --concurrency 32 --duration 30 --output load.json
+    python -m benchmarks.loadtest --serve --baseline load.json
+
+With --baseline, the run fails when a route's p50, p95 or p99 latency, or those
+given with --compare, is more than --threshold times the baseline's, or
+throughput fell by as much. Needs httpx.
+"""
+from typing import Dict, Iterator, List, NamedTuple, Optional
+import asyncio
+import bisect
+import json
+import random
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import httpx
+import typer
+from sqlalchemy import text
+
+from pedroai.io import eprint
+
+from explorer import paths
+from explorer.database import create_db_engine
+from explorer.sqlite_profile import SERVE
+
+
+app = typer.Typer()
+
+# Share of requests going to each route
+ROUTE_MIX = {
+    "random_question": 0.3,
+    "question": 0.3,
+    "dialog": 0.25,
+    "dialogs": 0.15,
+}
+DIALOGS_LIMIT = 10
+# Pages read by following next cursors before starting again at a random page
+DIALOG_PAGES_PER_VISIT = 5
+PERCENTILES = [50, 95, 99]
+# Percentiles checked against a baseline, including the tail
+COMPARED_PERCENTILES = [50, 95, 99]
+# Upper bounds in milliseconds of the latency histogram buckets
+HISTOGRAM_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+REGRESSION_RATIO = 1.25
+SAMPLED_IDS = 10_000
+
+
+class TrafficIds(NamedTuple):
+    qanta_ids: List[int]
+    dialog_ids: List[int]
+    n_dialogs: int
+
+
+def sample_ids(db_path: str, seed: int) -> TrafficIds:
+    db_engine = create_db_engine(db_path, SERVE)
+    with db_engine.connect() as conn:
+        qanta_ids = [r[0] for r in conn.execute(text("SELECT qanta_id FROM questions"))]
+        dialog_ids = [
+            r[0] for r in conn.execute(text("SELECT dialog_id FROM curiosity_dialog"))
+        ]
+    db_engine.dispose()
+    if len(qanta_ids) == 0 or len(dialog_ids) == 0:
+        raise ValueError(f"No questions or dialogs in {db_path}, run populate first")
+    rng = random.Random(seed)
+    return TrafficIds(
+        rng.sample(qanta_ids, min(SAMPLED_IDS, len(qanta_ids))),
+        rng.sample(dialog_ids, min(SAMPLED_IDS, len(dialog_ids))),
+        len(dialog_ids),
+    )
+
+
+class User:
+    """
+    One simulated client choosing routes by ROUTE_MIX. Dialog paging follows
+    the next cursor of the previous page like a reader clicking through.
+    """
+
+    def __init__(self, ids: TrafficIds, rng: random.Random) -> None:
+        self.ids = ids
+        self.rng = rng
+        self.routes = list(ROUTE_MIX)
+        self.weights = [ROUTE_MIX[r] for r in self.routes]
+        self.cursor: Optional[str] = None
+        self.pages_left = 0
+
+    def next_request(self):
+        route = self.rng.choices(self.routes, self.weights)[0]
+        if route == "random_question":
+            return route, "/qanta/question/random"
+        if route == "question":
+            return route, f"/qanta/question/{self.rng.choice(self.ids.qanta_ids)}"
+        if route == "dialog":
+            return route, f"/curiosity/dialog/{self.rng.choice(self.ids.dialog_ids)}"
+        if self.cursor is not None and self.pages_left > 0:
+            return (
+                route,
+                f"/curiosity/dialogs?limit={DIALOGS_LIMIT}&cursor={self.cursor}",
+            )
+        n_pages = max(1, -(-self.ids.n_dialogs // DIALOGS_LIMIT))
+        self.pages_left = DIALOG_PAGES_PER_VISIT
+        page = self.rng.randint(1, n_pages)
+        return route, f"/curiosity/dialogs?limit={DIALOGS_LIMIT}&page={page}"
+
+    def read_response(self, route: str, response: httpx.Response):
+        if route == "dialogs" and response.status_code == 200:
+            self.cursor = response.json().get("next")
+            self.pages_left -= 1
+
+
+class RouteStats:
+    def __init__(self) -> None:
+        self.latencies_ms: List[float] = []
+        self.errors = 0
+
+    def add(self, latency_ms: float, ok: bool):
+        self.latencies_ms.append(latency_ms)
+        if not ok:
+            self.errors += 1
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """
+    Nearest rank percentile of values sorted in increasing order
+    """
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def histogram(values: List[float]) -> Dict[str, int]:
+    counts = [0] * (len(HISTOGRAM_MS) + 1)
+    for v in values:
+        counts[bisect.bisect_left(HISTOGRAM_MS, v)] += 1
+    labels = [f"<={b}ms" for b in HISTOGRAM_MS] + [f">{HISTOGRAM_MS[-1]}ms"]
+    return dict(zip(labels, counts))
+
+
+def summarize(stats: RouteStats, seconds: float) -> Dict:
+    latencies = sorted(stats.latencies_ms)
+    summary = {
+        "requests": len(latencies),
+        "errors": stats.errors,
+        "requests_per_s": len(latencies) / seconds,
+    }
+    if len(latencies) != 0:
+        for p in PERCENTILES:
+            summary[f"p{p}_ms"] = percentile(latencies, p)
+        summary["histogram"] = histogram(latencies)
+    return summary
+
+
+async def run_user(
+    client: httpx.AsyncClient,
+    user: User,
+    stats: Dict[str, RouteStats],
+    record_after: float,
+    stop_at: float,
+):
+    while time.perf_counter() < stop_at:
+        route, url = user.next_request()
+        start = time.perf_counter()
+        try:
+            response = await client.get(url)
+            ok = response.status_code == 200
+            user.read_response(route, response)
+        except httpx.HTTPError:
+            ok = False
+        end = time.perf_counter()
+        # Requests finishing during warmup are not counted
+        if end >= record_after:
+            stats[route].add((end - start) * 1000, ok)
+
+
+async def generate_load(
+    base_url: str,
+    ids: TrafficIds,
+    concurrency: int,
+    duration: float,
+    warmup: float,
+    seed: int,
+) -> Dict:
+    stats = {route: RouteStats() for route in ROUTE_MIX}
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=30
+    ) as client:
+        start = time.perf_counter()
+        record_after = start + warmup
+        stop_at = record_after + duration
+        users = [User(ids, random.Random(seed + i)) for i in range(concurrency)]
+        await asyncio.gather(
+            *[run_user(client, u, stats, record_after, stop_at) for u in users]
+        )
+        seconds = time.perf_counter() - record_after
+    routes = {route: summarize(s, seconds) for route, s in stats.items()}
+    total = RouteStats()
+    for s in stats.values():
+        total.latencies_ms.extend(s.latencies_ms)
+        total.errors += s.errors
+    return {
+        "base_url": base_url,
+        "concurrency": concurrency,
+        "duration_s": seconds,
+        "total": summarize(total, seconds),
+        "routes": routes,
+    }
+
+
+def compare_to_baseline(
+    report: Dict,
+    baseline: Dict,
+    threshold: float = REGRESSION_RATIO,
+    percentiles: Optional[List[int]] = None,
+) -> List[str]:
+    """
+    Descriptions of the latencies and throughputs in report that regressed
+    by more than threshold from baseline, comparing percentiles,
+    COMPARED_PERCENTILES by default
+    """
+    if percentiles is None:
+        percentiles = COMPARED_PERCENTILES
+    regressions = []
+    pairs = [("total", report["total"], baseline["total"])] + [
+        (route, summary, baseline["routes"][route])
+        for route, summary in report["routes"].items()
+        if route in baseline["routes"]
+    ]
+    for name, current, before in pairs:
+        for p in percentiles:
+            key = f"p{p}_ms"
+            if (
+                key in current
+                and key in before
+                and current[key] > before[key] * threshold
+            ):
+                regressions.append(
+                    f"{name} {key} {current[key]:.1f} > {before[key]:.1f} * {threshold}"
+                )
+    if (
+        report["total"]["requests_per_s"] * threshold
+        < baseline["total"]["requests_per_s"]
+    ):
+        regressions.append(
+            f"throughput {report['total']['requests_per_s']:.1f}/s < "
+            f"{baseline['total']['requests_per_s']:.1f}/s / {threshold}"
+        )
+    return regressions
+
+
+@contextmanager
+def serve(port: int, workers: int, timeout: float = 60) -> Iterator[str]:
+    """
+    Run explorer.web:app with uvicorn until the context exits, yielding its
+    base url once it answers
+    """
+    command = [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(port),
+        "--workers",
+        str(workers),
+        "--no-access-log",
+        "explorer.web:app",
+    ]
+    server = subprocess.Popen(command)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f"Server exited with {server.returncode}")
+            try:
+                if httpx.get(f"{base_url}/qanta/question/random").status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server did not start within {timeout}s")
+            time.sleep(0.2)
+        yield base_url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def print_report(report: Dict):
+    header = f"{'route':<16} {'requests':>9} {'errors':>7} {'req/s':>8}"
+    header += "".join(f" {f'p{p}':>8}" for p in PERCENTILES)
+    eprint(header)
+    for name, summary in [("total", report["total"])] + list(report["routes"].items()):
+        line = (
+            f"{name:<16} {summary['requests']:>9} {summary['errors']:>7} "
+            f"{summary['requests_per_s']:>8.1f}"
+        )
+        line += "".join(
+            f" {summary.get(f'p{p}_ms', float('nan')):>6.1f}ms" for p in PERCENTILES
+        )
+        eprint(line)
+
+
+@app.command()
+def main(
+    base_url: str = "http://127.0.0.1:8000",
+    serve_app: bool = typer.Option(False, "--serve"),
+    port: int = 8000,
+    workers: int = 2,
+    concurrency: int = 16,
+    duration: float = 30,
+    warmup: float = 3,
+    seed: int = 0,
+    output: Optional[str] = None,
+    baseline: Optional[str] = None,
+    threshold: float = REGRESSION_RATIO,
+    compare: List[int] = typer.Option(COMPARED_PERCENTILES),
+):
+    ids = sample_ids(paths.QANTA_DB, seed)
+
+    def load(url: str) -> Dict:
+        return asyncio.run(generate_load(url, ids, concurrency, duration, warmup, seed))
+
+    if serve_app:
+        with serve(port, workers) as url:
+            report = load(url)
+        report["workers"] = workers
+    else:
+        report = load(base_url)
+    print_report(report)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), threshold, compare)
+        for r in regressions:
+            eprint(f"REGRESSION {r}")
+        if len(regressions) != 0:
+            raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,110 @@
+"""
+Compare read latency of the served database under the connection profile
+the web tier used before, a plain connection per checkout with SQLite's
+defaults, against pooled connections and the SERVE profile. Each call checks
+out a connection and runs one of the reads question and dialog pages do,
+from several threads like the database thread pool:
+
+    EXPLORER_DATA_DIR=/tmp/bench python -m benchmarks.sqlite_profile --threads 8
+"""
+from typing import Callable, Dict, List
+import random
+import threading
+import time
+
+import typer
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+
+from pedroai.io import eprint
+
+from benchmarks.loadtest import percentile, sample_ids
+from explorer import paths
+from explorer.sqlite_profile import SERVE, SqliteProfile, create_sqlite_engine
+
+
+app = typer.Typer()
+
+READS = {
+    "question": "SELECT * FROM questions WHERE qanta_id = :qanta_id",
+    "plays": "SELECT * FROM play_event WHERE qanta_id = :qanta_id ORDER BY date LIMIT 15",
+    "dialog": "SELECT * FROM curiosity_dialog WHERE dialog_id = :dialog_id",
+    "dialogs": (
+        "SELECT dialog_id FROM curiosity_dialog WHERE dialog_id > :dialog_id "
+        "ORDER BY dialog_id LIMIT 10"
+    ),
+}
+PERCENTILES = [50, 95, 99]
+
+
+def profiles(db_path: str) -> Dict[str, Callable[[], Engine]]:
+    return {
+        "default": lambda: create_engine(
+            f"sqlite:///{db_path}", connect_args={"check_same_thread": False}
+        ),
+        "pooled": lambda: create_sqlite_engine(
+            db_path, SqliteProfile(read_only=True, pool_size=SERVE.pool_size)
+        ),
+        "serve": lambda: create_sqlite_engine(db_path, SERVE),
+    }
+
+
+def run_reads(
+    db_engine: Engine, params: List[Dict], threads: int, calls: int
+) -> Dict[str, List[float]]:
+    statements = {name: text(sql) for name, sql in READS.items()}
+    latencies: Dict[str, List[float]] = {name: [] for name in READS}
+    lock = threading.Lock()
+
+    def worker(offset: int):
+        rng = random.Random(offset)
+        timings = []
+        for _ in range(calls):
+            name = rng.choice(list(READS))
+            start = time.perf_counter()
+            with db_engine.connect() as conn:
+                conn.execute(statements[name], rng.choice(params)).fetchall()
+            timings.append((name, (time.perf_counter() - start) * 1000))
+        with lock:
+            for name, ms in timings:
+                latencies[name].append(ms)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return latencies
+
+
+@app.command()
+def main(
+    db_path: str = paths.QANTA_DB, threads: int = 8, calls: int = 2_000, seed: int = 0
+):
+    ids = sample_ids(db_path, seed)
+    rng = random.Random(seed)
+    params = [
+        {"qanta_id": rng.choice(ids.qanta_ids), "dialog_id": rng.choice(ids.dialog_ids)}
+        for _ in range(1_000)
+    ]
+    header = f"{'profile':<10} {'read':<10}" + "".join(
+        f" {f'p{p}':>9}" for p in PERCENTILES
+    )
+    eprint(header)
+    for profile, make_engine in profiles(db_path).items():
+        db_engine = make_engine()
+        # Warm the pool and the OS page cache before timing
+        run_reads(db_engine, params, threads, 100)
+        latencies = run_reads(db_engine, params, threads, calls)
+        db_engine.dispose()
+        everything = sorted(ms for values in latencies.values() for ms in values)
+        for name, values in [("all", everything)] + sorted(latencies.items()):
+            values = sorted(values)
+            eprint(
+                f"{profile:<10} {name:<10}"
+                + "".join(f" {percentile(values, p):>7.3f}ms" for p in PERCENTILES)
+            )
+
+
+if __name__ == "__main__":
+    app()
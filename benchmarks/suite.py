@@ -0,0 +1,275 @@
+"""
+Time the ingestion and query paths on the data under EXPLORER_DATA_DIR and
+save the timings as JSON, so a regression shows up when results from two
+commits are compared. With --generate, synthetic data is written there
+first. Run from the repository root, the web app reads its templates
+from there:
+
+    EXPLORER_DATA_DIR=/tmp/bench python -m benchmarks.suite run --generate --output before.json
+    python -m benchmarks.suite compare before.json after.json
+"""
+from typing import Callable, Dict, List, Optional
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import typer
+from fastapi.testclient import TestClient
+
+from pedroai.io import eprint
+
+from benchmarks.synthetic import generate
+from explorer import paths
+from explorer.build import build_curiosity, build_db, build_qanta
+from explorer.curiosity.wiki_db import CuriosityStore
+from explorer.database import (
+    BUZZ_BADGES,
+    Base,
+    CuriosityDbDialog,
+    Question,
+    create_db_engine,
+    get_db_context,
+)
+from explorer.log import get_logger
+
+
+log = get_logger(__name__)
+app = typer.Typer()
+
+# A slower median than this times the baseline counts as a regression
+REGRESSION_RATIO = 1.2
+
+
+def time_calls(fn: Callable[[int], object], repeats: int) -> Dict:
+    """
+    Call fn with 0 to repeats - 1 and summarize how long the calls took
+    """
+    seconds = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn(i)
+        seconds.append(time.perf_counter() - start)
+    return {
+        "repeats": repeats,
+        "median_ms": statistics.median(seconds) * 1000,
+        "min_ms": min(seconds) * 1000,
+        "max_ms": max(seconds) * 1000,
+    }
+
+
+def bench_builds(results: Dict):
+    # Each stage on a scratch database, then the served database for the rest
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_engine = create_db_engine(os.path.join(tmp_dir, "build.sqlite3"))
+        Base.metadata.create_all(bind=db_engine)
+        results["build_qanta"] = time_calls(lambda _: build_qanta(db_engine), 1)
+        results["build_curiosity"] = time_calls(lambda _: build_curiosity(db_engine), 1)
+        db_engine.dispose()
+    results["build_db"] = time_calls(lambda _: build_db(), 1)
+
+
+def bench_questions(results: Dict, repeats: int):
+    with get_db_context() as db:
+        questions = (
+            db.query(Question)
+            .filter(Question.n_plays > 0)
+            .order_by(Question.qanta_id)
+            .limit(repeats)
+            .all()
+        )
+        if len(questions) == 0:
+            log.warning("No questions with plays, skipping text_with_buzzes")
+            return
+        results["text_with_buzzes.precomputed"] = time_calls(
+            lambda i: questions[i % len(questions)].text_with_buzzes(), repeats
+        )
+        results["text_with_buzzes.annotated"] = time_calls(
+            lambda i: questions[i % len(questions)].text_with_buzzes(
+                max_buzzes=BUZZ_BADGES + 1
+            ),
+            repeats,
+        )
+
+
+def bench_store(results: Dict, repeats: int, batch_size: int):
+    store = CuriosityStore(paths.WIKI_DB)
+    rng = random.Random(0)
+    pages = store.get_focus_entities()
+    sample = [rng.choice(pages) for _ in range(repeats)]
+    batches = [rng.sample(pages, min(batch_size, len(pages))) for _ in range(repeats)]
+    mentioned = [
+        (p, links[0].mention_entity if links else p)
+        for p, links in store.get_links_batch(sample).items()
+    ]
+    sections = store.get_sections_batch(sample)
+
+    def page(i: int) -> str:
+        return sample[i % len(sample)]
+
+    calls = {
+        "get_focus_entities": lambda i: store.get_focus_entities(),
+        "random_entity": lambda i: store.random_entity(),
+        "random_sections": lambda i: store.random_sections(page(i), 1),
+        "get_links": lambda i: store.get_links(page(i)),
+        "get_links_batch": lambda i: store.get_links_batch(batches[i]),
+        "get_page_facts": lambda i: store.get_page_facts(page(i)),
+        "get_page_facts_batch": lambda i: store.get_page_facts_batch(batches[i]),
+        "get_facts": lambda i: store.get_facts(*mentioned[i % len(mentioned)]),
+        "get_facts_batch": lambda i: store.get_facts_batch(mentioned),
+        "get_sections": lambda i: store.get_sections(page(i)),
+        "get_sections_batch": lambda i: store.get_sections_batch(batches[i]),
+        "get_section_facts": lambda i: store.get_section_facts(
+            page(i), sections[page(i)][-1]
+        ),
+        "get_entity_summary": lambda i: store.get_entity_summary(page(i)),
+        "get_entity_summaries": lambda i: store.get_entity_summaries(batches[i]),
+    }
+    for name, fn in calls.items():
+        results[f"store.{name}"] = time_calls(fn, repeats)
+    # Whole table reads are slow enough that a few calls are enough
+    for name in ["get_fact_lookup", "get_fact_sections"]:
+        results[f"store.{name}"] = time_calls(
+            lambda i, name=name: getattr(store, name)(), 3
+        )
+    curricula = store.prominence_curriculum()
+    results["store.prominence_curriculum.get"] = time_calls(
+        lambda i: curricula.get(page(i)), repeats
+    )
+    results["store.prominence_curriculum.iterate"] = time_calls(
+        lambda i: sum(1 for _ in curricula.iter_curricula()), 3
+    )
+
+
+def route_urls(qanta_ids: List[int], dialog_ids: List[int]) -> Dict[str, Callable]:
+    # Every request has a different query string so the response cache misses
+    return {
+        "qanta.question": lambda i: f"/qanta/question/{qanta_ids[i % len(qanta_ids)]}",
+        "qanta.random": lambda i: "/qanta/question/random",
+        "qanta.api.question": lambda i: (
+            f"/qanta/api/qanta/v1/{qanta_ids[i % len(qanta_ids)]}?plays=1"
+        ),
+        "qanta.api.questions": lambda i: "/qanta/api/qanta/v1/questions?limit=50",
+        "qanta.api.search": lambda i: "/qanta/api/search?q=river+king",
+        "curiosity.dialog": lambda i: (
+            f"/curiosity/dialog/{dialog_ids[i % len(dialog_ids)]}"
+        ),
+        "curiosity.random": lambda i: "/curiosity/dialog/random",
+        "curiosity.dialogs": lambda i: f"/curiosity/dialogs?page={i % 10 + 1}",
+        "curiosity.topics": lambda i: "/curiosity/topics",
+        "curiosity.api.search": lambda i: "/curiosity/api/search?q=river",
+    }
+
+
+def bench_routes(results: Dict, repeats: int):
+    # pylint: disable=import-outside-toplevel
+    # The app reads the served database, so it is imported once it is built
+    from explorer.web import app as web_app
+
+    with get_db_context() as db:
+        qanta_ids = [r[0] for r in db.query(Question.qanta_id).limit(repeats)]
+        dialog_ids = [
+            r[0] for r in db.query(CuriosityDbDialog.dialog_id).limit(repeats)
+        ]
+    with TestClient(web_app) as client:
+        for name, url in route_urls(qanta_ids, dialog_ids).items():
+
+            def get(i: int, url=url):
+                separator = "&" if "?" in url(i) else "?"
+                response = client.get(f"{url(i)}{separator}bench={i}")
+                response.raise_for_status()
+
+            results[f"route.{name}"] = time_calls(get, repeats)
+        ids = {"ids": qanta_ids}
+        results["route.qanta.api.batch"] = time_calls(
+            lambda i: client.post("/qanta/api/qanta/v1/batch", json=ids), repeats
+        )
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return (
+            subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            .stdout.decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@app.command()
+def run(
+    output: str = "benchmark_results.json",
+    generate_data: bool = typer.Option(False, "--generate"),
+    questions: int = 2_000,
+    plays: int = 20_000,
+    dialogs: int = 250,
+    pages: int = 200,
+    repeats: int = 50,
+    batch_size: int = 50,
+):
+    if generate_data:
+        generate(
+            paths.DATA_DIR,
+            questions=questions,
+            plays=plays,
+            dialogs=dialogs,
+            pages=pages,
+        )
+    results: Dict[str, Dict] = {}
+    bench_builds(results)
+    bench_questions(results, repeats)
+    bench_store(results, repeats, batch_size)
+    bench_routes(results, repeats)
+    report = {
+        "commit": git_commit(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "data_dir": paths.DATA_DIR,
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    for name, r in results.items():
+        eprint(f"{name:<40} {r['median_ms']:>10.2f}ms median of {r['repeats']}")
+    eprint(f"Wrote {len(results)} results to {output}")
+
+
+@app.command()
+def compare(baseline: str, current: str, threshold: float = REGRESSION_RATIO):
+    """
+    Median of each benchmark in current relative to baseline, exiting with
+    an error when any is more than threshold times slower
+    """
+    with open(baseline) as f:
+        before = json.load(f)["results"]
+    with open(current) as f:
+        after = json.load(f)["results"]
+    regressions = 0
+    for name in sorted(before.keys() & after.keys()):
+        ratio = after[name]["median_ms"] / max(before[name]["median_ms"], 1e-6)
+        flag = ""
+        if ratio > threshold:
+            flag = " REGRESSION"
+            regressions += 1
+        eprint(
+            f"{name:<40} {before[name]['median_ms']:>10.2f}ms -> "
+            f"{after[name]['median_ms']:>10.2f}ms {ratio:>6.2f}x{flag}"
+        )
+    if regressions != 0:
+        eprint(f"{regressions} benchmarks are more than {threshold}x slower")
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,296 @@
+"""
+Write synthetic source data in the layout populate reads: the QANTA question
+JSON, a protobowl HDF5 log, Curiosity dialog JSON for every fold and a wiki
+database. Values are random but shaped like the real data, so builds and
+queries do comparable work at a configurable scale:
+
+    python -m benchmarks.synthetic /tmp/bench --questions 100000 --plays 1000000
+"""
+from typing import Dict, List
+import json
+import os
+import random
+import warnings
+
+import numpy as np
+import pandas as pd
+import typer
+from sqlalchemy import create_engine
+
+from explorer import paths
+from explorer.curiosity import wiki_db
+from explorer.log import get_logger
+
+
+log = get_logger(__name__)
+app = typer.Typer()
+
+WORDS = (
+    "the of a this author wrote novel king battle river element compound "
+    "for ten points name his her which country city war poem painter"
+).split()
+CATEGORIES = ["History", "Literature", "Science", "Fine Arts", "Geography"]
+FOLDS = ["guesstrain", "guessdev", "buzztrain", "buzzdev", "buzztest"]
+DIFFICULTIES = ["College", "High School", "Open"]
+SECTIONS = ["Body", "History", "Geography", "Culture", "Economy", "Politics"]
+DIALOG_ACTS = [
+    "request_topic",
+    "inform_response",
+    "request_aspect",
+    "feedback_positive",
+]
+
+
+def source_path(data_dir: str, path: str) -> str:
+    """
+    Where path, a source under paths.DATA_DIR, goes under data_dir
+    """
+    return os.path.join(data_dir, os.path.relpath(path, paths.DATA_DIR))
+
+
+def sentence(rng: random.Random, low: int, high: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def page_title(i: int) -> str:
+    return f"Page_{i}"
+
+
+def make_question(rng: random.Random, qanta_id: int, n_pages: int) -> Dict:
+    sentences = [sentence(rng, 10, 25) + "." for _ in range(rng.randint(3, 6))]
+    text = " ".join(sentences)
+    tokenizations = []
+    start = 0
+    for s in sentences:
+        tokenizations.append([start, start + len(s)])
+        start += len(s) + 1
+    return {
+        "qanta_id": qanta_id,
+        "text": text,
+        "first_sentence": sentences[0],
+        "tokenizations": tokenizations,
+        "answer": f"answer {qanta_id}",
+        "page": page_title(rng.randrange(n_pages)) if rng.random() < 0.9 else None,
+        "fold": rng.choice(FOLDS),
+        "gameplay": True,
+        "category": rng.choice(CATEGORIES),
+        "subcategory": "None",
+        "tournament": f"Tournament {rng.randrange(40)}",
+        "difficulty": rng.choice(DIFFICULTIES),
+        "year": rng.randint(1997, 2017),
+        # Protobowl ids are strings, a third of questions were never played
+        "proto_id": f"proto{qanta_id}" if qanta_id % 3 else None,
+        "qdb_id": qanta_id,
+        "dataset": "protobowl" if qanta_id % 3 else "quizdb.org",
+    }
+
+
+def write_questions(path: str, rng: random.Random, n_questions: int, n_pages: int):
+    questions = [make_question(rng, i, n_pages) for i in range(n_questions)]
+    with open(path, "w") as f:
+        json.dump({"questions": questions, "version": "synthetic"}, f)
+
+
+def write_protobowl_log(path: str, seed: int, n_plays: int, n_questions: int):
+    np_rng = np.random.default_rng(seed)
+    qanta_ids = np_rng.integers(0, max(1, n_questions), n_plays)
+    # Plays of questions missing from qanta are dropped by populate
+    qids = np.where(
+        (qanta_ids % 3 != 0) & (np_rng.random(n_plays) < 0.95),
+        np.char.add("proto", qanta_ids.astype(str)),
+        "unknown",
+    )
+    results = np.array([True, False, "prompt"], dtype=object)
+    log_df = pd.DataFrame(
+        {
+            "qid": qids.astype(object),
+            "uid": np.char.add(
+                "user", np_rng.integers(0, n_plays // 5 + 1, n_plays).astype(str)
+            ).astype(object),
+            "buzzing_position": np_rng.random(n_plays),
+            "date": pd.Timestamp("2017-01-01")
+            + pd.to_timedelta(np_rng.integers(0, 10**7, n_plays), unit="s"),
+            "guess": "guess",
+            "result": results[np_rng.integers(0, 3, n_plays)],
+        }
+    )
+    # Like the real log, result mixes booleans and strings so it is pickled
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", pd.errors.PerformanceWarning)
+        log_df.to_hdf(path, key="data")
+
+
+def make_dialog(rng: random.Random, dialog_id: int, n_pages: int, n_facts: int) -> Dict:
+    messages = []
+    for k in range(rng.randint(6, 14)):
+        sender = "user" if k % 2 == 0 else "assistant"
+        facts = []
+        if sender == "assistant":
+            facts = [
+                {
+                    "fid": rng.randrange(1, n_facts + 1),
+                    "used": rng.random() < 0.5,
+                    "source": "section",
+                }
+                for _ in range(rng.randint(1, 4))
+            ]
+        messages.append(
+            {
+                "message": sentence(rng, 6, 30),
+                "liked": rng.random() < 0.5,
+                "sender": sender,
+                "facts": facts,
+                "message_id": f"{dialog_id}-{k}",
+                "dialog_acts": [rng.choice(DIALOG_ACTS)],
+            }
+        )
+    aspects = rng.sample(SECTIONS[1:], 2)
+    return {
+        "messages": messages,
+        "known_entities": [page_title(rng.randrange(n_pages)) for _ in range(3)],
+        "focus_entity": page_title(rng.randrange(n_pages)),
+        "dialog_id": dialog_id,
+        "inferred_steps": False,
+        "created_time": 1_560_000_000 + dialog_id,
+        "aspects": aspects,
+        "first_aspect": aspects[0],
+        "second_aspect": aspects[1],
+        "shuffle_facts": True,
+        "related_entities": [page_title(rng.randrange(n_pages)) for _ in range(5)],
+        "tag": "synthetic",
+        "user_id": str(rng.randrange(500)),
+        "assistant_id": str(rng.randrange(500)),
+        "user_dialog_rating": rng.randint(1, 5),
+        "user_other_agent_rating": rng.randint(1, 5),
+        "assistant_dialog_rating": rng.randint(1, 5),
+        "assistant_other_agent_rating": rng.randint(1, 5),
+        "reported": False,
+    }
+
+
+def write_dialogs(
+    data_dir: str, rng: random.Random, n_dialogs: int, n_pages: int, n_facts: int
+):
+    dialog_id = 0
+    for fold in paths.CURIOSITY_FOLDS:
+        dialogs = []
+        for _ in range(n_dialogs):
+            dialogs.append(make_dialog(rng, dialog_id, n_pages, n_facts))
+            dialog_id += 1
+        with open(source_path(data_dir, paths.curiosity_dialogs(fold)), "w") as f:
+            json.dump({"dialogs": dialogs}, f)
+
+
+def write_wiki(
+    path: str,
+    rng: random.Random,
+    n_pages: int,
+    facts_per_page: int,
+    mentions_per_fact: int,
+):
+    if os.path.exists(path):
+        os.remove(path)
+    db_engine = create_engine(f"sqlite:///{path}")
+    wiki_db.Base.metadata.create_all(db_engine)
+    tables = wiki_db.Base.metadata.tables
+    fact_id = 0
+    mention_id = 0
+    with db_engine.begin() as conn:
+        for i in range(n_pages):
+            page = page_title(i)
+            views = rng.randrange(100, 100_000)
+            facts: List[Dict] = []
+            mentions: List[Dict] = []
+            for paragraph in range(facts_per_page):
+                fact_id += 1
+                section_idx = paragraph * len(SECTIONS) // facts_per_page
+                facts.append(
+                    {
+                        "id": fact_id,
+                        "page": page,
+                        "section_idx": section_idx,
+                        "section_title": SECTIONS[section_idx],
+                        "paragraph_idx": paragraph,
+                        "text": sentence(rng, 10, 30) + " < ref >cite< / ref >",
+                        "pageviews": views,
+                    }
+                )
+                for _ in range(mentions_per_fact):
+                    mention_id += 1
+                    mentions.append(
+                        {
+                            "id": mention_id,
+                            "is_location": rng.random() < 0.2,
+                            "pageviews": rng.randrange(100, 100_000),
+                            "page": page,
+                            "title": page_title(rng.randrange(n_pages)),
+                            "fact_id": fact_id,
+                        }
+                    )
+            conn.execute(tables["fact"].insert(), facts)
+            if len(mentions) != 0:
+                conn.execute(tables["mention"].insert(), mentions)
+            conn.execute(
+                tables["wiki"].insert(),
+                [{"title": page, "text": sentence(rng, 20, 40), "is_simple": False}],
+            )
+    db_engine.dispose()
+
+
+def generate(
+    data_dir: str,
+    questions: int = 2_000,
+    plays: int = 20_000,
+    dialogs: int = 250,
+    pages: int = 200,
+    facts_per_page: int = 40,
+    mentions_per_fact: int = 3,
+    seed: int = 0,
+):
+    """
+    Write every source populate reads to data_dir, with dialogs per fold
+    """
+    rng = random.Random(seed)
+    os.makedirs(source_path(data_dir, paths.CURIOSITY_DIR), exist_ok=True)
+    log.info("Writing %s questions and %s plays", questions, plays)
+    write_questions(source_path(data_dir, paths.QANTA_QUESTIONS), rng, questions, pages)
+    write_protobowl_log(
+        source_path(data_dir, paths.PROTOBOWL_LOG), seed, plays, questions
+    )
+    log.info("Writing %s dialogs per fold", dialogs)
+    write_dialogs(data_dir, rng, dialogs, pages, pages * facts_per_page)
+    log.info("Writing %s wiki pages", pages)
+    write_wiki(
+        source_path(data_dir, paths.WIKI_DB),
+        rng,
+        pages,
+        facts_per_page,
+        mentions_per_fact,
+    )
+
+
+@app.command()
+def main(
+    data_dir: str = typer.Argument(paths.DATA_DIR),
+    questions: int = 2_000,
+    plays: int = 20_000,
+    dialogs: int = 250,
+    pages: int = 200,
+    facts_per_page: int = 40,
+    mentions_per_fact: int = 3,
+    seed: int = 0,
+):
+    generate(
+        data_dir,
+        questions=questions,
+        plays=plays,
+        dialogs=dialogs,
+        pages=pages,
+        facts_per_page=facts_per_page,
+        mentions_per_fact=mentions_per_fact,
+        seed=seed,
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,48 @@
+"""
+Fetch many rows by id with a few IN queries instead of one query per id
+"""
+from typing import Dict, List, Sequence
+
+from fastapi import HTTPException
+from pydantic import BaseModel  # pylint: disable=no-name-in-module
+
+
+# Below SQLite's default limit of 999 bound parameters per statement
+MAX_QUERY_IDS = 900
+MAX_BATCH_IDS = 10_000
+
+
+class BatchRequest(BaseModel):
+    ids: List[int]
+
+
+def check_batch(request: BatchRequest):
+    if len(request.ids) > MAX_BATCH_IDS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per batch"
+        )
+
+
+def fetch_by_ids(db, model, column, ids: Sequence[int]) -> Dict:
+    """
+    Rows of model whose column is in ids, keyed by id, querying
+    MAX_QUERY_IDS ids at a time
+    """
+    unique_ids = list(dict.fromkeys(ids))
+    rows = {}
+    for start in range(0, len(unique_ids), MAX_QUERY_IDS):
+        chunk = unique_ids[start : start + MAX_QUERY_IDS]
+        for row in db.query(model).filter(column.in_(chunk)):
+            rows[getattr(row, column.key)] = row
+    return rows
+
+
+def batch_response(name: str, ids: Sequence[int], rows: Dict, to_dict) -> Dict:
+    """
+    Results in the order of ids, repeated ids included, and the ids with
+    no row under missing
+    """
+    return {
+        name: [to_dict(rows[i]) for i in ids if i in rows],
+        "missing": [i for i in dict.fromkeys(ids) if i not in rows],
+    }
@@ -0,0 +1,671 @@
+"""
+Building the database from the downloaded source files. Only the main.py
+commands import this module, so the web app never loads pandas or tqdm.
+"""
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+from datetime import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+
+import pandas as pd
+from tqdm import tqdm
+
+from sqlalchemy import Table, bindparam, text
+from sqlalchemy.engine import Engine
+
+from explorer import paths
+from explorer.log import get_logger
+from explorer.json_stream import iter_json_array
+from explorer.compression import store_dialogs, stored_level
+from explorer.curiosity.data import CuriosityDialog
+from explorer.curiosity.fact_store import ensure_fact_store
+from explorer.curiosity.prominence import ensure_prominence
+from explorer.sampling import write_sampling_tables
+from explorer.sqlite_profile import close_journal
+from explorer.search import (
+    build_dialog_index,
+    build_fact_index,
+    build_question_index,
+    has_index,
+)
+from explorer.database import (
+    BUZZ_BADGES,
+    FIRST_PLAYS,
+    COMBINED_FACETS,
+    QUESTION_FACETS,
+    SCHEMA_VERSION,
+    Base,
+    create_db_engine,
+    engine,
+    get_build_info,
+    play_event_dict,
+)
+from explorer.qanta.buzzes import annotate_buzzes
+
+
+log = get_logger(__name__)
+
+QUESTION_BATCH_SIZE = 10_000
+PLAY_EVENT_BATCH_SIZE = 50_000
+DIALOG_BATCH_SIZE = 1_000
+PLAY_EVENT_COLUMNS = [
+    "qanta_id",
+    "buzzing_position",
+    "user_id",
+    "date",
+    "guess",
+    "result",
+]
+# Protobowl logs store results as True/False or the string "prompt"
+PLAY_EVENT_RESULTS = {True: "correct", False: "wrong", "prompt": "prompt"}
+# Columns upserts compare to decide whether a row changed, when not all of
+# them. Dialogs stored compressed have no plain data to compare, so their
+# hash stands in for it.
+UPSERT_COMPARED_COLUMNS = {
+    "curiosity_dialog": [
+        c.name
+        for c in Base.metadata.tables["curiosity_dialog"].columns
+        if c.name not in ("dialog_id", "data", "data_zstd")
+    ]
+}
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source_key(path: str) -> str:
+    return os.path.relpath(path, paths.DATA_DIR)
+
+
+def source_changed(db_engine: Engine, path: str, record: bool = True) -> bool:
+    """
+    Compare path to its fingerprint from the last build. Size and mtime are
+    checked first, the content hash only when the mtime alone differs. If
+    record is set, the new mtime of a touched but unmodified file is saved.
+    """
+    table = Base.metadata.tables["source_file"]
+    with db_engine.connect() as conn:
+        row = conn.execute(
+            table.select().where(table.c.path == _source_key(path))
+        ).first()
+    if row is None:
+        return True
+    stat = os.stat(path)
+    if stat.st_size != row.size:
+        return True
+    if stat.st_mtime == row.mtime:
+        return False
+    if file_sha256(path) != row.sha256:
+        return True
+    if record:
+        # Touched but not modified, remember the new mtime to skip hashing next time
+        record_source(db_engine, path, sha256=row.sha256)
+    return False
+
+
+def record_source(db_engine: Engine, path: str, sha256: Optional[str] = None):
+    stat = os.stat(path)
+    if sha256 is None:
+        sha256 = file_sha256(path)
+    upsert_rows(
+        db_engine,
+        Base.metadata.tables["source_file"],
+        [
+            {
+                "path": _source_key(path),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "sha256": sha256,
+            }
+        ],
+    )
+
+
+def upsert_rows(db_engine: Engine, table: Table, rows: List[Dict]) -> int:
+    """
+    Insert rows, updating existing ones only where a column differs. Columns
+    missing from the rows are left as they are. Returns the number of rows actually inserted or changed.
+    """
+    if len(rows) == 0:
+        return 0
+    columns = list(rows[0])
+    keys = [c.name for c in table.primary_key.columns]
+    updates = [c for c in columns if c not in keys]
+    compared = UPSERT_COMPARED_COLUMNS.get(table.name, updates)
+    statement = text(
+        f"INSERT INTO {table.name} ({', '.join(columns)}) "
+        f"VALUES ({', '.join(':' + c for c in columns)}) "
+        f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+        + ", ".join(f"{c} = excluded.{c}" for c in updates)
+        + " WHERE "
+        + " OR ".join(f"{c} IS NOT excluded.{c}" for c in compared)
+    ).bindparams(*[bindparam(c, type_=table.c[c].type) for c in columns])
+    with db_engine.begin() as conn:
+        return conn.execute(statement, rows).rowcount
+
+
+def delete_missing(db_engine: Engine, table: Table, key: str, seen: Set) -> int:
+    """
+    Delete rows whose key was not seen in the latest source data
+    """
+    column = table.c[key]
+    with db_engine.begin() as conn:
+        existing = {
+            r[0] for r in conn.execute(table.select().with_only_columns([column]))
+        }
+        missing = list(existing - seen)
+        for start in range(0, len(missing), 500):
+            conn.execute(table.delete().where(column.in_(missing[start : start + 500])))
+    return len(missing)
+
+
+def stamp_build(db_engine: Engine, current_schema: bool = True):
+    """
+    Give the build a new id. Builds that kept tables from an older schema
+    keep the old schema version, so the next incremental build is a full one.
+    """
+    rows = [
+        {"key": "build_id", "value": uuid.uuid4().hex},
+        {"key": "built_at", "value": datetime.utcnow().isoformat()},
+    ]
+    if current_schema:
+        rows.append({"key": "schema_version", "value": str(SCHEMA_VERSION)})
+    upsert_rows(db_engine, Base.metadata.tables["build_info"], rows)
+
+
+def copy_database(source: str, target: str):
+    """
+    Copy a SQLite database with the backup API, which is consistent
+    even if the source is being read
+    """
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        with dst:
+            src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+@contextmanager
+def shadow_database(path: str, copy: bool) -> Iterator[Engine]:
+    """
+    Build into a shadow file next to path, then atomically swap it in so
+    readers only ever see a complete database. If copy is set, the shadow
+    starts from the current database so builds can be incremental.
+    """
+    shadow_path = f"{path}.shadow"
+    if os.path.exists(shadow_path):
+        os.remove(shadow_path)
+    if copy and os.path.exists(path):
+        log.info("Copying %s to %s", path, shadow_path)
+        copy_database(path, shadow_path)
+    shadow_engine = create_db_engine(shadow_path)
+    try:
+        yield shadow_engine
+    except BaseException:
+        shadow_engine.dispose()
+        if os.path.exists(shadow_path):
+            os.remove(shadow_path)
+        raise
+    shadow_engine.dispose()
+    close_journal(shadow_path)
+    os.replace(shadow_path, path)
+    log.info("Swapped new database into %s", path)
+
+
+def qanta_sources() -> List[str]:
+    return [paths.QANTA_QUESTIONS, paths.PROTOBOWL_LOG]
+
+
+def curiosity_sources() -> List[str]:
+    return [paths.curiosity_dialogs(fold) for fold in paths.CURIOSITY_FOLDS]
+
+
+def wiki_sources() -> List[str]:
+    # The wiki database is downloaded separately and may not be present
+    return [paths.WIKI_DB] if os.path.exists(paths.WIKI_DB) else []
+
+
+def build_db(
+    incremental: bool = False,
+    qanta: bool = True,
+    curiosity: bool = True,
+    workers: int = 1,
+    compression_level: Optional[int] = None,
+):
+    """
+    Build the database into a shadow copy and swap it in when finished.
+    Full builds start from an empty database. Incremental builds skip
+    sources whose fingerprints match the last build and otherwise only
+    write rows that changed, so they are a no-op when nothing changed.
+    With more than one worker, sources are parsed in parallel processes.
+    With a compression level, dialogs are stored zstd compressed.
+    """
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    # The pipeline builds on the row helpers in this module
+    from explorer.pipeline import build_parallel
+
+    sources = (qanta_sources() if qanta else []) + (
+        curiosity_sources() + wiki_sources() if curiosity else []
+    )
+    live_info = get_build_info(engine) if os.path.exists(paths.QANTA_DB) else {}
+    schema_current = live_info.get("schema_version") == str(SCHEMA_VERSION)
+    if incremental and not schema_current:
+        log.info("Database schema is out of date, doing a full build")
+        incremental = False
+    # The served database is only read, the shadow records touched sources
+    if (
+        incremental
+        and not any(source_changed(engine, p, record=False) for p in sources)
+        and (not curiosity or stored_level(engine) == compression_level)
+    ):
+        log.info("Sources are unchanged, nothing to rebuild")
+        return
+
+    # Partial builds keep the tables they do not touch, whatever their schema
+    partial = not (qanta and curiosity)
+    copy = incremental or partial
+    if partial and not schema_current and os.path.exists(paths.QANTA_DB):
+        log.warning(
+            "Keeping tables from an older database schema, "
+            "run a full populate to rebuild them"
+        )
+    with shadow_database(paths.QANTA_DB, copy=copy) as db_engine:
+        if not copy:
+            log.info("Creating DB")
+        # Adds tables missing from a copied database
+        Base.metadata.create_all(bind=db_engine)
+        if workers > 1:
+            build_parallel(
+                db_engine,
+                workers,
+                incremental=incremental,
+                qanta=qanta,
+                curiosity=curiosity,
+            )
+        else:
+            if qanta:
+                build_qanta(db_engine, incremental=incremental)
+            if curiosity:
+                build_curiosity(db_engine, incremental=incremental)
+        if curiosity:
+            # After the search index, which reads the plain text
+            store_dialogs(db_engine, compression_level)
+            index_facts(db_engine, incremental=incremental)
+        stamp_build(db_engine, current_schema=schema_current or not partial)
+    # Pooled connections to the served database still read the replaced file
+    engine.dispose()
+    # Every table is rewritten since they are tagged with the new build id
+    write_sampling_tables(paths.QANTA_DB)
+    if curiosity:
+        ensure_fact_store(paths.WIKI_DB, paths.FACT_STORE)
+        ensure_prominence(paths.WIKI_DB, paths.PROMINENCE_DB)
+
+
+def index_facts(db_engine: Engine, incremental: bool = False):
+    if (
+        incremental
+        and has_index(db_engine, "fact_fts")
+        and not any(source_changed(db_engine, p) for p in wiki_sources())
+    ):
+        log.info("Wiki facts are unchanged, skipping")
+        return
+    build_fact_index(db_engine, paths.WIKI_DB)
+    for path in wiki_sources():
+        record_source(db_engine, path)
+
+
+def load_curiosity() -> Iterator[Tuple[str, CuriosityDialog]]:
+    for fold in paths.CURIOSITY_FOLDS:
+        for d in iter_json_array(paths.curiosity_dialogs(fold), "dialogs"):
+            yield fold, CuriosityDialog(**d)
+
+
+def to_dialog_row(dialog: CuriosityDialog) -> Dict:
+    data = dialog.json()
+    return {
+        "dialog_id": dialog.dialog_id,
+        "user_id": dialog.user_id,
+        "assistant_id": dialog.assistant_id,
+        "topic": dialog.focus_entity,
+        "aspect_1": dialog.first_aspect,
+        "aspect_2": dialog.second_aspect,
+        "data": data,
+        "data_zstd": None,
+        "data_sha256": hashlib.sha256(data.encode()).hexdigest(),
+    }
+
+
+def batched(items: Iterable, batch_size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) != 0:
+        yield batch
+
+
+def plan_curiosity(db_engine: Engine, incremental: bool) -> bool:
+    """
+    Decide whether dialogs need to be written, preparing the table if so
+    """
+    if incremental:
+        return any(source_changed(db_engine, p) for p in curiosity_sources())
+    log.info("Dropping Prior version")
+    table = Base.metadata.tables["curiosity_dialog"]
+    table.drop(bind=db_engine, checkfirst=True)
+    table.create(bind=db_engine)
+    return True
+
+
+def record_curiosity_sources(db_engine: Engine):
+    for path in curiosity_sources():
+        record_source(db_engine, path)
+
+
+def build_curiosity(db_engine: Engine, incremental: bool = False):
+    if not plan_curiosity(db_engine, incremental):
+        log.info("Curiosity dialogs are unchanged, skipping")
+        return
+
+    log.info("Loading and writing dialogs")
+    table = Base.metadata.tables["curiosity_dialog"]
+    seen = set()
+    n_changed = 0
+    rows = (to_dialog_row(d) for _, d in tqdm(load_curiosity()))
+    for batch in batched(rows, DIALOG_BATCH_SIZE):
+        seen.update(r["dialog_id"] for r in batch)
+        n_changed += upsert_rows(db_engine, table, batch)
+    n_deleted = delete_missing(db_engine, table, "dialog_id", seen)
+    log.info("Dialogs: %s written or changed, %s deleted", n_changed, n_deleted)
+    build_dialog_index(db_engine)
+    record_curiosity_sources(db_engine)
+
+
+def to_question_row(q: Dict) -> Dict:
+    return {
+        "qanta_id": q["qanta_id"],
+        "text": q["text"],
+        "first_sentence": q["first_sentence"],
+        "tokenizations": json.dumps(q["tokenizations"]),
+        "answer": q["answer"],
+        "page": q["page"],
+        "fold": q["fold"],
+        "gameplay": q["gameplay"],
+        "category": q["category"],
+        "subcategory": q["subcategory"],
+        "tournament": q["tournament"],
+        "difficulty": q["difficulty"],
+        "year": q["year"],
+        "proto_id": q["proto_id"],
+        "qdb_id": q["qdb_id"],
+        "dataset": q["dataset"],
+    }
+
+
+def write_questions(db_engine: Engine) -> Dict:
+    """
+    Upsert questions from the qanta dump, delete questions no longer in it,
+    and return the mapping from protobowl ids to qanta ids.
+    """
+    table = Base.metadata.tables["questions"]
+    proto_id_to_qanta = {}
+    seen = set()
+    n_changed = 0
+    log.info("Writing questions")
+    questions = iter_json_array(paths.QANTA_QUESTIONS, "questions")
+    for batch in batched(tqdm(questions), QUESTION_BATCH_SIZE):
+        rows = []
+        for q in batch:
+            if q["proto_id"] is not None:
+                proto_id_to_qanta[q["proto_id"]] = q["qanta_id"]
+            seen.add(q["qanta_id"])
+            rows.append(to_question_row(q))
+        n_changed += upsert_rows(db_engine, table, rows)
+    n_deleted = delete_missing(db_engine, table, "qanta_id", seen)
+    log.info("Questions: %s written or changed, %s deleted", n_changed, n_deleted)
+    return proto_id_to_qanta
+
+
+def precompute_facet_counts(db_engine: Engine):
+    """
+    Fill question_facet_count with the number of questions for each
+    combination of COMBINED_FACETS values, then question_facet_pair with the
+    counts of every facet value given one other facet's value, summed from
+    it when both facets are combined and counted from questions otherwise.
+    """
+    columns = ", ".join(COMBINED_FACETS)
+    with db_engine.begin() as conn:
+        conn.execute(text("DELETE FROM question_facet_count"))
+        conn.execute(text("DELETE FROM question_facet_pair"))
+        conn.execute(
+            text(
+                f"INSERT INTO question_facet_count ({columns}, n_questions) "
+                f"SELECT {columns}, COUNT(*) FROM questions GROUP BY {columns}"
+            )
+        )
+        for given in QUESTION_FACETS:
+            for facet in QUESTION_FACETS:
+                if given in COMBINED_FACETS and facet in COMBINED_FACETS:
+                    source = "SUM(n_questions) FROM question_facet_count"
+                else:
+                    source = "COUNT(*) FROM questions"
+                # given == facet gives each value's count without filters
+                conn.execute(
+                    text(
+                        "INSERT INTO question_facet_pair "
+                        "(given_facet, given_value, facet, value, n_questions) "
+                        f"SELECT :given, {given}, :facet, {facet}, {source} "
+                        f"GROUP BY {given}, {facet}"
+                    ),
+                    given=given,
+                    facet=facet,
+                )
+        n = conn.execute(text("SELECT COUNT(*) FROM question_facet_count")).scalar()
+        n_pairs = conn.execute(
+            text("SELECT COUNT(*) FROM question_facet_pair")
+        ).scalar()
+    log.info("Precomputed %s facet combinations and %s pairs", n, n_pairs)
+
+
+def read_proto_id_mapping(db_engine: Engine) -> Dict:
+    table = Base.metadata.tables["questions"]
+    with db_engine.connect() as conn:
+        rows = conn.execute(
+            table.select()
+            .with_only_columns([table.c.proto_id, table.c.qanta_id])
+            .where(table.c.proto_id.isnot(None))
+        )
+        return {r.proto_id: r.qanta_id for r in rows}
+
+
+def plan_qanta(db_engine: Engine, incremental: bool) -> Tuple[bool, bool]:
+    """
+    Decide whether questions and play events need to be written. Play events
+    have no natural key to upsert on, so if they changed they are cleared and
+    rewritten in full, which readers never see since builds use a shadow copy.
+    """
+    questions_changed = not incremental or source_changed(
+        db_engine, paths.QANTA_QUESTIONS
+    )
+    # Play events are keyed through proto_id, so they depend on both files
+    events_changed = questions_changed or source_changed(db_engine, paths.PROTOBOWL_LOG)
+    if events_changed:
+        with db_engine.begin() as conn:
+            conn.execute(Base.metadata.tables["play_event"].delete())
+    return questions_changed, events_changed
+
+
+def build_qanta(db_engine: Engine, incremental: bool = False):
+    questions_changed, events_changed = plan_qanta(db_engine, incremental)
+    if questions_changed:
+        proto_id_to_qanta = write_questions(db_engine)
+        build_question_index(db_engine)
+        precompute_facet_counts(db_engine)
+        record_source(db_engine, paths.QANTA_QUESTIONS)
+    else:
+        log.info("Questions are unchanged, skipping")
+        proto_id_to_qanta = read_proto_id_mapping(db_engine)
+
+    if events_changed:
+        log.info("Writing play events")
+        write_play_events(db_engine, paths.PROTOBOWL_LOG, proto_id_to_qanta)
+        precompute_question_plays(db_engine)
+        record_source(db_engine, paths.PROTOBOWL_LOG)
+    else:
+        log.info("Play events are unchanged, skipping")
+
+
+def iter_protobowl_chunks(path: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    """
+    Yield the protobowl log in chunks of at most chunksize rows.
+    Table formatted HDF5 files are read incrementally, fixed format files
+    can only be read whole so they are sliced after loading.
+    """
+    try:
+        chunks = pd.read_hdf(path, chunksize=chunksize)
+    except TypeError:
+        df = pd.read_hdf(path)
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start : start + chunksize]
+    else:
+        yield from chunks
+
+
+def to_play_event_rows(chunk: pd.DataFrame, proto_id_to_qanta: Dict) -> pd.DataFrame:
+    """
+    Convert a chunk of protobowl log rows to play_event rows, dropping
+    events for questions that are not in qanta.
+    """
+    qanta_ids = chunk["qid"].map(proto_id_to_qanta)
+    matched = qanta_ids.notna().to_numpy()
+    chunk = chunk[matched]
+    results = chunk["result"].map(PLAY_EVENT_RESULTS)
+    unexpected = results.isna().to_numpy()
+    if unexpected.any():
+        raise ValueError(f"Unexpected result: {chunk['result'][unexpected].iloc[0]}")
+    return pd.DataFrame(
+        {
+            "qanta_id": qanta_ids[matched].astype(int).to_numpy(),
+            "buzzing_position": chunk["buzzing_position"].to_numpy(),
+            "user_id": chunk["uid"].to_numpy(),
+            "date": chunk["date"].to_numpy(),
+            "guess": chunk["guess"].to_numpy(),
+            "result": results.to_numpy(),
+        },
+        columns=PLAY_EVENT_COLUMNS,
+    )
+
+
+def write_play_events(
+    db_engine: Engine,
+    path: str,
+    proto_id_to_qanta: Dict,
+    batch_size: int = PLAY_EVENT_BATCH_SIZE,
+):
+    """
+    Write play events in fixed size batches through a Core executemany,
+    committing each batch so memory stays flat regardless of log size.
+    """
+    n = 0
+    start = time.time()
+    insert = Base.metadata.tables["play_event"].insert()
+    with tqdm(unit="rows") as progress:
+        for chunk in iter_protobowl_chunks(path, batch_size):
+            rows = to_play_event_rows(chunk, proto_id_to_qanta)
+            if len(rows) != 0:
+                with db_engine.begin() as conn:
+                    conn.execute(insert, rows.to_dict("records"))
+            n += len(rows)
+            progress.update(len(chunk))
+    elapsed = time.time() - start
+    log.info(
+        "Found %s matching records, wrote in %.1fs (%.0f rows/sec)",
+        n,
+        elapsed,
+        n / max(elapsed, 1e-9),
+    )
+
+
+def precompute_question_plays(db_engine: Engine, page_size: int = 1_000):
+    """
+    Store the buzz annotated text, first plays and play count of each question
+    so that question pages are a single row read. Questions are processed a
+    page at a time to keep memory flat.
+    """
+    log.info("Precomputing question plays")
+    questions = Base.metadata.tables["questions"]
+    plays = Base.metadata.tables["play_event"]
+    update = (
+        questions.update()
+        .where(questions.c.qanta_id == bindparam("b_qanta_id"))
+        .values(
+            buzz_html=bindparam("buzz_html"),
+            first_plays=bindparam("first_plays"),
+            n_plays=bindparam("n_plays"),
+        )
+    )
+    last_id = None
+    with tqdm() as progress:
+        while True:
+            with db_engine.begin() as conn:
+                query = questions.select().with_only_columns(
+                    [questions.c.qanta_id, questions.c.text]
+                )
+                if last_id is not None:
+                    query = query.where(questions.c.qanta_id > last_id)
+                page = conn.execute(
+                    query.order_by(questions.c.qanta_id).limit(page_size)
+                ).fetchall()
+                if len(page) == 0:
+                    break
+                last_id = page[-1].qanta_id
+                page_plays = defaultdict(list)
+                for play in conn.execute(
+                    plays.select()
+                    .where(plays.c.qanta_id.between(page[0].qanta_id, last_id))
+                    .order_by(plays.c.qanta_id, plays.c.play_id)
+                ):
+                    page_plays[play.qanta_id].append(play)
+
+                updates = []
+                for q in page:
+                    q_plays = page_plays[q.qanta_id]
+                    records = sorted(
+                        [p for p in q_plays if p.result != "prompt"],
+                        key=lambda p: p.date,
+                    )
+                    updates.append(
+                        {
+                            "b_qanta_id": q.qanta_id,
+                            "buzz_html": annotate_buzzes(
+                                q.text,
+                                [p.user_id for p in q_plays],
+                                [p.buzzing_position for p in q_plays],
+                                [p.result for p in q_plays],
+                                max_buzzes=BUZZ_BADGES,
+                            ),
+                            "first_plays": json.dumps(
+                                [play_event_dict(p) for p in records[:FIRST_PLAYS]],
+                                default=str,
+                            ),
+                            "n_plays": len(records),
+                        }
+                    )
+                conn.execute(update, updates)
+                progress.update(len(page))
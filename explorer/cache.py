@@ -0,0 +1,241 @@
+"""
+Response cache for dataset pages. The data only changes when populate swaps
+in a new build, so responses are cached in memory and tagged with an ETag
+derived from the build id, letting browsers and CDNs revalidate with a 304
+instead of downloading the page again. The build id is checked at most once
+per VERSION_TTL seconds, in the database thread pool.
+"""
+from typing import Callable, List, Optional, Pattern, Tuple
+import functools
+import glob
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl
+
+from explorer.database import get_build_id, run_in_db_thread
+from explorer.metrics import RESPONSE_CACHE
+
+
+# Pages whose content is fixed for a build, random pages are left out
+CACHED_ROUTES = [
+    r"/qanta/question/\d+",
+    r"/qanta/api/qanta/v1/\d+",
+    r"/qanta/api/qanta/v1/questions",
+    r"/qanta/api/search",
+    r"/curiosity/dialog/\d+",
+    r"/curiosity/dialog/topic/[^/]+",
+    r"/curiosity/dialogs",
+    r"/curiosity/topics",
+    r"/curiosity/api/search",
+]
+CACHE_BYTES = int(os.environ.get("EXPLORER_CACHE_BYTES", str(64 * 1024 * 1024)))
+# Responses larger than this fraction of the cache are served but not stored
+MAX_ENTRY_FRACTION = 16
+CACHE_CONTROL = "public, max-age=300"
+# Seconds a build id is used before checking for a swapped in build again
+VERSION_TTL = 1.0
+
+
+@functools.lru_cache()
+def get_release_id() -> str:
+    """
+    Fingerprint of the code and templates that render pages, so a deploy
+    without a rebuild still changes ETags. EXPLORER_RELEASE overrides it.
+    """
+    release = os.environ.get("EXPLORER_RELEASE")
+    if release is not None:
+        return release
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    files = glob.glob(os.path.join(package_dir, "**", "*.py"), recursive=True)
+    files += glob.glob(os.path.join("templates", "**", "*"), recursive=True)
+    digest = hashlib.sha1()
+    for path in sorted(files):
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def cache_key(scope) -> str:
+    query = sorted(parse_qsl(scope["query_string"].decode("latin-1"), True))
+    return scope["path"] + "?" + "&".join(f"{k}={v}" for k, v in query)
+
+
+def make_etag(version: str, key: str) -> str:
+    digest = hashlib.sha1(f"{version}\n{get_release_id()}\n{key}".encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    If-None-Match uses weak comparison (RFC 7232 section 2.3.2), so a tag a
+    proxy marked weak with W/, for instance after compressing the body, still
+    matches
+    """
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in [t[2:] if t.startswith("W/") else t for t in tags]
+
+
+class CachedResponse:
+    def __init__(self, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers)
+
+
+def storable(start) -> bool:
+    return start["status"] == 200 and all(
+        k.lower() != b"set-cookie" for k, _ in start["headers"]
+    )
+
+
+class ResponseCache:
+    """
+    ASGI middleware caching successful GET responses of CACHED_ROUTES in an
+    LRU holding at most max_bytes of responses. The cache is emptied when
+    version, the database build id by default, changes. version blocks, so
+    it is called in the database thread pool at most once per version_ttl
+    seconds.
+    """
+
+    def __init__(
+        self,
+        app,
+        max_bytes: int = CACHE_BYTES,
+        max_entry_bytes: Optional[int] = None,
+        routes: Optional[List[str]] = None,
+        version: Callable[[], str] = get_build_id,
+        cache_control: str = CACHE_CONTROL,
+        version_ttl: float = VERSION_TTL,
+    ) -> None:
+        self.app = app
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = (
+            max_bytes // MAX_ENTRY_FRACTION
+            if max_entry_bytes is None
+            else max_entry_bytes
+        )
+        self.routes: List[Pattern] = [
+            re.compile(r) for r in (CACHED_ROUTES if routes is None else routes)
+        ]
+        self.version = version
+        self.cache_control = cache_control.encode()
+        self.version_ttl = version_ttl
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._size = 0
+        self._cached_version: Optional[str] = None
+        self._version_checked = 0.0
+
+    def _cacheable(self, scope) -> bool:
+        return (
+            scope["type"] == "http"
+            and scope["method"] == "GET"
+            and any(r.fullmatch(scope["path"]) for r in self.routes)
+        )
+
+    def _get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key: str, entry: CachedResponse):
+        if entry.size > self.max_entry_bytes:
+            return
+        if key in self._entries:
+            self._size -= self._entries.pop(key).size
+        self._entries[key] = entry
+        self._size += entry.size
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    async def _current_version(self) -> str:
+        now = time.monotonic()
+        if (
+            self._cached_version is None
+            or now - self._version_checked >= self.version_ttl
+        ):
+            self._version_checked = now
+            version = await run_in_db_thread(self.version)
+            if version != self._cached_version:
+                self.clear()
+                self._cached_version = version
+        return self._cached_version
+
+    async def __call__(self, scope, receive, send):
+        if not self._cacheable(scope):
+            await self.app(scope, receive, send)
+            return
+
+        version = await self._current_version()
+        key = cache_key(scope)
+        etag = make_etag(version, key)
+        cache_headers = [
+            (b"etag", etag.encode()),
+            (b"cache-control", self.cache_control),
+        ]
+
+        entry = self._get(key)
+        # Only a response the route produced for this build can be revalidated
+        if_none_match = dict(scope["headers"]).get(b"if-none-match")
+        if (
+            entry is not None
+            and if_none_match is not None
+            and etag_matches(if_none_match.decode("latin-1"), etag)
+        ):
+            RESPONSE_CACHE.inc("not_modified")
+            await send(
+                {"type": "http.response.start", "status": 304, "headers": cache_headers}
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if entry is not None:
+            RESPONSE_CACHE.inc("hit")
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": entry.status,
+                    "headers": entry.headers,
+                }
+            )
+            await send({"type": "http.response.body", "body": entry.body})
+            return
+
+        RESPONSE_CACHE.inc("miss")
+        start = {}
+        chunks = []
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                if message["status"] == 200:
+                    message["headers"] = list(message.get("headers", [])) + (
+                        cache_headers
+                    )
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                # Not stored if a new build was swapped in meanwhile
+                if (
+                    not message.get("more_body", False)
+                    and storable(start)
+                    and self._cached_version == version
+                ):
+                    self._put(
+                        key,
+                        CachedResponse(
+                            start["status"], start["headers"], b"".join(chunks)
+                        ),
+                    )
+            await send(message)
+
+        await self.app(scope, receive, capture)
@@ -0,0 +1,319 @@
+"""
+Optional zstd compression of stored Curiosity dialogs. Dialogs repeat the
+same keys and many of the same values, so populate trains a zstd dictionary
+over them and stores each dialog compressed with it, which shrinks the
+dialog table several times over. Needs the zstandard package, which is
+only imported when compression is used.
+"""
+from typing import Dict, Iterator, List, Optional, Tuple
+import statistics
+import threading
+import time
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Engine
+
+from explorer.database import Base, BuildCache
+from explorer.log import get_logger
+
+
+log = get_logger(__name__)
+
+DEFAULT_LEVEL = 10
+DICTIONARY_BYTES = 112_640
+# zstd suggests training on about 100 times the dictionary size, so smaller
+# sample sets get a smaller dictionary
+SAMPLE_BYTES_PER_DICTIONARY_BYTE = 100
+MIN_DICTIONARY_BYTES = 1_024
+MAX_TRAINING_SAMPLES = 5_000
+PAGE_SIZE = 1_000
+DECODERS = BuildCache()
+
+
+def import_zstd():
+    try:
+        import zstandard  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        raise RuntimeError(
+            "Compressed dialogs need the zstandard package installed"
+        ) from None
+    return zstandard
+
+
+class DialogDecoder:
+    """
+    Decompresses dialogs compressed with one dictionary. zstd decompressors
+    must not be shared between threads, so each thread gets its own.
+    """
+
+    def __init__(self, dictionary: bytes) -> None:
+        self.zstd = import_zstd()
+        self.dictionary = self.zstd.ZstdCompressionDict(dictionary)
+        self._local = threading.local()
+
+    def decompress(self, data: bytes) -> str:
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self.zstd.ZstdDecompressor(dict_data=self.dictionary)
+            self._local.decompressor = decompressor
+        return decompressor.decompress(data).decode()
+
+
+def read_decoder(db) -> Optional[DialogDecoder]:
+    dictionary = db.execute(
+        text("SELECT dictionary FROM dialog_dictionary LIMIT 1")
+    ).scalar()
+    return None if dictionary is None else DialogDecoder(dictionary)
+
+
+def get_decoder(db) -> Optional[DialogDecoder]:
+    """
+    Decoder for the database being served, None if its dialogs are stored
+    as plain text
+    """
+    return DECODERS.get_or_set("decoder", lambda: read_decoder(db))
+
+
+def dialog_json(
+    decoder: Optional[DialogDecoder], data: Optional[str], data_zstd: Optional[bytes]
+) -> Optional[str]:
+    if data is not None or data_zstd is None:
+        return data
+    if decoder is None:
+        raise ValueError("Dialog is compressed but there is no dictionary")
+    return decoder.decompress(data_zstd)
+
+
+def iter_dialog_pages(
+    conn, decoder, plain_only: bool = False, compressed_only: bool = False
+) -> Iterator[List[Tuple[int, str]]]:
+    """
+    Every dialog's id and JSON in pages of PAGE_SIZE, decompressing them
+    as needed, or only those stored as plain text or compressed
+    """
+    where = ""
+    if plain_only:
+        where = "data IS NOT NULL AND "
+    elif compressed_only:
+        where = "data IS NULL AND "
+    after = -1
+    while True:
+        rows = conn.execute(
+            text(
+                "SELECT dialog_id, data, data_zstd FROM curiosity_dialog "
+                f"WHERE {where}dialog_id > :after ORDER BY dialog_id LIMIT :limit"
+            ),
+            after=after,
+            limit=PAGE_SIZE,
+        ).fetchall()
+        if len(rows) == 0:
+            break
+        yield [(r.dialog_id, dialog_json(decoder, r.data, r.data_zstd)) for r in rows]
+        after = rows[-1].dialog_id
+
+
+def training_samples(conn, decoder) -> List[bytes]:
+    n = conn.execute(text("SELECT COUNT(*) FROM curiosity_dialog")).scalar()
+    step = max(1, -(-n // MAX_TRAINING_SAMPLES))
+    samples = []
+    for page in iter_dialog_pages(conn, decoder):
+        samples.extend(
+            data.encode() for dialog_id, data in page if dialog_id % step == 0
+        )
+    return samples
+
+
+def train_dictionary(samples: List[bytes], dictionary_bytes: int = DICTIONARY_BYTES):
+    """
+    Dictionary of at most dictionary_bytes, less when there are too few
+    samples for a dictionary that large to pay for itself
+    """
+    zstd = import_zstd()
+    sample_bytes = sum(len(s) for s in samples)
+    dictionary_bytes = min(
+        dictionary_bytes,
+        max(MIN_DICTIONARY_BYTES, sample_bytes // SAMPLE_BYTES_PER_DICTIONARY_BYTE),
+    )
+    return zstd.train_dictionary(dictionary_bytes, samples)
+
+
+def count_storage(conn) -> Dict[str, int]:
+    return dict(
+        conn.execute(
+            text(
+                "SELECT COUNT(data) AS plain, COUNT(data_zstd) AS compressed, "
+                "COALESCE(SUM(LENGTH(data_zstd)), 0) AS compressed_bytes "
+                "FROM curiosity_dialog"
+            )
+        ).first()
+    )
+
+
+def stored_level(db_engine: Engine) -> Optional[int]:
+    """
+    Level the dialogs were compressed at, None when stored as plain text
+    """
+    with db_engine.connect() as conn:
+        return conn.execute(text("SELECT level FROM dialog_dictionary")).scalar()
+
+
+def store_dialogs(db_engine: Engine, level: Optional[int] = None):
+    """
+    Store dialogs compressed at zstd level with a dictionary trained over
+    them, or as plain text when level is None. Nothing is rewritten when the
+    dialogs are already stored that way, and when only dialogs written since
+    are plain they are compressed with the stored dictionary.
+    """
+    dictionaries = Base.metadata.tables["dialog_dictionary"]
+    with db_engine.connect() as conn:
+        current = conn.execute(dictionaries.select()).first()
+        storage = count_storage(conn)
+    if level is None and storage["compressed"] == 0:
+        return
+    if level is not None and current is not None and current.level == level:
+        if storage["plain"] != 0:
+            compress_plain(db_engine, current)
+        return
+
+    decoder = None if current is None else DialogDecoder(current.dictionary)
+    update = dialog_update()
+    compressor = None
+    plain_bytes = 0
+    with db_engine.begin() as conn:
+        conn.execute(dictionaries.delete())
+        if level is not None:
+            log.info("Training dialog dictionary")
+            dictionary = train_dictionary(training_samples(conn, decoder))
+            conn.execute(
+                dictionaries.insert(),
+                [{"dictionary": dictionary.as_bytes(), "level": level}],
+            )
+            compressor = import_zstd().ZstdCompressor(level=level, dict_data=dictionary)
+        log.info("Rewriting dialogs")
+        for page in iter_dialog_pages(conn, decoder):
+            rows = []
+            for dialog_id, data in page:
+                plain_bytes += len(data.encode())
+                if compressor is None:
+                    rows.append(
+                        {"dialog_id": dialog_id, "data": data, "data_zstd": None}
+                    )
+                else:
+                    compressed = compressor.compress(data.encode())
+                    rows.append(
+                        {"dialog_id": dialog_id, "data": None, "data_zstd": compressed}
+                    )
+            conn.execute(update, rows)
+        after = count_storage(conn)
+    if compressor is not None:
+        log.info(
+            "Compressed %s dialogs at level %s from %s to %s bytes, %.1fx, "
+            "with a %s byte dictionary",
+            after["compressed"],
+            level,
+            plain_bytes,
+            after["compressed_bytes"],
+            plain_bytes / max(1, after["compressed_bytes"]),
+            len(dictionary.as_bytes()),
+        )
+    # Give back the pages the old representation used
+    with db_engine.connect() as conn:
+        conn.execute(text("VACUUM"))
+
+
+def dialog_update():
+    dialogs = Base.metadata.tables["curiosity_dialog"]
+    return text(
+        "UPDATE curiosity_dialog SET data = :data, data_zstd = :data_zstd "
+        "WHERE dialog_id = :dialog_id"
+    ).bindparams(bindparam("data_zstd", type_=dialogs.c.data_zstd.type))
+
+
+def compress_plain(db_engine: Engine, current):
+    """
+    Compress the dialogs stored as plain text with the current dictionary,
+    leaving the others untouched
+    """
+    zstd = import_zstd()
+    compressor = zstd.ZstdCompressor(
+        level=current.level, dict_data=zstd.ZstdCompressionDict(current.dictionary)
+    )
+    update = dialog_update()
+    n = 0
+    with db_engine.begin() as conn:
+        for page in iter_dialog_pages(conn, None, plain_only=True):
+            conn.execute(
+                update,
+                [
+                    {
+                        "dialog_id": dialog_id,
+                        "data": None,
+                        "data_zstd": compressor.compress(data.encode()),
+                    }
+                    for dialog_id, data in page
+                ],
+            )
+            n += len(page)
+    log.info("Compressed %s new dialogs with the stored dictionary", n)
+
+
+def percentile(values: List[float], p: float) -> float:
+    # quantiles needs at least two values, as with --sample 1
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def measure_level(samples: List[bytes], level: int, dictionary=None) -> Dict:
+    """
+    Compress samples at level, with dictionary if given, and time
+    decompressing each of them
+    """
+    zstd = import_zstd()
+    if dictionary is None:
+        compressor = zstd.ZstdCompressor(level=level)
+        decompressor = zstd.ZstdDecompressor()
+    else:
+        compressor = zstd.ZstdCompressor(level=level, dict_data=dictionary)
+        decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+    start = time.perf_counter()
+    compressed = [compressor.compress(s) for s in samples]
+    compress_seconds = time.perf_counter() - start
+    decode_us = []
+    for c in compressed:
+        start = time.perf_counter()
+        decompressor.decompress(c)
+        decode_us.append((time.perf_counter() - start) * 1e6)
+    plain_bytes = sum(len(s) for s in samples)
+    compressed_bytes = sum(len(c) for c in compressed)
+    return {
+        "level": level,
+        "dictionary": dictionary is not None,
+        "ratio": plain_bytes / compressed_bytes,
+        "compress_mb_per_s": plain_bytes / compress_seconds / 1e6,
+        "decode_p50_us": percentile(decode_us, 50),
+        "decode_p99_us": percentile(decode_us, 99),
+    }
+
+
+def measure_levels(
+    db_engine: Engine, levels: List[int], dictionary_bytes: int = DICTIONARY_BYTES
+) -> List[Dict]:
+    """
+    Compression ratio and speed at each level, with and without a trained
+    dictionary. The dictionary is trained on half of the sampled dialogs and
+    measured on the other half.
+    """
+    with db_engine.connect() as conn:
+        current = conn.execute(
+            Base.metadata.tables["dialog_dictionary"].select()
+        ).first()
+        decoder = None if current is None else DialogDecoder(current.dictionary)
+        samples = training_samples(conn, decoder)
+    held_out = samples[1::2]
+    dictionary = train_dictionary(samples[0::2], dictionary_bytes)
+    results = []
+    for level in levels:
+        results.append(measure_level(held_out, level))
+        results.append(measure_level(held_out, level, dictionary))
+    return results
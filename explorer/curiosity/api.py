@@ -1,44 +1,122 @@
-from typing import Optional
-import random
+from typing import List, Optional
+import json
 import math
+import os
+import threading
 
-from fastapi import FastAPI, Request, Depends
-from fastapi.templating import Jinja2Templates
+from fastapi import FastAPI, Request, Depends, HTTPException, Response
 
-from explorer.database import SessionLocal, get_db, CuriosityDbDialog
-from explorer.curiosity.wiki_db import CuriosityStore
+from explorer import paths
+from explorer.batch import BatchRequest, batch_response, check_batch, fetch_by_ids
+from explorer.compression import dialog_json, get_decoder
+from explorer.database import (
+    AsyncDB,
+    get_db,
+    engine,
+    refresh_engine,
+    CuriosityDbDialog,
+    BuildCache,
+)
+from explorer.curiosity.fact_store import FactStore
 from explorer.curiosity.data import CuriosityDialog
+from explorer.export import export_dialogs, export_response
+from explorer.jinja import ConfigurableJinja2Templates
+from explorer.log import get_logger
+from explorer.metrics import RequestMetrics
+from explorer.pagination import decode_cursor, encode_cursor
+from explorer.sampling import get_sampling_table
+from explorer.search import search_dialogs, search_facts, search_page
+
+log = get_logger(__name__)
 
-CACHED_CURIOSITY_IDS = []
 CACHED_CURIOSITY_TOPICS = []
-fact_lookup = CuriosityStore("data/curiosity/wiki_sql.sqlite.db").get_fact_lookup()
+# Dialog counts by topic, bounded since the topic comes from the request
+DIALOG_COUNTS = BuildCache(max_size=1024)
+# Parsed dialogs for rendering pages, keyed by dialog id
+PARSED_DIALOGS = BuildCache(max_size=2048)
+SEARCHES = {"dialogs": search_dialogs, "facts": search_facts}
+_fact_lookup: Optional[FactStore] = None
+# Routes run their queries on several threads, so caches are filled under a lock
+_cache_lock = threading.Lock()
 
 curiosity_app = FastAPI()
-templates = Jinja2Templates(directory="templates")
+curiosity_app.add_middleware(RequestMetrics, name="curiosity")
+templates = ConfigurableJinja2Templates(directory="templates")
+
 
+def get_fact_lookup() -> Optional[FactStore]:
+    """
+    Open the fact store populate built on first use, or None if it is
+    missing. Web workers only read it, building it here would have every
+    worker race to write the same file.
+    """
+    global _fact_lookup  # pylint: disable=global-statement
+    with _cache_lock:
+        if _fact_lookup is None:
+            if not os.path.exists(paths.FACT_STORE):
+                log.error(
+                    "Fact store %s is missing, run populate to build it",
+                    paths.FACT_STORE,
+                )
+                return None
+            _fact_lookup = FactStore(paths.FACT_STORE)
+    return _fact_lookup
 
-def get_curiosity_topics(db: SessionLocal):
-    if len(CACHED_CURIOSITY_TOPICS) == 0:
-        topics = db.query(CuriosityDbDialog.topic).distinct().all()
-        for t in topics:
-            if isinstance(t, str):
-                CACHED_CURIOSITY_TOPICS.append(t)
-            else:
-                CACHED_CURIOSITY_TOPICS.append(t[0])
 
-        CACHED_CURIOSITY_TOPICS.extend(topics)
+def get_curiosity_topics(db):
+    with _cache_lock:
+        if len(CACHED_CURIOSITY_TOPICS) == 0:
+            topics = db.query(CuriosityDbDialog.topic).distinct().all()
+            for t in topics:
+                if isinstance(t, str):
+                    CACHED_CURIOSITY_TOPICS.append(t)
+                else:
+                    CACHED_CURIOSITY_TOPICS.append(t[0])
+
+            CACHED_CURIOSITY_TOPICS.extend(topics)
     return CACHED_CURIOSITY_TOPICS
 
 
+def get_parsed_dialog(db, dialog_id: int) -> Optional[CuriosityDialog]:
+    def parse():
+        row = (
+            db.query(CuriosityDbDialog.data, CuriosityDbDialog.data_zstd)
+            .filter_by(dialog_id=dialog_id)
+            .first()
+        )
+        if row is None:
+            return None
+        return CuriosityDialog.parse_raw(dialog_json(get_decoder(db), *row))
+
+    return PARSED_DIALOGS.get_or_set(dialog_id, parse)
+
+
+def json_response(name: str, items: List[str], **fields) -> Response:
+    """
+    JSON object with the already serialized items listed under name,
+    followed by fields. The stored dialog JSON was validated when it was
+    built, so it is spliced in rather than parsed and serialized again.
+    """
+    body = [f'{{"{name}":[', ",".join(items), "]"]
+    for key, value in fields.items():
+        body.append(f",{json.dumps(key)}:{json.dumps(value)}")
+    body.append("}")
+    return Response("".join(body), media_type="application/json")
+
+
 def get_html_dialog(db, request: Request, dialog_id: int):
-    dialog = db.query(CuriosityDbDialog).filter_by(dialog_id=dialog_id).first()
-    if dialog is None:
+    data = get_parsed_dialog(db, dialog_id)
+    if data is None:
         return templates.TemplateResponse(
             "missing.html.jinja2",
             {"request": request, "data_id": dialog_id, "data_name": "Curiosity Dialog"},
             status_code=404,
         )
-    data = CuriosityDialog.parse_raw(dialog.data)
+    fact_lookup = get_fact_lookup()
+    if fact_lookup is None:
+        raise HTTPException(
+            status_code=503, detail="Wiki facts are not built, run populate"
+        )
     dialog_facts = {}
     for msg in data.messages:
         for f in msg.facts:
@@ -50,37 +128,90 @@ def get_html_dialog(db, request: Request, dialog_id: int):
     )
 
 
-def get_all_curiosity_ids(db):
-    if len(CACHED_CURIOSITY_IDS) == 0:
-        all_curiosity_ids = [r[0] for r in db.query(CuriosityDbDialog.dialog_id).all()]
-        CACHED_CURIOSITY_IDS.extend(all_curiosity_ids)
-    return CACHED_CURIOSITY_IDS
+def random_dialog_id(db, topic: Optional[str] = None) -> int:
+    dialog_id = get_sampling_table(db, "curiosity").choice({"topic": topic})
+    if dialog_id is None:
+        raise HTTPException(status_code=404, detail="No dialog matches the filters")
+    return dialog_id
+
+
+def get_dialog_count(db, topic: Optional[str]) -> int:
+    query = db.query(CuriosityDbDialog)
+    if topic is not None:
+        query = query.filter_by(topic=topic)
+    return DIALOG_COUNTS.get_or_set(topic, query.count)
+
+
+def get_html_topic_dialogs(db, request: Request, topic: str):
+    topic_dialogs = db.query(CuriosityDbDialog).filter_by(topic=topic).all()
+    n = len(topic_dialogs)
+    return templates.TemplateResponse(
+        "curiosity/topics.html.jinja2",
+        {"request": request, "dialogs": topic_dialogs, "n": n, "topic": topic},
+    )
+
+
+def get_dialog_page(
+    db, topic: Optional[str], limit: int, page: Optional[int], after: Optional[int]
+):
+    query = db.query(
+        CuriosityDbDialog.dialog_id, CuriosityDbDialog.data, CuriosityDbDialog.data_zstd
+    )
+    if topic is not None:
+        query = query.filter_by(topic=topic)
+    if after is None:
+        query = query.order_by(CuriosityDbDialog.dialog_id).offset((page - 1) * limit)
+    else:
+        query = query.filter(CuriosityDbDialog.dialog_id > after).order_by(
+            CuriosityDbDialog.dialog_id
+        )
+    # Fetch one extra row to know whether there is a next page
+    dialogs = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(dialogs) > limit:
+        dialogs = dialogs[:limit]
+        next_cursor = encode_cursor(dialogs[-1].dialog_id)
+    total = get_dialog_count(db, topic)
+    total_pages = math.ceil(total / limit)
+    decoder = get_decoder(db)
+    return json_response(
+        "dialogs",
+        [dialog_json(decoder, d.data, d.data_zstd) for d in dialogs],
+        n_dialogs=total,
+        n_pages=total_pages,
+        page=page,
+        next=next_cursor,
+        topic=topic,
+    )
+
+
+def get_dialog_batch(db, ids: List[int]):
+    dialogs = fetch_by_ids(db, CuriosityDbDialog, CuriosityDbDialog.dialog_id, ids)
+    decoder = get_decoder(db)
+    response = batch_response(
+        "dialogs", ids, dialogs, lambda d: dialog_json(decoder, d.data, d.data_zstd)
+    )
+    return json_response("dialogs", response["dialogs"], missing=response["missing"])
 
 
 @curiosity_app.get("/dialog/random")
-async def read_random_dialog(request: Request, db: SessionLocal = Depends(get_db)):
-    dialog_id = random.choice(get_all_curiosity_ids(db))
-    return get_html_dialog(db, request, dialog_id)
+async def read_random_dialog(
+    request: Request, topic: Optional[str] = None, db: AsyncDB = Depends(get_db)
+):
+    dialog_id = await db.run(random_dialog_id, topic)
+    return await db.run(get_html_dialog, request, dialog_id)
 
 
 @curiosity_app.get("/dialog/{dialog_id}")
-async def read_dialog(
-    request: Request, dialog_id: int, db: SessionLocal = Depends(get_db)
-):
-    return get_html_dialog(db, request, dialog_id)
+async def read_dialog(request: Request, dialog_id: int, db: AsyncDB = Depends(get_db)):
+    return await db.run(get_html_dialog, request, dialog_id)
 
 
 @curiosity_app.get("/dialog/topic/{topic}")
 async def read_dialogs_by_topic(
-    request: Request, topic: str, db: SessionLocal = Depends(get_db)
+    request: Request, topic: str, db: AsyncDB = Depends(get_db)
 ):
-    # pylint: disable=unused-argument
-    topic_dialogs = db.query(CuriosityDbDialog).filter_by(topic=topic).all()
-    n = len(topic_dialogs)
-    return templates.TemplateResponse(
-        "curiosity/topics.html.jinja2",
-        {"request": request, "dialogs": topic_dialogs, "n": n, "topic": topic},
-    )
+    return await db.run(get_html_topic_dialogs, request, topic)
 
 
 @curiosity_app.get("/dialogs")
@@ -89,32 +220,64 @@ async def get_dialogs(
     topic: Optional[str] = None,
     limit: int = 10,
     page: int = 1,
-    db: SessionLocal = Depends(get_db),
+    cursor: Optional[str] = None,
+    db: AsyncDB = Depends(get_db),
 ):
+    """
+    Dialogs ordered by id. Pass the returned `next` cursor to get the
+    following page with a keyset seek, `page` is kept for older clients.
+    """
     # pylint: disable=unused-argument
-    if topic is None:
-        dialogs = db.query(CuriosityDbDialog).limit(limit).offset((page - 1) * limit)
-        total = db.query(CuriosityDbDialog).count()
-    else:
-        dialogs = (
-            db.query(CuriosityDbDialog)
-            .filter_by(topic=topic)
-            .limit(limit)
-            .offset((page - 1) * limit)
-        )
-        total = db.query(CuriosityDbDialog).filter_by(topic=topic).count()
-    total_pages = math.ceil(total / limit)
-    return {
-        "dialogs": [CuriosityDialog.parse_raw(d.data) for d in dialogs],
-        "n_dialogs": total,
-        "n_pages": total_pages,
-        "page": page,
-        "topic": topic,
-    }
+    if cursor is None:
+        return await db.run(get_dialog_page, topic, limit, page, None)
+    return await db.run(get_dialog_page, topic, limit, None, decode_cursor(cursor))
+
+
+@curiosity_app.post("/api/dialogs/batch")
+async def get_dialogs_by_id(batch: BatchRequest, db: AsyncDB = Depends(get_db)):
+    """
+    Dialogs for every id in the body, in the same order. Ids with no dialog
+    are listed under `missing`.
+    """
+    check_batch(batch)
+    return await db.run(get_dialog_batch, batch.ids)
+
+
+@curiosity_app.get("/api/dialogs/export")
+def export(
+    topic: Optional[str] = None,
+    format: str = "ndjson",  # pylint: disable=redefined-builtin
+):
+    """
+    Every dialog, or those of topic, streamed as NDJSON or Parquet
+    """
+    refresh_engine()
+    return export_response(
+        lambda: export_dialogs(engine, format, topic), format, "dialogs"
+    )
 
 
 @curiosity_app.get("/topics")
-async def get_topics(request: Request, db: SessionLocal = Depends(get_db)):
+async def get_topics(request: Request, db: AsyncDB = Depends(get_db)):
     # pylint: disable=unused-argument
-    topics = get_curiosity_topics(db)
+    topics = await db.run(get_curiosity_topics)
     return {"topics": topics}
+
+
+@curiosity_app.get("/api/search")
+async def search(
+    q: str,
+    source: str = "dialogs",
+    limit: int = 10,
+    page: int = 1,
+    db: AsyncDB = Depends(get_db),
+):
+    """
+    Dialogs ranked by how well their topic and messages match q, or wiki
+    facts with source=facts. Matches in the snippet are wrapped in <mark>.
+    """
+    if source not in SEARCHES:
+        raise HTTPException(
+            status_code=400, detail=f"source must be one of {', '.join(SEARCHES)}"
+        )
+    return await db.run(search_page, SEARCHES[source], q, limit, page)
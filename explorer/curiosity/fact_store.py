@@ -0,0 +1,125 @@
+"""
+Read only store of wiki fact texts that is memory mapped, so every web
+worker shares one copy through the page cache and opening it is instant.
+
+File layout, integers are native byte order:
+    magic (8 bytes) | n_slots (uint64)
+    offsets (uint64 * (n_slots + 1)), fact fid is blob[offsets[fid]:offsets[fid + 1]]
+    presence bitmap (ceil(n_slots / 8) bytes), bit fid is set if fact fid exists
+    blob of concatenated UTF-8 fact texts
+"""
+from typing import Iterator, Optional, Tuple
+import mmap
+import os
+import sqlite3
+import struct
+from array import array
+
+from explorer.log import get_logger
+
+
+log = get_logger(__name__)
+
+MAGIC = b"FACTS001"
+HEADER = struct.Struct("=8sQ")
+
+
+def iter_facts(wiki_db_path: str) -> Iterator[Tuple[int, str]]:
+    conn = sqlite3.connect(wiki_db_path)
+    try:
+        yield from conn.execute("SELECT id, text FROM fact ORDER BY id")
+    finally:
+        conn.close()
+
+
+def build_fact_store(wiki_db_path: str, output_path: str):
+    """
+    Write the fact texts of the wiki database to output_path, replacing
+    it atomically so readers never see a partial file
+    """
+    conn = sqlite3.connect(wiki_db_path)
+    try:
+        max_id = conn.execute("SELECT MAX(id) FROM fact").fetchone()[0]
+    finally:
+        conn.close()
+    n_slots = 0 if max_id is None else max_id + 1
+    offsets = array("Q", [0]) * (n_slots + 1)
+    bitmap = bytearray((n_slots + 7) // 8)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        blob_start = HEADER.size + offsets.itemsize * len(offsets) + len(bitmap)
+        f.seek(blob_start)
+        position = 0
+        previous_id = -1
+        for fid, text in iter_facts(wiki_db_path):
+            # Missing ids get empty slots
+            for missing in range(previous_id + 1, fid + 1):
+                offsets[missing] = position
+            data = text.encode("utf-8")
+            f.write(data)
+            position += len(data)
+            bitmap[fid // 8] |= 1 << (fid % 8)
+            previous_id = fid
+        for missing in range(previous_id + 1, n_slots + 1):
+            offsets[missing] = position
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, n_slots))
+        f.write(offsets.tobytes())
+        f.write(bitmap)
+    os.replace(tmp_path, output_path)
+    log.info(
+        "Wrote %s fact slots (%s bytes of text) to %s", n_slots, position, output_path
+    )
+
+
+def ensure_fact_store(wiki_db_path: str, output_path: str):
+    """
+    Build the fact store if it is missing or older than the wiki database
+    """
+    if not os.path.exists(wiki_db_path):
+        log.warning("Wiki database %s is missing, not building facts", wiki_db_path)
+        return
+    if os.path.exists(output_path) and os.path.getmtime(
+        output_path
+    ) >= os.path.getmtime(wiki_db_path):
+        return
+    log.info("Building fact store from %s", wiki_db_path)
+    build_fact_store(wiki_db_path, output_path)
+
+
+class FactStore:
+    """
+    Mapping from fact id to fact text backed by a memory mapped file
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, n_slots = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"Not a fact store: {path}")
+        self._n_slots = n_slots
+        offsets_end = HEADER.size + 8 * (n_slots + 1)
+        bitmap_end = offsets_end + (n_slots + 7) // 8
+        self._offsets = view[HEADER.size : offsets_end].cast("Q")
+        self._bitmap = view[offsets_end:bitmap_end]
+        self._blob = view[bitmap_end:]
+
+    def __contains__(self, fid: int) -> bool:
+        return 0 <= fid < self._n_slots and bool(
+            self._bitmap[fid // 8] >> (fid % 8) & 1
+        )
+
+    def __getitem__(self, fid: int) -> str:
+        if fid not in self:
+            raise KeyError(fid)
+        return str(self._blob[self._offsets[fid] : self._offsets[fid + 1]], "utf-8")
+
+    def get(self, fid: int, default: Optional[str] = None) -> Optional[str]:
+        if fid in self:
+            return self[fid]
+        return default
+
+    def __len__(self) -> int:
+        return bin(int.from_bytes(self._bitmap, "little")).count("1")
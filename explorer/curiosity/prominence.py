@@ -0,0 +1,156 @@
+"""
+Prominence curricula of wiki pages: the page's views and the distinct
+entities its facts mention with their views. They are computed by one
+aggregate query over the wiki database and materialized into a small SQLite
+database keyed by page, so a curriculum is read on demand and all of them
+can be iterated without holding them in memory.
+"""
+from typing import Iterator, Mapping, Optional, Tuple, TypedDict
+import json
+import os
+import sqlite3
+import threading
+
+from explorer.log import get_logger
+
+
+log = get_logger(__name__)
+
+SCHEMA = "CREATE TABLE prominence (page TEXT PRIMARY KEY, views INTEGER, entities TEXT)"
+# Entities come from the mention table's copy of the page, so there is no join
+# through fact. Pages without mentions get no entities. SQLite does not
+# guarantee the order json_group_array sees rows in, so they are sorted when
+# read.
+MATERIALIZE = """
+INSERT INTO prominence (page, views, entities)
+SELECT f.page, f.views, COALESCE(m.entities, '[]')
+FROM (SELECT page, MAX(pageviews) AS views FROM wiki.fact GROUP BY page) AS f
+LEFT JOIN (
+    SELECT page, json_group_array(json_array(title, pageviews)) AS entities
+    FROM (
+        SELECT DISTINCT page, title, pageviews FROM wiki.mention
+    )
+    GROUP BY page
+) AS m ON m.page = f.page
+"""
+
+
+def entity_order(entity: Tuple[str, int]):
+    title, views = entity
+    return -views, title
+
+
+class EntitySet(set):
+    """
+    Set of (title, pageviews) entities that iterates most viewed first, then
+    by title
+    """
+
+    def __iter__(self):
+        return iter(sorted(super().__iter__(), key=entity_order))
+
+
+class Curriculum(TypedDict):
+    views: int
+    entities: EntitySet
+
+
+def to_curriculum(views: int, entities: str) -> Curriculum:
+    return Curriculum(
+        views=views, entities=EntitySet(tuple(e) for e in json.loads(entities))
+    )
+
+
+def prominence_path(wiki_db_path: str) -> str:
+    return os.path.join(os.path.dirname(wiki_db_path), "wiki_prominence.sqlite3")
+
+
+def build_prominence(wiki_db_path: str, output_path: str):
+    """
+    Materialize the curricula of the wiki database to output_path,
+    replacing it atomically so readers never see a partial file
+    """
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("ATTACH DATABASE ? AS wiki", (wiki_db_path,))
+        conn.execute(SCHEMA)
+        conn.execute(MATERIALIZE)
+        conn.commit()
+        n_pages = conn.execute("SELECT COUNT(*) FROM prominence").fetchone()[0]
+    finally:
+        conn.close()
+    os.replace(tmp_path, output_path)
+    log.info("Wrote curricula of %s pages to %s", n_pages, output_path)
+
+
+def ensure_prominence(wiki_db_path: str, output_path: str):
+    """
+    Build the curricula if they are missing or older than the wiki database
+    """
+    if not os.path.exists(wiki_db_path):
+        log.warning("Wiki database %s is missing, not building curricula", wiki_db_path)
+        return
+    if os.path.exists(output_path) and os.path.getmtime(
+        output_path
+    ) >= os.path.getmtime(wiki_db_path):
+        return
+    log.info("Building curricula from %s", wiki_db_path)
+    build_prominence(wiki_db_path, output_path)
+
+
+class CurriculumTable(Mapping):
+    """
+    Read only mapping from page to its Curriculum backed by the materialized
+    table. Like the defaultdict curricula used to be built in, pages without
+    one get no views and no entities. Lookups share one connection, iterating
+    streams pages in order from a connection of its own.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn = self._connect()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(
+            f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+        )
+
+    def get(self, key: str, default: Optional[Curriculum] = None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT views, entities FROM prominence WHERE page = ?", (key,)
+            ).fetchone()
+        return default if row is None else to_curriculum(*row)
+
+    def __getitem__(self, page: str) -> Curriculum:
+        curriculum = self.get(page)
+        if curriculum is None:
+            return Curriculum(views=0, entities=EntitySet())
+        return curriculum
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM prominence").fetchone()[0]
+
+    def _stream(self, query: str) -> Iterator[tuple]:
+        conn = self._connect()
+        try:
+            yield from conn.execute(query)
+        finally:
+            conn.close()
+
+    def __iter__(self) -> Iterator[str]:
+        for (page,) in self._stream("SELECT page FROM prominence ORDER BY page"):
+            yield page
+
+    def iter_curricula(self) -> Iterator[Tuple[str, Curriculum]]:
+        query = "SELECT page, views, entities FROM prominence ORDER BY page"
+        for page, views, entities in self._stream(query):
+            yield page, to_curriculum(views, entities)
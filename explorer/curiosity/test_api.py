@@ -31,6 +31,25 @@ def test_dialogs_api():
     assert parsed["topic"] is None
 
 
+def test_dialogs_api_cursor():
+    first = client.get("/curiosity/dialogs", params={"limit": 2}).json()
+    assert first["next"] is not None
+    second = client.get(
+        "/curiosity/dialogs", params={"limit": 2, "cursor": first["next"]}
+    ).json()
+    by_page = client.get("/curiosity/dialogs", params={"limit": 2, "page": 2}).json()
+    assert [d["dialog_id"] for d in second["dialogs"]] == [
+        d["dialog_id"] for d in by_page["dialogs"]
+    ]
+    assert second["page"] is None
+    assert second["n_dialogs"] == first["n_dialogs"]
+
+
+def test_dialogs_api_bad_cursor():
+    response = client.get("/curiosity/dialogs", params={"cursor": "not a cursor"})
+    assert response.status_code == 400
+
+
 def test_topics_api():
     response = client.get("/curiosity/topics")
     assert response.status_code == 200
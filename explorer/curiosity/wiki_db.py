@@ -4,19 +4,33 @@ import platform
 import re
 import subprocess
 import os
+import threading
 from contextlib import contextmanager
-from collections import defaultdict
-from typing import List, Tuple, Dict, NamedTuple
-from sqlalchemy import Boolean, Integer, ForeignKey, Column, Text, create_engine
+from collections import OrderedDict, defaultdict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+from sqlalchemy import Boolean, Integer, ForeignKey, Column, Text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import (
-    Load,
-    sessionmaker,
-    scoped_session,
-    relationship,
-    selectinload,
+from sqlalchemy.orm import Session, sessionmaker, scoped_session, relationship
+
+from explorer.diagnostics import instrument_engine
+from explorer.sqlite_profile import SERVE, SqliteProfile, create_sqlite_engine
+from explorer.curiosity.prominence import (  # pylint: disable=unused-import
+    Curriculum,
+    CurriculumTable,
+    ensure_prominence,
+    prominence_path,
 )
-from sqlalchemy.orm.scoping import ScopedSession
 
 
 def md5sum(filename: str) -> str:
@@ -57,14 +71,18 @@ def clean_text(text: str) -> str:
 Base = declarative_base()
 
 
-def create_sql(sql_path: str):
-    engine = create_engine(f"sqlite:///{sql_path}")
+def create_sql(sql_path: str, profile: SqliteProfile = SERVE):
+    engine = create_sqlite_engine(sql_path, profile)
     Base.metadata.bind = engine
     factory = sessionmaker(bind=engine)
     session_cls = scoped_session(factory)
     return engine, session_cls()
 
 
+# Below SQLite's default limit of 999 bound parameters per statement
+MAX_QUERY_PARAMS = 900
+
+
 class EntityLink(NamedTuple):
     """
     This represents a single fact in the frontend
@@ -81,11 +99,6 @@ class EntityLink(NamedTuple):
     mention_id: int
 
 
-class Curriculum(NamedTuple):
-    views: int
-    entities: List[Tuple[str, int]]
-
-
 class Fact(Base):
     __tablename__ = "fact"
     id = Column(Integer, primary_key=True)
@@ -118,20 +131,86 @@ class WikiSummary(Base):
     is_simple = Column(Boolean, nullable=False)
 
 
+# Selected instead of loading ORM objects when building links
+FACT_COLUMNS = [Fact.id, Fact.page, Fact.section_title, Fact.text]
+MENTION_COLUMNS = [
+    Mention.id,
+    Mention.is_location,
+    Mention.pageviews,
+    Mention.page,
+    Mention.title,
+    Mention.fact_id,
+]
+
+
+def to_link(fact, mention, clean: bool = False) -> EntityLink:
+    return EntityLink(
+        fact.page,
+        mention.title,
+        fact.section_title,
+        mention.pageviews,
+        clean_text(fact.text) if clean else fact.text,
+        mention.is_location,
+        fact.id,
+        mention.id,
+    )
+
+
+class EntityCache:
+    """
+    Least recently used cache of per entity results, a max_size of 0
+    disables it
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._values: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            if len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+
+def chunks(items: List, size: int = MAX_QUERY_PARAMS) -> Iterator[List]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
 class CuriosityStore:
     """
-    Convenience class for reading all data
+    Convenience class for reading all data. Each *_batch method takes many
+    page entities and answers with a few queries, the single entity methods
+    are shorthands for them. With cache_size, results for the cache_size
+    most recently used entities of each method are kept in memory.
     """
 
-    def __init__(self, sql_path: str) -> None:
-        self._engine = create_engine(f"sqlite:///{sql_path}")
+    def __init__(self, sql_path: str, cache_size: int = 0) -> None:
+        # One pool of read only connections reused by every call
+        self._sql_path = sql_path
+        self._engine = create_sqlite_engine(sql_path, SERVE)
         Base.metadata.bind = self._engine
+        instrument_engine(self._engine)
+        self._session_factory = sessionmaker(bind=self._engine)
+        self._cache = EntityCache(cache_size)
         self._pages: List[str] = self._cache_pages()
 
     @property
     @contextmanager
-    def _session_scope(self) -> ScopedSession:
-        session = scoped_session(sessionmaker(bind=self._engine))
+    def _session_scope(self) -> Session:
+        session = self._session_factory()
         try:
             yield session
             session.commit()
@@ -141,6 +220,30 @@ class CuriosityStore:
         finally:
             session.close()
 
+    def _cached_batch(
+        self, name: str, keys: Iterable[Hashable], query_fn: Callable
+    ) -> Dict:
+        """
+        Results for each key, from the cache or from query_fn called with the
+        keys that were not cached. Keys query_fn has no result for get [].
+        """
+        results = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            cached = self._cache.get((name, key))
+            if cached is None:
+                missing.append(key)
+            else:
+                results[key] = list(cached)
+        if len(missing) != 0:
+            with self._session_scope as session:
+                found = query_fn(session, missing)
+            for key in missing:
+                value = found.get(key, [])
+                self._cache.put((name, key), tuple(value))
+                results[key] = list(value)
+        return results
+
     def _cache_pages(self) -> List[str]:
         with self._session_scope as session:
             rows = session.query(Fact.page).distinct().all()
@@ -165,168 +268,187 @@ class CuriosityStore:
         return random.choice(self._pages)
 
     def random_sections(self, page_entity: str, n: int) -> List[str]:
-        with self._session_scope as session:
-            rows = (
-                session.query(Fact)
-                .filter_by(page=page_entity)
-                .filter(Fact.section_title != "Body")
-                .group_by(Fact.section_title)
+        section_names = [s for s in self.get_sections(page_entity) if s != "Body"]
+        if n > len(section_names):
+            raise ValueError(f"Not enough sections: {len(section_names)} vs {n}")
+        return random.sample(section_names, n)
+
+    @staticmethod
+    def _query_links(session, pages: List[str]) -> Dict[str, List[EntityLink]]:
+        # mention has no index on fact_id, so mentions are found with one scan
+        # by their copy of the page and matched to facts here
+        links = defaultdict(list)
+        for chunk in chunks(pages):
+            facts = (
+                session.query(*FACT_COLUMNS)
+                .filter(Fact.page.in_(chunk))
+                .order_by(Fact.id)
                 .all()
             )
-            section_names = [r.section_title for r in rows]
-            if n > len(section_names):
-                raise ValueError(f"Not enough sections: {len(section_names)} vs {n}")
-            return random.sample(section_names, n)
+            fact_mentions = defaultdict(list)
+            rows = (
+                session.query(*MENTION_COLUMNS)
+                .filter(Mention.page.in_(chunk))
+                .order_by(Mention.id)
+            )
+            for mention in rows:
+                fact_mentions[mention.fact_id].append(mention)
+            for fact in facts:
+                for m in fact_mentions[fact.id]:
+                    links[fact.page].append(to_link(fact, m))
+        return links
+
+    def get_links_batch(
+        self, page_entities: Iterable[str]
+    ) -> Dict[str, List[EntityLink]]:
+        """
+        For each page_entity, return all entity links on the page
+        """
+        return self._cached_batch("links", page_entities, self._query_links)
 
     def get_links(self, page_entity: str) -> List[EntityLink]:
         """
         For the given page_entity, return all entity links on the page
         """
-        with self._session_scope as session:
-            rows = (
-                session.query(Fact)
-                .filter_by(page=page_entity)
-                .options(selectinload(Fact.mentions))
-            )
-            links = []
-            for fact in rows:
-                for mention in fact.mentions:
-                    links.append(
-                        EntityLink(
-                            fact.page,
-                            mention.title,
-                            fact.section_title,
-                            mention.pageviews,
-                            fact.text,
-                            mention.is_location,
-                            fact.id,
-                            mention.id,
-                        )
-                    )
-            return links
+        return self.get_links_batch([page_entity])[page_entity]
+
+    def get_facts_batch(
+        self, pairs: Iterable[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], List[EntityLink]]:
+        """
+        For each (page_entity, known_entity) pair, find all facts on the
+        page that mention known_entity
+        """
+
+        def query(session, keys):
+            found = defaultdict(dict)
+            # A page and a title parameter per pair
+            for chunk in chunks(keys, MAX_QUERY_PARAMS // 2):
+                wanted = set(chunk)
+                rows = (
+                    session.query(*MENTION_COLUMNS)
+                    .filter(Mention.page.in_({page for page, _ in chunk}))
+                    .filter(Mention.title.in_({known for _, known in chunk}))
+                    .order_by(Mention.id)
+                )
+                for m in rows:
+                    key = (m.page, m.title)
+                    # One link per fact, from its first mention of known_entity
+                    if key in wanted and m.fact_id not in found[key]:
+                        found[key][m.fact_id] = m
+            fact_ids = sorted({i for mentions in found.values() for i in mentions})
+            facts = {}
+            for chunk in chunks(fact_ids):
+                rows = session.query(*FACT_COLUMNS).filter(Fact.id.in_(chunk))
+                facts.update((f.id, f) for f in rows)
+            return {
+                key: [
+                    to_link(facts[i], m, clean=True)
+                    for i, m in sorted(mentions.items())
+                ]
+                for key, mentions in found.items()
+            }
+
+        return self._cached_batch("facts", pairs, query)
 
     def get_facts(self, page_entity: str, known_entity: str) -> List[EntityLink]:
         """
         Find all facts on focus_entity's page that match known_entity
         """
-        with self._session_scope as session:
-            rows = (
-                session.query(Mention)
-                .filter(Mention.page == page_entity)
-                .filter(Mention.title == known_entity)
-                .group_by(Mention.fact_id)
-                .all()
-            )
-            return [
-                EntityLink(
-                    m.fact.page,
-                    m.title,
-                    m.fact.section_title,
-                    m.pageviews,
-                    clean_text(m.fact.text),
-                    m.is_location,
-                    m.fact_id,
-                    m.id,
+        key = (page_entity, known_entity)
+        return self.get_facts_batch([key])[key]
+
+    def get_sections_batch(self, page_entities: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Get all the valid sections for each page
+        """
+
+        def query(session, pages):
+            sections = defaultdict(list)
+            for chunk in chunks(pages):
+                rows = (
+                    session.query(Fact.page, Fact.section_title)
+                    .filter(Fact.page.in_(chunk))
+                    .group_by(Fact.page, Fact.section_title)
                 )
-                for m in rows
-            ]
+                for page, section_title in rows:
+                    sections[page].append(section_title)
+            return sections
+
+        return self._cached_batch("sections", page_entities, query)
 
     def get_sections(self, page_entity: str) -> List[str]:
         """
         Get all the valid sections for this page
         """
-        with self._session_scope as session:
-            rows = (
-                session.query(Fact)
-                .filter_by(page=page_entity)
-                .group_by(Fact.section_title)
-                .options(Load(Fact).load_only("page", "section_title"))
-                .all()
-            )
-            return [r.section_title for r in rows]
+        return self.get_sections_batch([page_entity])[page_entity]
+
+    def get_page_facts_batch(
+        self, page_entities: Iterable[str]
+    ) -> Dict[str, List[EntityLink]]:
+        """
+        For each page_entity, return unique facts, each with its first mention
+        """
+
+        def query(session, pages):
+            page_facts = defaultdict(list)
+            for page, links in self._query_links(session, pages).items():
+                seen = set()
+                for link in links:
+                    if link.fact_id not in seen:
+                        seen.add(link.fact_id)
+                        page_facts[page].append(link)
+            return page_facts
+
+        return self._cached_batch("page_facts", page_entities, query)
 
     def get_page_facts(self, page_entity: str) -> List[EntityLink]:
         """
         For the given page_entity, return unique facts
         """
-        with self._session_scope as session:
-            rows = (
-                session.query(Fact)
-                .filter_by(page=page_entity)
-                .options(selectinload(Fact.mentions))
-            )
-            links = []
-            for fact in rows:
-                links.append(
-                    EntityLink(
-                        fact.page,
-                        fact.mentions[0].title,
-                        fact.section_title,
-                        fact.mentions[0].pageviews,
-                        fact.text,
-                        fact.mentions[0].is_location,
-                        fact.id,
-                        fact.mentions[0].id,
-                    )
-                )
-            return links
+        return self.get_page_facts_batch([page_entity])[page_entity]
 
     def get_section_facts(self, page_entity: str, section: str) -> List[EntityLink]:
+        # Use first mention for now, its not too important, but could be
+        # improved to random later
+        return [
+            link._replace(context=clean_text(link.context))
+            for link in self.get_page_facts(page_entity)
+            if link.section_title == section
+        ]
+
+    def get_entity_summaries(self, page_entities: Iterable[str]) -> Dict[str, str]:
+        """
+        Summary of each page_entity that has one
+        """
+        summaries = {}
         with self._session_scope as session:
-            rows = (
-                session.query(Fact)
-                .filter_by(page=page_entity, section_title=section)
-                .options(selectinload(Fact.mentions))
-                .all()
-            )
-            return [
-                # Use first mention for now, its not too important, but could be
-                # improved to random later
-                EntityLink(
-                    f.page,
-                    f.mentions[0].title,
-                    f.section_title,
-                    f.mentions[0].pageviews,
-                    clean_text(f.text),
-                    f.mentions[0].is_location,
-                    f.id,
-                    f.mentions[0].id,
+            for chunk in chunks(list(dict.fromkeys(page_entities))):
+                rows = (
+                    session.query(WikiSummary.title, WikiSummary.text)
+                    .filter(WikiSummary.title.in_(chunk))
+                    .order_by(WikiSummary.id)
                 )
-                for f in rows
-            ]
+                for title, summary in rows:
+                    summaries.setdefault(title, summary.strip())
+        return summaries
 
     def get_entity_summary(self, page_entity: str) -> str:
-        with self._session_scope as session:
-            return (
-                session.query(WikiSummary)
-                .filter_by(title=page_entity)
-                .first()
-                .text.strip()
-            )
+        return self.get_entity_summaries([page_entity])[page_entity]
 
     def get_fact_sections(self):
         with self._session_scope as session:
             rows = session.query(Fact).all()
             return {f.id: f.section_title for f in rows}
 
-    def prominence_curriculum(self) -> Dict[str, Curriculum]:
+    def prominence_curriculum(self, path: Optional[str] = None) -> CurriculumTable:
         """
-        For each page, return a curriculum.
+        For each page, return a curriculum: a dict of the page's views and
+        the set of entities its facts mention, which iterates most viewed
+        first. They are materialized at path, next to the wiki database by
+        default, when missing or stale and read from there on demand.
         """
-        with self._session_scope as session:
-            page_mentions = (
-                session.query(Fact)
-                .options(
-                    selectinload(Fact.mentions),
-                    Load(Fact).load_only("page", "pageviews"),
-                    Load(Mention).load_only("pageviews", "title"),
-                )
-                .all()
-            )
-            curr = defaultdict(lambda: {"views": 0, "entities": set()})
-            for fact in page_mentions:
-                curr[fact.page]["views"] = fact.pageviews
-                current_mentions = curr[fact.page]["entities"]
-                for m in fact.mentions:
-                    current_mentions.add((m.title, m.pageviews))
-            return curr
+        if path is None:
+            path = prominence_path(self._sql_path)
+        ensure_prominence(self._sql_path, path)
+        return CurriculumTable(path)
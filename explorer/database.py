@@ -1,12 +1,15 @@
-from typing import List
+from typing import Callable, Dict, Optional
+import asyncio
+import contextvars
+import functools
 import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
-import pandas as pd
-from tqdm import tqdm
-
 from pedroai.math import to_precision
-from pedroai.io import read_json
 
 from sqlalchemy import (
     Column,
@@ -16,20 +19,33 @@ from sqlalchemy import (
     String,
     Boolean,
     DateTime,
-    create_engine,
+    Index,
+    LargeBinary,
 )
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, scoped_session
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import (
+    Session,
+    sessionmaker,
+    relationship,
+    scoped_session,
+    object_session,
+)
 
+from explorer import paths
+from explorer.diagnostics import instrument_engine
 from explorer.log import get_logger
-from explorer.curiosity.data import CuriosityDialog
+from explorer.sqlite_profile import BUILD, SERVE, SqliteProfile, create_sqlite_engine
+
+
+def create_db_engine(path: str, profile: SqliteProfile = BUILD) -> Engine:
+    return create_sqlite_engine(path, profile)
 
 
 Base = declarative_base()
-engine = create_engine(
-    "sqlite:///data/qanta_viewer.sqlite3", connect_args={"check_same_thread": False}
-)
+# The web tier only reads, builds write to a shadow file with their own engine
+engine = create_db_engine(paths.QANTA_DB, SERVE)
+instrument_engine(engine)
 SessionLocal = scoped_session(
     sessionmaker(bind=engine, autoflush=False, autocommit=False)
 )
@@ -37,17 +53,141 @@ SessionLocal = scoped_session(
 
 log = get_logger(__name__)
 
+# Bump whenever the tables change so incremental builds start from scratch
+SCHEMA_VERSION = 10
+# Number of buzzes annotated and plays listed on question pages
+BUZZ_BADGES = 5
+FIRST_PLAYS = 15
+# Question columns that questions can be browsed and counted by
+QUESTION_FACETS = [
+    "fold",
+    "category",
+    "subcategory",
+    "tournament",
+    "difficulty",
+    "year",
+    "dataset",
+]
+# Facets with few values, whose combinations question_facet_count counts.
+# Tournaments and years have so many values that combinations including
+# them are about one per question.
+COMBINED_FACETS = ["fold", "category", "subcategory", "difficulty", "dataset"]
+# Facets whose values are not strings, to read them back from text columns
+FACET_TYPES = {"year": int}
+# Threads that run queries for async routes, bounding concurrent queries
+DB_THREADS = int(os.environ.get("EXPLORER_DB_THREADS", "8"))
+
+_db_inode: Optional[int] = None
+_build_id: Optional[str] = None
+
+
+def refresh_engine():
+    """
+    Rebuilds atomically replace the database file, but pooled connections
+    keep reading the file they opened, which is what lets them open it
+    immutable. Dispose of them once the file changes.
+    """
+    global _db_inode, _build_id  # pylint: disable=global-statement
+    try:
+        inode = os.stat(paths.QANTA_DB).st_ino
+    except FileNotFoundError:
+        return
+    if _db_inode is not None and inode != _db_inode:
+        log.info("Database file was replaced, reconnecting")
+        engine.dispose()
+        _build_id = None
+    _db_inode = inode
+
+
+def get_build_id() -> str:
+    """
+    Id stamped by the build that produced the database being served, which
+    changes whenever a rebuild is swapped in
+    """
+    global _build_id  # pylint: disable=global-statement
+    refresh_engine()
+    if _build_id is None:
+        _build_id = get_build_info(engine).get("build_id", "")
+    return _build_id
+
+
+class BuildCache:
+    """
+    In memory cache that is emptied whenever a new database build is swapped
+    in. With max_size, it keeps only the max_size most recently used values.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size
+        self._build_id = None
+        self._values: "OrderedDict" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, compute: Callable):
+        build_id = get_build_id()
+        with self._lock:
+            if build_id != self._build_id:
+                self._values = OrderedDict()
+                self._build_id = build_id
+            if key in self._values:
+                self._values.move_to_end(key)
+                return self._values[key]
+        # Computed outside the lock so slow queries do not block other keys
+        value = compute()
+        with self._lock:
+            if self._build_id == build_id:
+                self._values[key] = value
+                if self.max_size is not None and len(self._values) > self.max_size:
+                    self._values.popitem(last=False)
+        return value
+
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+
+async def run_in_db_thread(fn: Callable, *args, **kwargs):
+    """
+    Call fn in the database thread pool, so blocking database work does not
+    hold up the event loop
+    """
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context so context variables carry over
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, fn, *args, **kwargs)
+    return await loop.run_in_executor(_db_executor, call)
+
+
+class AsyncDB:
+    """
+    Database handle for async routes. SQLAlchemy and sqlite3 block, so
+    session work is passed to run, which calls it with the session in the
+    database thread pool while the event loop serves other requests.
+    """
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        return await run_in_db_thread(fn, self.session, *args, **kwargs)
+
+    async def close(self):
+        await self.run(Session.close)
+
 
-def get_db():
+async def get_db():
+    refresh_engine()
+    # A plain session rather than the thread local one, since calls for one
+    # request may run on different pool threads
+    db = AsyncDB(SessionLocal.session_factory())
     try:
-        db = SessionLocal()
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 @contextmanager
 def get_db_context() -> SessionLocal:
+    refresh_engine()
     session = SessionLocal()
     yield session
     session.close()
@@ -55,6 +195,15 @@ def get_db_context() -> SessionLocal:
 
 class Question(Base):
     __tablename__ = "questions"
+    # Filter on a facet and page through matches in id order
+    __table_args__ = (
+        Index("ix_questions_fold_qanta_id", "fold", "qanta_id"),
+        Index("ix_questions_category_qanta_id", "category", "subcategory", "qanta_id"),
+        Index("ix_questions_difficulty_qanta_id", "difficulty", "qanta_id"),
+        Index("ix_questions_tournament_qanta_id", "tournament", "qanta_id"),
+        Index("ix_questions_year_qanta_id", "year", "qanta_id"),
+        Index("ix_questions_dataset_qanta_id", "dataset", "qanta_id"),
+    )
     qanta_id = Column(Integer, primary_key=True)
     text = Column(String)
     first_sentence = Column(String)
@@ -71,6 +220,10 @@ class Question(Base):
     proto_id = Column(Integer)
     qdb_id = Column(Integer)
     dataset = Column(String)
+    # Precomputed at build time from play events by precompute_question_plays
+    buzz_html = Column(String)
+    first_plays = Column(String)
+    n_plays = Column(Integer)
     plays = relationship("PlayEvent")
 
     def to_dict(self, include_buzzes=False, max_buzzes=5):
@@ -95,40 +248,76 @@ class Question(Base):
             else None,
         }
 
-    def text_with_buzzes(self, max_buzzes: int = 5):
-        filtered_events = []
-        seen_players = set()
-        for event in self.plays:
-            if event.user_id in seen_players:
-                continue
-            filtered_events.append(event)
-            seen_players.add(event.user_id)
-
-        tokens = self.text.split()
-        n_tokens = len(tokens)
-        modified_tokens = []
-        buzzed_players = set()
-        for idx, tok in enumerate(tokens):
-            for event in filtered_events:
-                if event.user_id in buzzed_players or len(buzzed_players) >= max_buzzes:
-                    continue
-
-                if idx / n_tokens > event.buzzing_position:
-                    buzzed_players.add(event.user_id)
-                    if event.result == "wrong":
-                        modified_tokens.append(
-                            rf'<span class="badge badge-pill badge-danger">{len(buzzed_players)}</span>'
-                        )
-                    elif event.result == "correct":
-                        modified_tokens.append(
-                            rf'<span class="badge badge-pill badge-success">{len(buzzed_players)}</span>'
-                        )
-            modified_tokens.append(tok)
-        return " ".join(modified_tokens)
+    def text_with_buzzes(self, max_buzzes: int = BUZZ_BADGES):
+        if max_buzzes == BUZZ_BADGES and self.buzz_html is not None:
+            return self.buzz_html
+        # pylint: disable=import-outside-toplevel
+        # numpy is only needed when the precomputed html cannot be used
+        from explorer.qanta.buzzes import annotate_buzzes
+
+        plays = (
+            object_session(self)
+            .query(PlayEvent.user_id, PlayEvent.buzzing_position, PlayEvent.result)
+            .filter_by(qanta_id=self.qanta_id)
+            .order_by(PlayEvent.play_id)
+            .all()
+        )
+        return annotate_buzzes(
+            self.text,
+            [p.user_id for p in plays],
+            [p.buzzing_position for p in plays],
+            [p.result for p in plays],
+            max_buzzes=max_buzzes,
+        )
+
+
+class QuestionFacetCount(Base):
+    """
+    Number of questions with each combination of COMBINED_FACETS values,
+    built by populate. Counts filtered on several of those facets sum over
+    this table instead of grouping questions.
+    """
+
+    __tablename__ = "question_facet_count"
+    id = Column(Integer, primary_key=True)
+    fold = Column(String)
+    category = Column(String)
+    subcategory = Column(String)
+    difficulty = Column(String)
+    dataset = Column(String)
+    n_questions = Column(Integer)
+
+
+class QuestionFacetPair(Base):
+    """
+    Number of questions with value for facet among those with given_value
+    for given_facet, so counts filtered on a single facet are a lookup.
+    Rows where given_facet is facet hold the unfiltered count of each value.
+    Values are stored as text, see FACET_TYPES.
+    """
+
+    __tablename__ = "question_facet_pair"
+    __table_args__ = (
+        Index("ix_question_facet_pair_facet", "given_facet", "facet", "given_value"),
+    )
+    id = Column(Integer, primary_key=True)
+    given_facet = Column(String)
+    given_value = Column(String)
+    facet = Column(String)
+    value = Column(String)
+    n_questions = Column(Integer)
 
 
 class PlayEvent(Base):
     __tablename__ = "play_event"
+    # Serves the first non-prompt plays of a question in date order. result
+    # comes last so the order is read from the index and the scan stops at
+    # the limit, rather than sorting every play of the question
+    __table_args__ = (
+        Index(
+            "ix_play_event_qanta_date_result", "qanta_id", "date", "play_id", "result"
+        ),
+    )
     play_id = Column(Integer, primary_key=True)
     qanta_id = Column(Integer, ForeignKey("questions.qanta_id"), index=True)
     user_id = Column(String)
@@ -139,19 +328,25 @@ class PlayEvent(Base):
     question = relationship("Question", back_populates="plays")
 
     def to_dict(self):
-        return {
-            "user_id": self.user_id,
-            "buzzing_position": self.buzzing_position,
-            "buzzing_position_str": to_precision(self.buzzing_position, 3),
-            "guess": self.guess,
-            "result": self.result,
-            "date": self.date,
-        }
+        return play_event_dict(self)
+
+
+def play_event_dict(event) -> Dict:
+    return {
+        "user_id": event.user_id,
+        "buzzing_position": event.buzzing_position,
+        "buzzing_position_str": to_precision(event.buzzing_position, 3),
+        "guess": event.guess,
+        "result": event.result,
+        "date": event.date,
+    }
 
 
 class CuriosityDbDialog(Base):
     """
-    The full dialog data is stored in `data`.
+    The full dialog data is stored in `data`, or zstd compressed in
+    `data_zstd` when populate is run with a compression level, see
+    explorer.compression.
     Other fields are primarily for convenience for use
     in DB queries.
     """
@@ -160,124 +355,51 @@ class CuriosityDbDialog(Base):
     dialog_id = Column(Integer, primary_key=True)
     user_id = Column(Integer)
     assistant_id = Column(Integer)
-    topic = Column(String)
+    topic = Column(String, index=True)
     aspect_1 = Column(String)
     aspect_2 = Column(String)
     data = Column(String)
+    data_zstd = Column(LargeBinary)
+    # Of the plain JSON, so builds can compare dialogs however they are stored
+    data_sha256 = Column(String)
 
     @property
     def url(self):
         return f"https://datasets.pedro.ai/curiosity/dialog/{self.dialog_id}"
 
 
-def build_db():
-    # pylint: disable=bare-except
-    log.info("Dropping and Creating DB")
-    try:
-        Base.metadata.drop_all(bind=engine)
-    except:
-        pass
-    Base.metadata.create_all(bind=engine)
-    build_qanta()
-    build_curiosity()
+class DialogDictionary(Base):
+    """
+    zstd dictionary that compressed dialogs were compressed with
+    """
 
+    __tablename__ = "dialog_dictionary"
+    id = Column(Integer, primary_key=True)
+    dictionary = Column(LargeBinary)
+    level = Column(Integer)
 
-def load_curiosity() -> List[CuriosityDialog]:
-    dialogs: List[CuriosityDialog] = []
-    for fold in ["train", "val", "test", "test_zero"]:
-        for d in read_json(f"data/curiosity/curiosity_dialogs.{fold}.json")["dialogs"]:
-            dialogs.append((fold, CuriosityDialog(**d)))
-    return dialogs
 
+class SourceFile(Base):
+    """
+    Fingerprint of a source file as of the last build that read it
+    """
 
-def build_curiosity():
-    log.info("Dropping Prior viersion")
-    try:
-        Base.metadata.tables["curiosity_dialog"].drop(bind=engine)
-    except OperationalError:
-        pass
-    Base.metadata.tables["curiosity_dialog"].create(bind=engine)
-    log.info("Loading curiosity dialogs")
-    dialogs = load_curiosity()
-
-    with get_db_context() as db:
-        log.info("Writing dialogs")
-        for _, d in tqdm(dialogs):
-            db.add(
-                CuriosityDbDialog(
-                    dialog_id=d.dialog_id,
-                    user_id=d.user_id,
-                    assistant_id=d.assistant_id,
-                    topic=d.focus_entity,
-                    aspect_1=d.first_aspect,
-                    aspect_2=d.second_aspect,
-                    data=d.json(),
-                )
-            )
-        log.info("Committing dialogs")
-        db.commit()
-
-
-def build_qanta():
-    log.info("Loading data")
-    with open("data/qanta.mapped.2018.04.18.json") as f:
-        questions = json.load(f)["questions"]
-
-    df = pd.read_hdf("data/protobowl-042818.log.h5")
-    proto_id_to_qanta = {}
-
-    with get_db_context() as db:
-        log.info("Writing questions")
-        for q in tqdm(questions):
-            if q["proto_id"] is not None:
-                proto_id_to_qanta[q["proto_id"]] = q["qanta_id"]
-            db.add(
-                Question(
-                    qanta_id=q["qanta_id"],
-                    text=q["text"],
-                    first_sentence=q["first_sentence"],
-                    tokenizations=json.dumps(q["tokenizations"]),
-                    answer=q["answer"],
-                    page=q["page"],
-                    fold=q["fold"],
-                    gameplay=q["gameplay"],
-                    category=q["category"],
-                    subcategory=q["subcategory"],
-                    tournament=q["tournament"],
-                    difficulty=q["difficulty"],
-                    year=q["year"],
-                    proto_id=q["proto_id"],
-                    qdb_id=q["qdb_id"],
-                    dataset=q["dataset"],
-                )
-            )
-        db.commit()
-
-        log.info("Writing play events")
-        n = 0
-        for event in tqdm(df.itertuples()):
-            if event.qid not in proto_id_to_qanta:
-                continue
-
-            if event.result is True:
-                result = "correct"
-            elif event.result is False:
-                result = "wrong"
-            elif event.result == "prompt":
-                result = "prompt"
-            else:
-                raise ValueError(f"Unexpected result: {event.result}")
-
-            db.add(
-                PlayEvent(
-                    qanta_id=proto_id_to_qanta[event.qid],
-                    buzzing_position=event.buzzing_position,
-                    user_id=event.uid,
-                    date=event.date,
-                    guess=event.guess,
-                    result=result,
-                )
-            )
-            n += 1
-        log.info("Found %s matching records", n)
-        db.commit()
+    __tablename__ = "source_file"
+    path = Column(String, primary_key=True)
+    size = Column(Integer)
+    mtime = Column(Float)
+    sha256 = Column(String)
+
+
+class BuildInfo(Base):
+    __tablename__ = "build_info"
+    key = Column(String, primary_key=True)
+    value = Column(String)
+
+
+def get_build_info(db_engine: Engine) -> Dict[str, str]:
+    table = Base.metadata.tables["build_info"]
+    with db_engine.connect() as conn:
+        if not db_engine.dialect.has_table(conn, table.name):
+            return {}
+        return {r.key: r.value for r in conn.execute(table.select())}
@@ -0,0 +1,167 @@
+"""
+Opt-in query diagnostics for finding missing indexes and N+1 query patterns
+during development, enabled with EXPLORER_DIAGNOSTICS=1. On the engines it
+instruments it:
+- logs queries slower than EXPLORER_SLOW_QUERY_MS with their query plan
+- runs EXPLAIN QUERY PLAN once for each new statement shape and warns when
+  it scans a whole table, which small development data would not make slow
+- warns when one request runs the same statement shape more than
+  EXPLORER_REPEATED_QUERIES times
+"""
+from typing import List, Optional, Set
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from explorer.log import get_logger
+from explorer.metrics import current_request
+
+
+log = get_logger(__name__)
+
+ENABLED = os.environ.get("EXPLORER_DIAGNOSTICS", "") not in ("", "0")
+SLOW_QUERY_MS = float(os.environ.get("EXPLORER_SLOW_QUERY_MS", "100"))
+REPEATED_QUERIES = int(os.environ.get("EXPLORER_REPEATED_QUERIES", "20"))
+MAX_LOGGED_CHARS = 500
+# Statements that have a query plan, others like PRAGMA or DDL are not explained
+EXPLAINED = re.compile(r"^\s*(SELECT|WITH|UPDATE|DELETE|INSERT)\b", re.IGNORECASE)
+# A plan step reading every row of a table, rather than searching an index.
+# SQLite before 3.36 writes SCAN TABLE t.
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)$")
+
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMETER_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    """
+    The statement with literals and parameter lists of any length replaced,
+    so queries differing only in their values share a shape
+    """
+    shape = _STRINGS.sub("?", statement)
+    shape = _NUMBERS.sub("?", shape)
+    shape = _PARAMETER_LISTS.sub("(?...)", shape)
+    return _SPACES.sub(" ", shape).strip()
+
+
+def truncate(statement: str) -> str:
+    if len(statement) <= MAX_LOGGED_CHARS:
+        return statement
+    return statement[:MAX_LOGGED_CHARS] + "..."
+
+
+def explain(dbapi_connection, statement: str, parameters) -> List[str]:
+    """
+    Steps of the SQLite query plan for statement, empty if it cannot be
+    explained
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        rows = cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[3] for row in rows]
+    except Exception:  # pylint: disable=broad-except
+        return []
+    finally:
+        cursor.close()
+
+
+def full_scans(plan: List[str]) -> List[str]:
+    return [m.group(1) for m in map(FULL_SCAN.match, plan) if m is not None]
+
+
+def format_plan(plan: List[str]) -> str:
+    return "\n".join(f"    {step}" for step in plan)
+
+
+class QueryDiagnostics:
+    """
+    Engine event listeners that time, explain and count queries
+    """
+
+    def __init__(
+        self,
+        slow_query_ms: float = SLOW_QUERY_MS,
+        repeated_queries: int = REPEATED_QUERIES,
+    ) -> None:
+        self.slow_query_ms = slow_query_ms
+        self.repeated_queries = repeated_queries
+        self._explained: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def instrument(self, db_engine: Engine):
+        event.listen(db_engine, "before_cursor_execute", self.before_execute)
+        event.listen(db_engine, "after_cursor_execute", self.after_execute)
+
+    def before_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):  # pylint: disable=unused-argument
+        conn.info.setdefault("diagnostics_start", []).append(time.perf_counter())
+
+    def after_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):  # pylint: disable=unused-argument
+        elapsed_ms = (time.perf_counter() - conn.info["diagnostics_start"].pop()) * 1000
+        shape = statement_shape(statement)
+        explainable = not executemany and EXPLAINED.match(statement) is not None
+        plan: Optional[List[str]] = None
+        if explainable and self._first_time(shape):
+            plan = explain(conn.connection, statement, parameters)
+            scans = full_scans(plan)
+            if len(scans) != 0:
+                log.warning(
+                    "Full table scan of %s in %s\n%s",
+                    ", ".join(scans),
+                    truncate(shape),
+                    format_plan(plan),
+                )
+        if elapsed_ms >= self.slow_query_ms:
+            if plan is None and explainable:
+                plan = explain(conn.connection, statement, parameters)
+            log.warning(
+                "Slow query took %.1fms: %s\n%s",
+                elapsed_ms,
+                truncate(shape),
+                format_plan(plan or []),
+            )
+        self._count(shape)
+
+    def _first_time(self, shape: str) -> bool:
+        with self._lock:
+            if shape in self._explained:
+                return False
+            self._explained.add(shape)
+            return True
+
+    def _count(self, shape: str):
+        stats = current_request()
+        if stats is None:
+            return
+        if stats.statements is None:
+            stats.statements = {}
+        count = stats.statements.get(shape, 0) + 1
+        stats.statements[shape] = count
+        # Once per request and shape, when the count first passes the limit
+        if count == self.repeated_queries + 1:
+            log.warning(
+                "Request ran the same statement more than %s times, "
+                "likely an N+1 query: %s",
+                self.repeated_queries,
+                truncate(shape),
+            )
+
+
+DIAGNOSTICS = QueryDiagnostics()
+
+
+def instrument_engine(db_engine: Engine):
+    """
+    Attach the diagnostics to db_engine when EXPLORER_DIAGNOSTICS is set
+    """
+    if ENABLED:
+        DIAGNOSTICS.instrument(db_engine)
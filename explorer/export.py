@@ -0,0 +1,320 @@
+"""
+Stream questions and dialogs out of the database as NDJSON or Parquet. Rows
+are read in batches from one cursor and encoded a batch at a time, so an
+export of the whole dataset uses bounded memory and its first bytes are
+ready as soon as the first batch is read. Parquet needs the optional
+pyarrow package.
+"""
+from typing import Dict, Iterator, List, Optional
+import datetime
+import json
+import os
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+
+from explorer.compression import dialog_json, read_decoder
+from explorer.database import QUESTION_FACETS, Base
+
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+# Rows read per fetch, also the most ids in one query for plays
+BATCH_SIZE = 500
+ROW_GROUP_SIZE = 5_000
+QUESTION_COLUMNS = [
+    "qanta_id",
+    "text",
+    "first_sentence",
+    "tokenizations",
+    "answer",
+    "page",
+    "gameplay",
+    "proto_id",
+    "qdb_id",
+] + QUESTION_FACETS
+PLAY_COLUMNS = ["play_id", "user_id", "buzzing_position", "guess", "result", "date"]
+DIALOG_COLUMNS = [
+    "dialog_id",
+    "user_id",
+    "assistant_id",
+    "topic",
+    "aspect_1",
+    "aspect_2",
+    "data",
+    "data_zstd",
+]
+
+
+def iter_batches(conn, query) -> Iterator[List]:
+    result = conn.execution_options(stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(BATCH_SIZE)
+        if len(rows) == 0:
+            break
+        yield rows
+
+
+def attach_plays(conn, questions: List[Dict]):
+    plays = Base.metadata.tables["play_event"]
+    by_id = {}
+    for q in questions:
+        q["plays"] = []
+        by_id[q["qanta_id"]] = q
+    query = (
+        select([plays.c.qanta_id] + [plays.c[c] for c in PLAY_COLUMNS])
+        .where(plays.c.qanta_id.in_(list(by_id)))
+        .order_by(plays.c.qanta_id, plays.c.play_id)
+    )
+    for row in conn.execute(query):
+        by_id[row.qanta_id]["plays"].append({c: row[c] for c in PLAY_COLUMNS})
+
+
+def iter_question_batches(
+    conn, filters: Dict[str, List], plays: bool = False
+) -> Iterator[List[Dict]]:
+    """
+    Questions in id order matching every filter, a facet and its allowed
+    values, optionally with their play events
+    """
+    questions = Base.metadata.tables["questions"]
+    query = select([questions.c[c] for c in QUESTION_COLUMNS]).order_by(
+        questions.c.qanta_id
+    )
+    for facet, values in filters.items():
+        query = query.where(questions.c[facet].in_(values))
+    for rows in iter_batches(conn, query):
+        batch = []
+        for row in rows:
+            q = dict(row)
+            q["tokenizations"] = json.loads(q["tokenizations"])
+            batch.append(q)
+        if plays:
+            attach_plays(conn, batch)
+        yield batch
+
+
+def iter_dialog_batches(conn, topic: Optional[str] = None) -> Iterator[List[Dict]]:
+    dialogs = Base.metadata.tables["curiosity_dialog"]
+    query = select([dialogs.c[c] for c in DIALOG_COLUMNS]).order_by(dialogs.c.dialog_id)
+    if topic is not None:
+        query = query.where(dialogs.c.topic == topic)
+    decoder = read_decoder(conn)
+    for rows in iter_batches(conn, query):
+        batch = []
+        for row in rows:
+            dialog = dict(row)
+            dialog["data"] = dialog_json(
+                decoder, dialog["data"], dialog.pop("data_zstd")
+            )
+            batch.append(dialog)
+        yield batch
+
+
+def to_json(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot export {type(value)} to JSON")
+
+
+def encode_ndjson(batches: Iterator[List[Dict]]) -> Iterator[bytes]:
+    for batch in batches:
+        yield "".join(json.dumps(r, default=to_json) + "\n" for r in batch).encode()
+
+
+def encode_dialog_ndjson(batches: Iterator[List[Dict]]) -> Iterator[bytes]:
+    # The stored data is the dialog's JSON already, so it is not parsed again
+    for batch in batches:
+        yield "".join(d["data"] + "\n" for d in batch).encode()
+
+
+class ChunkSink:
+    """
+    File-like object for pyarrow that keeps written bytes until drained
+    """
+
+    closed = False
+
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def question_schema(plays: bool):
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+
+    types = {
+        "qanta_id": pa.int64(),
+        "tokenizations": pa.list_(pa.list_(pa.int64())),
+        "gameplay": pa.bool_(),
+        # Protobowl ids are strings despite the column type
+        "proto_id": pa.string(),
+        "qdb_id": pa.int64(),
+        "year": pa.int64(),
+    }
+    fields = [(c, types.get(c, pa.string())) for c in QUESTION_COLUMNS]
+    if plays:
+        play = pa.struct(
+            [
+                ("play_id", pa.int64()),
+                ("user_id", pa.string()),
+                ("buzzing_position", pa.float64()),
+                ("guess", pa.string()),
+                ("result", pa.string()),
+                ("date", pa.timestamp("us")),
+            ]
+        )
+        fields.append(("plays", pa.list_(play)))
+    return pa.schema(fields)
+
+
+def dialog_schema():
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+
+    return pa.schema(
+        [
+            ("dialog_id", pa.int64()),
+            ("user_id", pa.int64()),
+            ("assistant_id", pa.int64()),
+            ("topic", pa.string()),
+            ("aspect_1", pa.string()),
+            ("aspect_2", pa.string()),
+            ("data", pa.string()),
+        ]
+    )
+
+
+def encode_parquet(batches: Iterator[List[Dict]], schema) -> Iterator[bytes]:
+    """
+    Write batches to Parquet in row groups of about ROW_GROUP_SIZE rows,
+    yielding the bytes of each row group once it is written
+    """
+    # pylint: disable=import-outside-toplevel
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    rows = []
+    for batch in batches:
+        rows.extend(batch)
+        if len(rows) >= ROW_GROUP_SIZE:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            rows = []
+            yield sink.drain()
+    if len(rows) != 0:
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+    writer.close()
+    yield sink.drain()
+
+
+def check_format(fmt: str):
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if fmt == "parquet":
+        try:
+            import pyarrow  # pylint: disable=import-outside-toplevel,unused-import
+        except ImportError:
+            raise ValueError("Parquet export needs pyarrow installed") from None
+
+
+def stream(db_engine: Engine, read_batches, encode) -> Iterator[bytes]:
+    with db_engine.connect() as conn:
+        yield from encode(read_batches(conn))
+
+
+def export_questions(
+    db_engine: Engine,
+    fmt: str = "ndjson",
+    filters: Optional[Dict[str, List]] = None,
+    plays: bool = False,
+) -> Iterator[bytes]:
+    """
+    Encoded chunks of the questions matching filters. Raises ValueError
+    for an unknown format before anything is read.
+    """
+    check_format(fmt)
+
+    def read_batches(conn):
+        return iter_question_batches(conn, filters or {}, plays)
+
+    if fmt == "parquet":
+        schema = question_schema(plays)
+        return stream(db_engine, read_batches, lambda b: encode_parquet(b, schema))
+    return stream(db_engine, read_batches, encode_ndjson)
+
+
+def export_dialogs(
+    db_engine: Engine, fmt: str = "ndjson", topic: Optional[str] = None
+) -> Iterator[bytes]:
+    """
+    Encoded chunks of the dialogs, or those of topic. Raises ValueError for
+    an unknown format before anything is read.
+    """
+    check_format(fmt)
+
+    def read_batches(conn):
+        return iter_dialog_batches(conn, topic)
+
+    if fmt == "parquet":
+        schema = dialog_schema()
+        return stream(db_engine, read_batches, lambda b: encode_parquet(b, schema))
+    return stream(db_engine, read_batches, encode_dialog_ndjson)
+
+
+def write_export(chunks: Iterator[bytes], path: str) -> int:
+    """
+    Write chunks to path, replacing it only once the export is complete
+    """
+    size = 0
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size
+
+
+def export_response(make_chunks, fmt: str, name: str) -> StreamingResponse:
+    """
+    Stream the chunks returned by make_chunks() as a download, a bad format
+    is a 400 error
+    """
+    try:
+        chunks = make_chunks()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
+    return StreamingResponse(
+        chunks,
+        media_type=FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={name}.{fmt}"},
+    )
@@ -1,6 +1,10 @@
 from typing import Optional, Dict
+import time
+
 from starlette.templating import Jinja2Templates
 
+from explorer.metrics import TEMPLATE_SECONDS
+
 
 class ConfigurableJinja2Templates(Jinja2Templates):
     def __init__(self, directory: str, jinja_globals: Optional[Dict] = None):
@@ -9,3 +13,12 @@ class ConfigurableJinja2Templates(Jinja2Templates):
         if jinja_globals is not None:
             for k, v in jinja_globals.items():
                 self.env.globals[k] = v
+
+    def TemplateResponse(
+        self, name: str, *args, **kwargs
+    ):  # pylint: disable=invalid-name
+        # Responses render their template when created
+        start = time.perf_counter()
+        response = super().TemplateResponse(name, *args, **kwargs)
+        TEMPLATE_SECONDS.observe(time.perf_counter() - start, name)
+        return response
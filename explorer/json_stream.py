@@ -0,0 +1,113 @@
+import json
+import re
+from typing import Any, Iterator, Optional, TextIO
+
+
+CHUNK_SIZE = 1 << 20
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"\s*")
+
+
+class _JsonReader:
+    """
+    Incremental reader over a JSON text file that keeps only a small
+    window of the file in memory.
+    """
+
+    def __init__(self, f: TextIO, chunk_size: int = CHUNK_SIZE) -> None:
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> None:
+        # Read at least as much as is already pending so values that span
+        # many chunks are decoded in a logarithmic number of attempts
+        size = max(self._chunk_size, len(self._buffer) - self._pos)
+        data = self._f.read(size)
+        if len(data) == 0:
+            self._eof = True
+        self._buffer = self._buffer[self._pos :] + data
+        self._pos = 0
+
+    def peek(self) -> str:
+        """
+        Skip whitespace and return the next character, or "" at the end of the file
+        """
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if self._eof:
+                return ""
+            self._fill()
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found!r}")
+        self._pos += 1
+
+    def decode(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                self._fill()
+                continue
+            # A value ending exactly at the end of the buffer may be a truncated
+            # number or literal, so only accept it once the next chunk is read
+            if end == len(self._buffer) and not self._eof:
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+
+def _iter_array(reader: _JsonReader) -> Iterator[Any]:
+    reader.expect("[")
+    if reader.peek() == "]":
+        return
+    while True:
+        yield reader.decode()
+        if reader.peek() == ",":
+            reader.expect(",")
+        else:
+            reader.expect("]")
+            return
+
+
+def iter_json_array(
+    path: str, key: Optional[str] = None, chunk_size: int = CHUNK_SIZE
+) -> Iterator[Any]:
+    """
+    Yield the elements of a JSON array one at a time without loading the file.
+    If key is given, the file must be an object and the array is its value
+    for key, such as "questions" in the qanta dump or "dialogs" in curiosity.
+    Other top level values are parsed and discarded.
+    """
+    with open(path, encoding="utf-8") as f:
+        reader = _JsonReader(f, chunk_size=chunk_size)
+        if key is None:
+            yield from _iter_array(reader)
+            return
+
+        reader.expect("{")
+        if reader.peek() == "}":
+            raise KeyError(key)
+        while True:
+            current_key = reader.decode()
+            reader.expect(":")
+            if current_key == key:
+                yield from _iter_array(reader)
+                return
+            reader.decode()
+            if reader.peek() == ",":
+                reader.expect(",")
+            else:
+                reader.expect("}")
+                raise KeyError(key)
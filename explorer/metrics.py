@@ -0,0 +1,367 @@
+"""
+Request, database and template metrics exposed at /metrics in the Prometheus
+text format. Recording is a few dictionary updates under a lock, cheap
+enough to leave on. Each uvicorn worker process keeps its own metrics, so
+with several workers a scrape reads whichever worker answers it.
+"""
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import bisect
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.routing import Match, Mount
+
+
+# Starlette appends the charset
+CONTENT_TYPE = "text/plain; version=0.0.4"
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+# Requests that match no route share one label instead of one per path
+UNMATCHED = "unmatched"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+    pairs = ",".join(f'{n}="{escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def header(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        lines = self.header()
+        for labels, value in values:
+            lines.append(
+                f"{self.name}{format_labels(self.labelnames, labels)} "
+                f"{format_value(value)}"
+            )
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = list(buckets)
+        # Per label values, the count in each bucket and above the last, then the sum
+        self._values: Dict[Tuple, List] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1) + [0.0]
+                self._values[labels] = counts
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *labels: str) -> int:
+        counts = self._values.get(labels)
+        return 0 if counts is None else sum(counts[:-1])
+
+    def total(self, *labels: str) -> float:
+        counts = self._values.get(labels)
+        return 0 if counts is None else counts[-1]
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        lines = self.header()
+        names = self.labelnames + ("le",)
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + [math.inf], counts[:-1]):
+                cumulative += count
+                bucket_labels = format_labels(names, labels + (format_value(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+REQUESTS = Counter(
+    "explorer_http_requests_total",
+    "HTTP requests by app, route template, method and status",
+    ["app", "route", "method", "status"],
+)
+REQUEST_SECONDS = Histogram(
+    "explorer_http_request_duration_seconds",
+    "Time to respond to HTTP requests",
+    ["app", "route", "method"],
+)
+IN_FLIGHT = Gauge(
+    "explorer_http_requests_in_flight", "HTTP requests being served", ["app"]
+)
+REQUEST_QUERIES = Histogram(
+    "explorer_http_request_db_queries",
+    "Database queries run for each HTTP request",
+    ["app", "route"],
+    buckets=QUERY_COUNT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    "explorer_http_request_db_seconds",
+    "Time spent in database queries for each HTTP request",
+    ["app", "route"],
+)
+QUERIES = Counter("explorer_db_queries_total", "Database queries run", ["db"])
+QUERY_SECONDS = Counter(
+    "explorer_db_query_seconds_total", "Time spent in database queries", ["db"]
+)
+TEMPLATE_SECONDS = Histogram(
+    "explorer_template_render_seconds", "Time to render templates", ["template"]
+)
+RESPONSE_CACHE = Counter(
+    "explorer_response_cache_requests_total",
+    "Cacheable requests by whether the response cache served them",
+    ["result"],
+)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    """
+    Database work done for the request being served
+    """
+
+    __slots__ = ("queries", "db_seconds", "statements")
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.db_seconds = 0.0
+        # Runs of each statement shape, kept by explorer.diagnostics when enabled
+        self.statements: Optional[Dict[str, int]] = None
+
+
+_request_stats: "contextvars.ContextVar[Optional[RequestStats]]" = (
+    contextvars.ContextVar("request_stats", default=None)
+)
+
+
+def current_request() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+
+@contextmanager
+def request_stats() -> Iterator[RequestStats]:
+    """
+    Stats of the request being served, started here unless an app it is
+    mounted in already did
+    """
+    stats = _request_stats.get()
+    if stats is not None:
+        yield stats
+        return
+    stats = RequestStats()
+    token = _request_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _request_stats.reset(token)
+
+
+def db_label(conn) -> str:
+    return os.path.basename(conn.engine.url.database or "memory")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument
+    seconds = time.perf_counter() - conn.info["query_start"].pop()
+    db = db_label(conn)
+    QUERIES.inc(db)
+    QUERY_SECONDS.inc(db, amount=seconds)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += seconds
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_query(context):
+    starts = context.connection.info.get("query_start") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def route_templates(routes: Iterable, prefix: str = "") -> Dict:
+    """
+    Path template of each endpoint, through mounted apps. A mount's own
+    endpoint gets a catch all template for paths none of its routes match.
+    """
+    templates = {}
+    for route in routes:
+        if isinstance(route, Mount):
+            path = prefix + route.path
+            templates.update(route_templates(getattr(route.app, "routes", []), path))
+            templates.setdefault(route.app, path + "/{path}")
+        elif hasattr(route, "endpoint"):
+            templates.setdefault(route.endpoint, prefix + route.path)
+    return templates
+
+
+def match_endpoint(routes: Iterable, scope) -> Optional[Callable]:
+    """
+    Endpoint the request in scope would be routed to, for requests answered
+    before reaching a router, like response cache hits
+    """
+    for route in routes:
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            if isinstance(route, Mount):
+                nested = match_endpoint(
+                    getattr(route.app, "routes", []), {**scope, **child_scope}
+                )
+                return route.app if nested is None else nested
+            return child_scope.get("endpoint")
+    return None
+
+
+class RequestMetrics:
+    """
+    ASGI middleware recording latency, status, in flight requests and the
+    database queries of each HTTP request, labelled by name and the route
+    template the request matched
+    """
+
+    def __init__(self, app, name: str) -> None:
+        self.app = app
+        self.name = name
+        self._templates: Optional[Dict] = None
+
+    def route_label(self, router, scope) -> str:
+        routes = getattr(router, "routes", [])
+        if self._templates is None:
+            self._templates = route_templates(routes)
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            endpoint = match_endpoint(routes, scope)
+        return self._templates.get(endpoint, UNMATCHED)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Routers of mounted apps replace these as the request goes down
+        router = scope.get("app")
+        with request_stats() as stats:
+            await self._serve(scope, receive, send, router, stats)
+
+    async def _serve(self, scope, receive, send, router, stats: RequestStats):
+        queries = stats.queries
+        db_seconds = stats.db_seconds
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc(self.name)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            seconds = time.perf_counter() - start
+            IN_FLIGHT.dec(self.name)
+            route = self.route_label(router, scope)
+            method = scope["method"]
+            REQUESTS.inc(self.name, route, method, str(status[0]))
+            REQUEST_SECONDS.observe(seconds, self.name, route, method)
+            REQUEST_QUERIES.observe(stats.queries - queries, self.name, route)
+            REQUEST_DB_SECONDS.observe(stats.db_seconds - db_seconds, self.name, route)
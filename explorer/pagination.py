@@ -0,0 +1,20 @@
+"""
+Opaque cursors for keyset pagination, where the next page starts after the
+last key of the current one
+"""
+import base64
+import binascii
+
+from fastapi import HTTPException
+
+
+def encode_cursor(key: int) -> str:
+    return base64.urlsafe_b64encode(str(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor") from None
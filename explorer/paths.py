@@ -0,0 +1,29 @@
+"""
+Locations of the downloaded source data and the databases built from it.
+Everything lives under EXPLORER_DATA_DIR, which defaults to data/
+"""
+import os
+
+
+DATA_DIR = os.environ.get("EXPLORER_DATA_DIR", "data")
+
+QANTA_DB = os.path.join(DATA_DIR, "qanta_viewer.sqlite3")
+QANTA_QUESTIONS = os.path.join(DATA_DIR, "qanta.mapped.2018.04.18.json")
+PROTOBOWL_LOG = os.path.join(DATA_DIR, "protobowl-042818.log.h5")
+
+CURIOSITY_DIR = os.path.join(DATA_DIR, "curiosity")
+CURIOSITY_FOLDS = ["train", "val", "test", "test_zero"]
+WIKI_DB = os.path.join(CURIOSITY_DIR, "wiki_sql.sqlite.db")
+# Generated from WIKI_DB by explorer.curiosity.fact_store
+FACT_STORE = os.path.join(CURIOSITY_DIR, "wiki_facts.bin")
+# Generated from WIKI_DB by explorer.curiosity.prominence
+PROMINENCE_DB = os.path.join(CURIOSITY_DIR, "wiki_prominence.sqlite3")
+
+
+def curiosity_dialogs(fold: str) -> str:
+    return os.path.join(CURIOSITY_DIR, f"curiosity_dialogs.{fold}.json")
+
+
+def sampling_table(name: str) -> str:
+    # Generated from QANTA_DB by explorer.sampling
+    return os.path.join(DATA_DIR, f"{name}_sampling.bin")
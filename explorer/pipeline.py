@@ -0,0 +1,215 @@
+"""
+Parallel database build. Worker processes parse and validate the source
+files into plain row tuples and a single writer process drains them from a
+queue into SQLite, so parsing scales across cores while writes stay serialized.
+"""
+from typing import Dict, List, Optional, Tuple
+import multiprocessing as mp
+import time
+from collections import Counter, defaultdict
+from multiprocessing.pool import AsyncResult
+
+from sqlalchemy.engine import Engine
+
+from explorer import paths
+from explorer.curiosity.data import CuriosityDialog
+from explorer.json_stream import iter_json_array
+from explorer.log import get_logger
+from explorer.search import build_dialog_index, build_question_index
+from explorer.database import Base, create_db_engine
+from explorer.build import (
+    DIALOG_BATCH_SIZE,
+    PLAY_EVENT_BATCH_SIZE,
+    QUESTION_BATCH_SIZE,
+    batched,
+    delete_missing,
+    iter_protobowl_chunks,
+    plan_curiosity,
+    plan_qanta,
+    precompute_facet_counts,
+    precompute_question_plays,
+    read_proto_id_mapping,
+    record_curiosity_sources,
+    record_source,
+    to_dialog_row,
+    to_play_event_rows,
+    to_question_row,
+    upsert_rows,
+)
+
+
+log = get_logger(__name__)
+
+# Each worker may have this many batches waiting on the writer
+QUEUE_BATCHES_PER_WORKER = 4
+# Set in each worker process by the pool initializer
+_queue: Optional[mp.Queue] = None
+
+
+def _init_worker(queue: mp.Queue):
+    global _queue  # pylint: disable=global-statement
+    _queue = queue
+
+
+def _put_rows(table_name: str, rows: List[Dict]):
+    columns = list(rows[0])
+    _queue.put((table_name, columns, [tuple(r[c] for c in columns) for r in rows]))
+
+
+def question_task() -> Dict:
+    """
+    Queue question rows and return the protobowl to qanta id mapping
+    """
+    proto_id_to_qanta = {}
+    questions = iter_json_array(paths.QANTA_QUESTIONS, "questions")
+    for batch in batched(questions, QUESTION_BATCH_SIZE):
+        for q in batch:
+            if q["proto_id"] is not None:
+                proto_id_to_qanta[q["proto_id"]] = q["qanta_id"]
+        _put_rows("questions", [to_question_row(q) for q in batch])
+    return proto_id_to_qanta
+
+
+def dialog_task(fold: str) -> int:
+    """
+    Validate and queue the dialogs of one fold, so each file is parsed once
+    """
+    rows = (
+        to_dialog_row(CuriosityDialog(**d))
+        for d in iter_json_array(paths.curiosity_dialogs(fold), "dialogs")
+    )
+    n = 0
+    for batch in batched(rows, DIALOG_BATCH_SIZE):
+        _put_rows("curiosity_dialog", batch)
+        n += len(batch)
+    return n
+
+
+def play_event_task(proto_id_to_qanta: Dict) -> int:
+    n = 0
+    for chunk in iter_protobowl_chunks(paths.PROTOBOWL_LOG, PLAY_EVENT_BATCH_SIZE):
+        rows = to_play_event_rows(chunk, proto_id_to_qanta)
+        if len(rows) != 0:
+            _put_rows("play_event", rows.to_dict("records"))
+        n += len(rows)
+    return n
+
+
+def _write(db_path: str, queue: mp.Queue):
+    """
+    Drain row batches from the queue into the database until the None
+    sentinel arrives, then delete questions and dialogs that were not seen
+    """
+    db_engine = create_db_engine(db_path)
+    seen = defaultdict(set)
+    n_rows = Counter()
+    n_changed = Counter()
+    start = time.time()
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+        table_name, columns, rows = message
+        table = Base.metadata.tables[table_name]
+        records = [dict(zip(columns, r)) for r in rows]
+        n_rows[table_name] += len(records)
+        if table_name == "play_event":
+            with db_engine.begin() as conn:
+                conn.execute(table.insert(), records)
+            n_changed[table_name] += len(records)
+        else:
+            # The primary key is the first column of question and dialog rows
+            seen[table_name].update(r[0] for r in rows)
+            n_changed[table_name] += upsert_rows(db_engine, table, records)
+
+    for table_name, keys in seen.items():
+        table = Base.metadata.tables[table_name]
+        key = table.primary_key.columns.values()[0].name
+        n_deleted = delete_missing(db_engine, table, key, keys)
+        log.info("%s: %s rows deleted", table_name, n_deleted)
+    elapsed = time.time() - start
+    for table_name, n in n_rows.items():
+        log.info(
+            "%s: %s rows received, %s written or changed (%.0f rows/sec)",
+            table_name,
+            n,
+            n_changed[table_name],
+            n / max(elapsed, 1e-9),
+        )
+    db_engine.dispose()
+
+
+def _wait(result: AsyncResult, writer: mp.Process):
+    """
+    Wait for a task, failing fast if the writer died, since workers would
+    otherwise block forever on the full queue
+    """
+    while not result.ready():
+        if not writer.is_alive():
+            raise RuntimeError("Database writer process failed")
+        result.wait(1)
+    return result.get()
+
+
+def build_parallel(
+    db_engine: Engine,
+    workers: int,
+    incremental: bool = False,
+    qanta: bool = True,
+    curiosity: bool = True,
+):
+    questions_changed, events_changed = (
+        plan_qanta(db_engine, incremental) if qanta else (False, False)
+    )
+    dialogs_changed = plan_curiosity(db_engine, incremental) if curiosity else False
+    if not (questions_changed or events_changed or dialogs_changed):
+        log.info("Sources are unchanged, skipping")
+        return
+
+    log.info("Building with %s workers", workers)
+    queue = mp.Queue(maxsize=QUEUE_BATCHES_PER_WORKER * workers)
+    writer = mp.Process(target=_write, args=(db_engine.url.database, queue))
+    writer.start()
+    try:
+        with mp.Pool(workers, initializer=_init_worker, initargs=(queue,)) as pool:
+            tasks: List[Tuple[str, AsyncResult]] = []
+            if dialogs_changed:
+                for fold in paths.CURIOSITY_FOLDS:
+                    tasks.append(
+                        (f"dialogs {fold}", pool.apply_async(dialog_task, (fold,)))
+                    )
+            if questions_changed:
+                proto_id_to_qanta = _wait(pool.apply_async(question_task), writer)
+            else:
+                proto_id_to_qanta = read_proto_id_mapping(db_engine)
+            if events_changed:
+                tasks.append(
+                    (
+                        "play events",
+                        pool.apply_async(play_event_task, (proto_id_to_qanta,)),
+                    )
+                )
+            for name, result in tasks:
+                log.info("Finished %s: %s rows", name, _wait(result, writer))
+            # Exiting the with block terminates workers, which could lose rows
+            # still buffered in their queue feeder threads
+            pool.close()
+            pool.join()
+        queue.put(None)
+        writer.join()
+        if writer.exitcode != 0:
+            raise RuntimeError("Database writer process failed")
+    finally:
+        if writer.is_alive():
+            writer.terminate()
+
+    if questions_changed:
+        build_question_index(db_engine)
+        precompute_facet_counts(db_engine)
+        record_source(db_engine, paths.QANTA_QUESTIONS)
+    if events_changed:
+        precompute_question_plays(db_engine)
+        record_source(db_engine, paths.PROTOBOWL_LOG)
+    if dialogs_changed:
+        build_dialog_index(db_engine)
+        record_curiosity_sources(db_engine)
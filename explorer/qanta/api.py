@@ -1,58 +1,326 @@
-import random
+from typing import Dict, List, Optional
+import json
 
-from fastapi import FastAPI, Request, Depends
-from fastapi.templating import Jinja2Templates
+from fastapi import FastAPI, Request, Depends, HTTPException, Query
+from sqlalchemy import func
 
-from explorer.database import SessionLocal, Question, get_db
+from explorer.batch import BatchRequest, batch_response, check_batch, fetch_by_ids
+from explorer.database import (
+    AsyncDB,
+    engine,
+    refresh_engine,
+    Question,
+    QuestionFacetCount,
+    QuestionFacetPair,
+    PlayEvent,
+    get_db,
+    FIRST_PLAYS,
+    FACET_TYPES,
+    COMBINED_FACETS,
+    QUESTION_FACETS,
+)
+from explorer.export import export_questions, export_response
+from explorer.jinja import ConfigurableJinja2Templates
+from explorer.metrics import RequestMetrics
+from explorer.pagination import decode_cursor, encode_cursor
+from explorer.sampling import get_sampling_table
+from explorer.search import search_page, search_questions
 
 qanta_app = FastAPI()
-templates = Jinja2Templates(directory="templates")
+qanta_app.add_middleware(RequestMetrics, name="qanta")
+templates = ConfigurableJinja2Templates(directory="templates")
 
-CACHED_QANTA_IDS = []
+# Every result except prompts, as an IN list so both index columns are searched
+SHOWN_PLAY_RESULTS = ["correct", "wrong"]
+MAX_BROWSE_LIMIT = 100
+# Listed for each question when browsing, /api/qanta/v1/{qanta_id} has the rest
+BROWSE_COLUMNS = ["qanta_id", "first_sentence", "answer", "page"] + QUESTION_FACETS
 
 
-def get_all_qanta_ids(db):
-    if len(CACHED_QANTA_IDS) == 0:
-        all_qanta_ids = [r[0] for r in db.query(Question.qanta_id).all()]
-        CACHED_QANTA_IDS.extend(all_qanta_ids)
-    return CACHED_QANTA_IDS
+def random_qanta_id(
+    db,
+    fold: Optional[str] = None,
+    category: Optional[str] = None,
+    difficulty: Optional[str] = None,
+) -> int:
+    qanta_id = get_sampling_table(db, "qanta").choice(
+        {"fold": fold, "category": category, "difficulty": difficulty}
+    )
+    if qanta_id is None:
+        raise HTTPException(status_code=404, detail="No question matches the filters")
+    return qanta_id
+
+
+def get_question_plays(db, qanta_id: int, n: int):
+    """
+    First n non-prompt plays of a question by date, read in order from the
+    (qanta_id, date, play_id, result) index until n are found
+    """
+    return (
+        db.query(PlayEvent)
+        .filter(
+            PlayEvent.qanta_id == qanta_id, PlayEvent.result.in_(SHOWN_PLAY_RESULTS)
+        )
+        .order_by(PlayEvent.date, PlayEvent.play_id)
+        .limit(n)
+        .all()
+    )
+
+
+def count_question_plays(db, question: Question) -> int:
+    if question.n_plays is not None:
+        return question.n_plays
+    return (
+        db.query(PlayEvent)
+        .filter(
+            PlayEvent.qanta_id == question.qanta_id,
+            PlayEvent.result.in_(SHOWN_PLAY_RESULTS),
+        )
+        .count()
+    )
 
 
-def get_html_qanta_question(db, request, qanta_id: int, n: int = 15):
+def get_html_qanta_question(db, request, qanta_id: int, n: int = FIRST_PLAYS):
     question = db.query(Question).filter_by(qanta_id=qanta_id).first()
     question_dict = question.to_dict(include_buzzes=True)
-    records = sorted(
-        [r for r in question.plays if r.result != "prompt"], key=lambda r: r.date
-    )
-    n_records = len(records)
-    sample = [r.to_dict() for r in records[:n]]
+    if n == FIRST_PLAYS and question.first_plays is not None:
+        sample = json.loads(question.first_plays)
+    else:
+        sample = [r.to_dict() for r in get_question_plays(db, qanta_id, n)]
+    n_records = count_question_plays(db, question)
     return templates.TemplateResponse(
         "question.html.jinja2",
         {"request": request, "plays": sample, "n_plays": n_records, **question_dict},
     )
 
 
+def get_question_dict(db, qanta_id: int, plays: int = 0):
+    question = db.query(Question).filter_by(qanta_id=qanta_id).first()
+    question_dict = question.to_dict()
+    if plays > 0:
+        question_dict["plays"] = [
+            r.to_dict() for r in get_question_plays(db, qanta_id, plays)
+        ]
+        question_dict["n_plays"] = count_question_plays(db, question)
+    return question_dict
+
+
+def get_question_batch(db, ids: List[int]):
+    questions = fetch_by_ids(db, Question, Question.qanta_id, ids)
+    return batch_response("questions", ids, questions, Question.to_dict)
+
+
+def facet_clauses(model, filters: Dict[str, List], exclude: Optional[str] = None):
+    return [getattr(model, f).in_(v) for f, v in filters.items() if f != exclude]
+
+
+def count_facet_pairs(db, given: str, facet: str, given_values: Optional[List] = None):
+    n_questions = func.sum(QuestionFacetPair.n_questions)
+    query = db.query(QuestionFacetPair.value, n_questions).filter(
+        QuestionFacetPair.given_facet == given, QuestionFacetPair.facet == facet
+    )
+    if given_values is not None:
+        query = query.filter(
+            QuestionFacetPair.given_value.in_([str(v) for v in given_values])
+        )
+    to_value = FACET_TYPES.get(facet, str)
+    return [
+        (None if value is None else to_value(value), n)
+        for value, n in query.group_by(QuestionFacetPair.value)
+    ]
+
+
+def combined(facets) -> bool:
+    return all(f in COMBINED_FACETS for f in facets)
+
+
+def count_facet_combinations(db, filters: Dict[str, List], facet: str):
+    """
+    Count questions by facet value, summed over question_facet_count when
+    it has every facet involved. Otherwise questions are grouped, narrowed
+    by the indexes on the filtered facets.
+    """
+    if combined(list(filters) + [facet]):
+        column = getattr(QuestionFacetCount, facet)
+        n_questions = func.sum(QuestionFacetCount.n_questions)
+        model = QuestionFacetCount
+    else:
+        column = getattr(Question, facet)
+        n_questions = func.count()
+        model = Question
+    return (
+        db.query(column, n_questions)
+        .filter(*facet_clauses(model, filters, exclude=facet))
+        .group_by(column)
+        .all()
+    )
+
+
+def get_facet_counts(db, filters: Dict[str, List]) -> Dict[str, List[Dict]]:
+    """
+    Count questions by each value of each facet. Counts for a facet apply
+    the filters on the other facets but not its own, so they show how many
+    questions selecting that value would add. Without filters, or with
+    filters on a single facet, counts are looked up in question_facet_pair,
+    otherwise see count_facet_combinations.
+    """
+    counts = {}
+    for facet in QUESTION_FACETS:
+        others = {f: v for f, v in filters.items() if f != facet}
+        if len(others) == 0:
+            rows = count_facet_pairs(db, facet, facet)
+        elif len(others) == 1:
+            ((given, given_values),) = others.items()
+            rows = count_facet_pairs(db, given, facet, given_values)
+        else:
+            rows = count_facet_combinations(db, filters, facet)
+        rows = sorted(rows, key=lambda r: (-r[1], r[0] is None, r[0]))
+        counts[facet] = [{"value": value, "count": n} for value, n in rows]
+    return counts
+
+
+def count_matching_questions(db, filters: Dict[str, List]) -> int:
+    if len(filters) <= 1:
+        facet, values = next(iter(filters.items()), (QUESTION_FACETS[0], None))
+        return sum(n for _, n in count_facet_pairs(db, facet, facet, values))
+    if not combined(filters):
+        return db.query(Question).filter(*facet_clauses(Question, filters)).count()
+    return (
+        db.query(func.coalesce(func.sum(QuestionFacetCount.n_questions), 0))
+        .filter(*facet_clauses(QuestionFacetCount, filters))
+        .scalar()
+    )
+
+
+def browse_questions(
+    db,
+    filters: Dict[str, List],
+    limit: int,
+    after: Optional[int] = None,
+    facets: bool = True,
+):
+    query = db.query(*[getattr(Question, c) for c in BROWSE_COLUMNS]).filter(
+        *facet_clauses(Question, filters)
+    )
+    if after is not None:
+        query = query.filter(Question.qanta_id > after)
+    # Fetch one extra row to know whether there is a next page
+    rows = query.order_by(Question.qanta_id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].qanta_id)
+    response = {
+        "questions": [r._asdict() for r in rows],
+        "n_questions": count_matching_questions(db, filters),
+        "next": next_cursor,
+        "filters": filters,
+    }
+    if facets:
+        response["facets"] = get_facet_counts(db, filters)
+    return response
+
+
 @qanta_app.get("/question/random")
-async def read_random_question(request: Request, db: SessionLocal = Depends(get_db)):
-    qanta_id = random.choice(get_all_qanta_ids(db))
-    return get_html_qanta_question(db, request, qanta_id)
+async def read_random_question(
+    request: Request,
+    fold: Optional[str] = None,
+    category: Optional[str] = None,
+    difficulty: Optional[str] = None,
+    db: AsyncDB = Depends(get_db),
+):
+    qanta_id = await db.run(random_qanta_id, fold, category, difficulty)
+    return await db.run(get_html_qanta_question, request, qanta_id)
 
 
 @qanta_app.get("/question/{qanta_id}")
-async def read_question(
-    request: Request, qanta_id: int, db: SessionLocal = Depends(get_db)
-):
-    return get_html_qanta_question(db, request, qanta_id)
+async def read_question(request: Request, qanta_id: int, db: AsyncDB = Depends(get_db)):
+    return await db.run(get_html_qanta_question, request, qanta_id)
 
 
 @qanta_app.get("/api/qanta/v1/random")
-def get_random_question(db: SessionLocal = Depends(get_db)):
-    qanta_id = random.choice(get_all_qanta_ids(db))
-    question = db.query(Question).filter_by(qanta_id=qanta_id).first()
-    return question.to_dict()
+async def get_random_question(
+    fold: Optional[str] = None,
+    category: Optional[str] = None,
+    difficulty: Optional[str] = None,
+    db: AsyncDB = Depends(get_db),
+):
+    """
+    Random question, optionally only from the given fold, category and difficulty
+    """
+    qanta_id = await db.run(random_qanta_id, fold, category, difficulty)
+    return await db.run(get_question_dict, qanta_id)
+
+
+# Declared before /api/qanta/v1/{qanta_id} so that it does not match
+@qanta_app.get("/api/qanta/v1/questions")
+async def get_questions(
+    fold: Optional[List[str]] = Query(None),
+    category: Optional[List[str]] = Query(None),
+    subcategory: Optional[List[str]] = Query(None),
+    tournament: Optional[List[str]] = Query(None),
+    difficulty: Optional[List[str]] = Query(None),
+    year: Optional[List[int]] = Query(None),
+    dataset: Optional[List[str]] = Query(None),
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    facets: bool = True,
+    db: AsyncDB = Depends(get_db),
+):
+    """
+    Questions in id order matching every given facet, where repeating a
+    facet matches any of its values. Includes the number of matches, counts
+    by facet value unless facets=false, and a `next` cursor for the
+    following page.
+    """
+    if not 1 <= limit <= MAX_BROWSE_LIMIT:
+        raise HTTPException(
+            status_code=400, detail=f"limit must be between 1 and {MAX_BROWSE_LIMIT}"
+        )
+    values = [fold, category, subcategory, tournament, difficulty, year, dataset]
+    filters = {f: v for f, v in zip(QUESTION_FACETS, values) if v is not None}
+    after = None if cursor is None else decode_cursor(cursor)
+    return await db.run(browse_questions, filters, limit, after, facets)
+
+
+@qanta_app.get("/api/qanta/v1/export")
+def export(
+    fold: Optional[List[str]] = Query(None),
+    category: Optional[List[str]] = Query(None),
+    plays: bool = False,
+    format: str = "ndjson",  # pylint: disable=redefined-builtin
+):
+    """
+    Every question in the folds and categories given, or all questions,
+    streamed as NDJSON or Parquet, optionally with their play events
+    """
+    values = {"fold": fold, "category": category}
+    filters = {f: v for f, v in values.items() if v is not None}
+    refresh_engine()
+    return export_response(
+        lambda: export_questions(engine, format, filters, plays), format, "questions"
+    )
+
+
+@qanta_app.post("/api/qanta/v1/batch")
+async def get_questions_by_id(batch: BatchRequest, db: AsyncDB = Depends(get_db)):
+    """
+    Questions for every id in the body, in the same order. Ids with no
+    question are listed under `missing`.
+    """
+    check_batch(batch)
+    return await db.run(get_question_batch, batch.ids)
 
 
 @qanta_app.get("/api/qanta/v1/{qanta_id}")
-def get_question(qanta_id: int, db: SessionLocal = Depends(get_db)):
-    question = db.query(Question).filter_by(qanta_id=qanta_id).first()
-    return question.to_dict()
+async def get_question(qanta_id: int, plays: int = 0, db: AsyncDB = Depends(get_db)):
+    return await db.run(get_question_dict, qanta_id, plays)
+
+
+@qanta_app.get("/api/search")
+async def search(q: str, limit: int = 10, page: int = 1, db: AsyncDB = Depends(get_db)):
+    """
+    Questions ranked by how well their text, answer and page match q, with
+    matches in the snippet wrapped in <mark>
+    """
+    return await db.run(search_page, search_questions, q, limit, page)
@@ -0,0 +1,54 @@
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+
+BADGE_CLASSES = {"wrong": "badge-danger", "correct": "badge-success"}
+
+
+def annotate_buzzes(
+    text: str,
+    user_ids: Sequence[str],
+    buzzing_positions: Sequence[float],
+    results: Sequence[str],
+    max_buzzes: int = 5,
+) -> str:
+    """
+    Insert numbered badges into the question text where players buzzed.
+    Only the first play of each user counts, and a buzz is shown before
+    the first token whose position (idx / n_tokens) is past the buzzing
+    position. Badges are numbered in text order, prompts use up a number
+    without being shown, and at most max_buzzes buzzes are numbered.
+    """
+    tokens = text.split()
+    n_tokens = len(tokens)
+    if n_tokens == 0 or len(user_ids) == 0 or max_buzzes <= 0:
+        return " ".join(tokens)
+
+    _, first_plays = np.unique(np.asarray(user_ids, dtype=str), return_index=True)
+    first_plays.sort()
+    positions = np.asarray(buzzing_positions, dtype=float)[first_plays]
+    results = np.asarray(results, dtype=object)[first_plays]
+
+    fractions = np.arange(n_tokens) / n_tokens
+    token_idx = np.searchsorted(fractions, positions, side="right")
+    shown = np.flatnonzero(token_idx < n_tokens)
+    # Stable so that buzzes at the same token keep play order
+    shown = shown[np.argsort(token_idx[shown], kind="stable")][:max_buzzes]
+
+    badges: Dict[int, List[str]] = {}
+    for number, play in enumerate(shown, start=1):
+        badge_class = BADGE_CLASSES.get(results[play])
+        if badge_class is not None:
+            badges.setdefault(int(token_idx[play]), []).append(
+                f'<span class="badge badge-pill {badge_class}">{number}</span>'
+            )
+
+    parts = []
+    start = 0
+    for idx in sorted(badges):
+        parts.extend(tokens[start:idx])
+        parts.extend(badges[idx])
+        start = idx
+    parts.extend(tokens[start:])
+    return " ".join(parts)
@@ -1,18 +1,19 @@
-import json
 import typer
 import pandas as pd
 
+from explorer import paths
+from explorer.json_stream import iter_json_array
+
 
 app = typer.Typer()
 
 
 @app.command()
 def main(output: str):
-    with open("data/qanta.mapped.2018.04.18.json") as f:
-        questions = [q for q in json.load(f)["questions"] if q["page"] is not None]
-
     grouped = {}
-    for q in questions:
+    for q in iter_json_array(paths.QANTA_QUESTIONS, "questions"):
+        if q["page"] is None:
+            continue
         if q["page"] not in grouped:
             grouped[q["page"]] = []
         qdb_id = q["qdb_id"]
@@ -23,7 +24,13 @@ def main(output: str):
         if proto_id is None:
             proto_id = -1
         grouped[q["page"]].append(
-            [q["qanta_id"], qdb_id, proto_id, q["page"], q["answer"],]
+            [
+                q["qanta_id"],
+                qdb_id,
+                proto_id,
+                q["page"],
+                q["answer"],
+            ]
         )
 
     rows = []
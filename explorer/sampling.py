@@ -0,0 +1,271 @@
+"""
+Tables for picking random questions and dialogs, optionally filtered by
+facets such as fold or topic, without loading or scanning database tables.
+populate writes one file per table that web workers memory map, so every
+worker shares one copy through the page cache.
+
+File layout, integers are native byte order and sections are 8 byte aligned:
+    magic (8 bytes) | header length (uint64) | JSON header with section offsets
+    ids (int32 * n), the sampled ids in id order
+    for each facet:
+        codes (uint16 * n), index into the facet's values for each id
+        order (int32 * n), positions in ids sorted by code, so each value is a run
+        starts (int32 * (n_values + 1)), the run of value i is order[starts[i]:starts[i + 1]]
+"""
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import json
+import mmap
+import os
+import random
+import struct
+import threading
+from array import array
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from explorer import paths
+from explorer.database import (
+    create_db_engine,
+    get_build_id,
+    get_build_info,
+    get_db_context,
+)
+from explorer.log import get_logger
+from explorer.sqlite_profile import SERVE
+
+
+log = get_logger(__name__)
+
+MAGIC = b"SAMPLE01"
+HEADER = struct.Struct("=8sQ")
+# Random tries within the smallest matching run before scanning it
+REJECTION_TRIES = 64
+# Queries for the rows of each table, the id followed by its facets
+TABLES = {
+    "qanta": (
+        "SELECT qanta_id, fold, category, difficulty FROM questions ORDER BY qanta_id",
+        ["fold", "category", "difficulty"],
+    ),
+    "curiosity": (
+        "SELECT dialog_id, topic FROM curiosity_dialog ORDER BY dialog_id",
+        ["topic"],
+    ),
+}
+
+
+class Facet:
+    def __init__(self, values: List, codes: Sequence[int], order, starts) -> None:
+        self.values = values
+        self.codes = codes
+        self.order = order
+        self.starts = starts
+        self.value_codes = {v: i for i, v in enumerate(values)}
+
+    def run(self, value) -> Tuple[int, int]:
+        code = self.value_codes.get(value)
+        if code is None:
+            return 0, 0
+        return self.starts[code], self.starts[code + 1]
+
+
+def index_facet(column: Sequence) -> Tuple[List, array, array, array]:
+    values = sorted(set(column), key=lambda v: (v is None, str(v)))
+    if len(values) > 1 << 16:
+        raise ValueError(f"Too many facet values to index: {len(values)}")
+    value_codes = {v: i for i, v in enumerate(values)}
+    codes = array("H", (value_codes[v] for v in column))
+    order = array("i", sorted(range(len(column)), key=codes.__getitem__))
+    starts = array("i", [0]) * (len(values) + 1)
+    for c in codes:
+        starts[c + 1] += 1
+    for i in range(len(values)):
+        starts[i + 1] += starts[i]
+    return values, codes, order, starts
+
+
+class SamplingTable:
+    """
+    Ids with facets that random ids can be drawn from, uniformly among the
+    ids matching every given facet value
+    """
+
+    def __init__(self, ids: Sequence[int], facets: Dict[str, Facet], build_id: str):
+        self.ids = ids
+        self.facets = facets
+        self.build_id = build_id
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Sequence], facet_names: List[str], build_id=""):
+        """
+        Build a table in memory from (id, facet values...) rows
+        """
+        rows = list(rows)
+        facets = {}
+        for i, name in enumerate(facet_names, start=1):
+            facets[name] = Facet(*index_facet([r[i] for r in rows]))
+        return cls(array("i", (r[0] for r in rows)), facets, build_id)
+
+    @classmethod
+    def open(cls, path: str) -> "SamplingTable":
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(buffer)
+        magic, header_size = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"Not a sampling table: {path}")
+        header = json.loads(bytes(view[HEADER.size : HEADER.size + header_size]))
+        n = header["n"]
+        data_start = _align(HEADER.size + header_size)
+
+        def section(offset: int, fmt: str, length: int):
+            start = data_start + offset
+            return view[start : start + struct.calcsize(fmt) * length].cast(fmt)
+
+        facets = {}
+        for name, facet in header["facets"].items():
+            facets[name] = Facet(
+                facet["values"],
+                section(facet["codes"], "H", n),
+                section(facet["order"], "i", n),
+                section(facet["starts"], "i", len(facet["values"]) + 1),
+            )
+        return cls(section(header["ids"], "i", n), facets, header["build_id"])
+
+    def write(self, path: str):
+        """
+        Write the table to path, replacing it atomically
+        """
+        sections = [array("i", self.ids)]
+        header = {"build_id": self.build_id, "n": len(self.ids), "facets": {}}
+        for name, facet in self.facets.items():
+            header["facets"][name] = {"values": facet.values}
+            sections.extend(
+                [
+                    array("H", facet.codes),
+                    array("i", facet.order),
+                    array("i", facet.starts),
+                ]
+            )
+        offsets = []
+        offset = 0
+        for section in sections:
+            offsets.append(offset)
+            offset = _align(offset + section.itemsize * len(section))
+        header["ids"] = offsets[0]
+        for i, name in enumerate(self.facets):
+            codes, order, starts = offsets[1 + 3 * i : 4 + 3 * i]
+            header["facets"][name].update(
+                {"codes": codes, "order": order, "starts": starts}
+            )
+        header_bytes = json.dumps(header).encode()
+        data_start = _align(HEADER.size + len(header_bytes))
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(header_bytes)))
+            f.write(header_bytes)
+            for offset, section in zip(offsets, sections):
+                f.write(b"\0" * (data_start + offset - f.tell()))
+                f.write(section.tobytes())
+        os.replace(tmp_path, path)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def choice(self, filters: Optional[Dict[str, str]] = None, rng=random):
+        """
+        Random id among those matching every facet value in filters, or None
+        if no id matches. Raises KeyError for an unknown facet.
+        """
+        filters = {k: v for k, v in (filters or {}).items() if v is not None}
+        if len(filters) == 0:
+            return self.ids[rng.randrange(len(self.ids))] if len(self.ids) else None
+        runs = []
+        for name, value in filters.items():
+            facet = self.facets[name]
+            start, end = facet.run(value)
+            runs.append((end - start, start, end, facet, facet.value_codes.get(value)))
+        runs.sort(key=lambda r: r[0])
+        size, start, end, facet, _ = runs[0]
+        if size == 0:
+            return None
+        others = [(f.codes, code) for _, _, _, f, code in runs[1:]]
+
+        def matches(position: int) -> bool:
+            return all(codes[position] == code for codes, code in others)
+
+        for _ in range(REJECTION_TRIES):
+            position = facet.order[rng.randrange(start, end)]
+            if matches(position):
+                return self.ids[position]
+        # Rare combinations, find every match in the smallest run instead
+        candidates = [p for p in facet.order[start:end] if matches(p)]
+        if len(candidates) == 0:
+            return None
+        return self.ids[rng.choice(candidates)]
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+def read_sampling_table(conn, name: str, build_id: str = "") -> SamplingTable:
+    query, facet_names = TABLES[name]
+    return SamplingTable.from_rows(conn.execute(text(query)), facet_names, build_id)
+
+
+def write_sampling_tables(db_path: str):
+    """
+    Write the sampling table files for the database at db_path
+    """
+    db_engine = create_db_engine(db_path, SERVE)
+    try:
+        build_id = get_build_info(db_engine).get("build_id", "")
+        with db_engine.connect() as conn:
+            for name in TABLES:
+                table = read_sampling_table(conn, name, build_id)
+                table.write(paths.sampling_table(name))
+                log.info("Wrote %s sampling table with %s ids", name, len(table))
+    finally:
+        db_engine.dispose()
+
+
+_tables: Dict[str, SamplingTable] = {}
+_tables_lock = threading.Lock()
+
+
+def get_sampling_table(db, name: str) -> SamplingTable:
+    """
+    Sampling table for the database being served. The file written by
+    populate is used when it matches the current build, otherwise the table
+    is read from the database into memory.
+    """
+    build_id = get_build_id()
+    with _tables_lock:
+        table = _tables.get(name)
+        if table is not None and table.build_id == build_id:
+            return table
+        table = None
+        path = paths.sampling_table(name)
+        if os.path.exists(path):
+            table = SamplingTable.open(path)
+            if table.build_id != build_id:
+                table = None
+        if table is None:
+            log.info("No sampling table file for %s, reading the database", name)
+            table = read_sampling_table(db, name, build_id)
+        _tables[name] = table
+        return table
+
+
+def warm_sampling_tables():
+    """
+    Load every sampling table so the first random request is fast
+    """
+    with get_db_context() as db:
+        for name in TABLES:
+            try:
+                get_sampling_table(db, name)
+            except OperationalError as e:
+                log.warning("Could not load %s sampling table: %s", name, e)
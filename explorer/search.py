@@ -0,0 +1,269 @@
+"""
+Full text search over questions, curiosity dialogs and wiki facts with
+SQLite FTS5. The indexes live in the served database and are rebuilt by
+populate whenever their source rows change.
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+import html
+import math
+import os
+import re
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+from explorer.compression import iter_dialog_pages, read_decoder
+from explorer.log import get_logger
+
+
+log = get_logger(__name__)
+
+TOKENIZER = "porter unicode61 remove_diacritics 2"
+MAX_LIMIT = 100
+SNIPPET_TOKENS = 24
+# snippet() marks matches with these, they are swapped for <mark> once the
+# rest of the text is escaped
+_MATCH_START = "\x02"
+_MATCH_END = "\x03"
+_QUERY_TOKEN = re.compile(r"\w+\*?")
+
+# bm25 column weights, matching the answer counts more than matching the text
+QUESTION_WEIGHTS = (1.0, 4.0, 2.0)
+DIALOG_WEIGHTS = (2.0, 1.0)
+FACT_WEIGHTS = (2.0, 1.0, 1.0)
+
+
+def _drop(conn, table: str):
+    conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+
+
+def build_question_index(db_engine: Engine):
+    """
+    Index question text, answer and page. The index reads its content from
+    the questions table, so only the tokens are stored.
+    """
+    log.info("Building question search index")
+    with db_engine.begin() as conn:
+        _drop(conn, "questions_fts")
+        conn.execute(
+            text(
+                "CREATE VIRTUAL TABLE questions_fts USING fts5("
+                "text, answer, page, content='questions', content_rowid='qanta_id', "
+                f"tokenize='{TOKENIZER}')"
+            )
+        )
+        conn.execute(text("INSERT INTO questions_fts(questions_fts) VALUES('rebuild')"))
+
+
+def _dialog_messages(data: str) -> str:
+    return (
+        "(SELECT group_concat(json_extract(m.value, '$.message'), char(10)) "
+        f"FROM json_each({data}, '$.messages') AS m)"
+    )
+
+
+def build_dialog_index(db_engine: Engine):
+    """
+    Index the topic and message text of each dialog, pulled out of the stored
+    dialog JSON with SQLite's JSON functions. Compressed dialogs are
+    decompressed here and their JSON passed in.
+    """
+    log.info("Building dialog search index")
+    with db_engine.begin() as conn:
+        _drop(conn, "dialog_fts")
+        conn.execute(
+            text(
+                "CREATE VIRTUAL TABLE dialog_fts USING fts5("
+                f"topic, messages, tokenize='{TOKENIZER}')"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO dialog_fts(rowid, topic, messages) "
+                f"SELECT dialog_id, topic, {_dialog_messages('curiosity_dialog.data')} "
+                "FROM curiosity_dialog WHERE data IS NOT NULL"
+            )
+        )
+        compressed = conn.execute(
+            text("SELECT COUNT(*) FROM curiosity_dialog WHERE data IS NULL")
+        ).scalar()
+        if compressed == 0:
+            return
+        insert = text(
+            "INSERT INTO dialog_fts(rowid, topic, messages) "
+            f"SELECT dialog_id, topic, {_dialog_messages(':data')} "
+            "FROM curiosity_dialog WHERE dialog_id = :dialog_id"
+        )
+        decoder = read_decoder(conn)
+        for page in iter_dialog_pages(conn, decoder, compressed_only=True):
+            conn.execute(insert, [{"dialog_id": i, "data": data} for i, data in page])
+
+
+def build_fact_index(db_engine: Engine, wiki_db_path: str):
+    """
+    Copy the wiki facts into an index in the served database. Facts live in
+    the separate wiki database, which external content tables cannot read.
+    """
+    if not os.path.exists(wiki_db_path):
+        log.warning("Wiki database %s is missing, not indexing facts", wiki_db_path)
+        return
+    log.info("Building fact search index from %s", wiki_db_path)
+    with db_engine.connect() as conn:
+        conn.execute(text("ATTACH DATABASE :path AS wiki"), path=wiki_db_path)
+        try:
+            with conn.begin():
+                _drop(conn, "fact_fts")
+                conn.execute(
+                    text(
+                        "CREATE VIRTUAL TABLE fact_fts USING fts5("
+                        f"text, page, section_title, tokenize='{TOKENIZER}')"
+                    )
+                )
+                conn.execute(
+                    text(
+                        "INSERT INTO fact_fts(rowid, text, page, section_title) "
+                        "SELECT id, text, page, section_title FROM wiki.fact"
+                    )
+                )
+        finally:
+            conn.execute(text("DETACH DATABASE wiki"))
+
+
+def has_index(db_engine: Engine, table: str) -> bool:
+    with db_engine.connect() as conn:
+        return db_engine.dialect.has_table(conn, table)
+
+
+def to_match_query(query: str) -> Optional[str]:
+    """
+    Turn free text into an FTS5 query that matches documents containing every
+    word. Words are quoted so user input can never be parsed as FTS5 syntax,
+    and a trailing * is kept as a prefix search.
+    """
+    terms = []
+    for token in _QUERY_TOKEN.findall(query):
+        if token.endswith("*"):
+            terms.append(f'"{token[:-1]}"*')
+        else:
+            terms.append(f'"{token}"')
+    if len(terms) == 0:
+        return None
+    return " ".join(terms)
+
+
+def highlight(snippet: Optional[str]) -> Optional[str]:
+    """
+    Escape a snippet for HTML and wrap its matches in <mark>
+    """
+    if snippet is None:
+        return None
+    return (
+        html.escape(snippet)
+        .replace(_MATCH_START, "<mark>")
+        .replace(_MATCH_END, "</mark>")
+    )
+
+
+def _search(
+    db,
+    table: str,
+    key: str,
+    columns: str,
+    weights: Tuple,
+    match: str,
+    limit: int,
+    offset: int,
+) -> Tuple[List[Dict], int]:
+    weight_args = ", ".join(str(w) for w in weights)
+    rows = db.execute(
+        text(
+            f"SELECT rowid AS {key}, {columns}, "
+            f"snippet({table}, -1, :start, :end, '…', {SNIPPET_TOKENS}) AS snippet, "
+            f"bm25({table}, {weight_args}) AS score "
+            f"FROM {table} WHERE {table} MATCH :match "
+            "ORDER BY score LIMIT :limit OFFSET :offset"
+        ),
+        {
+            "start": _MATCH_START,
+            "end": _MATCH_END,
+            "match": match,
+            "limit": limit,
+            "offset": offset,
+        },
+    ).fetchall()
+    total = db.execute(
+        text(f"SELECT count(*) FROM {table} WHERE {table} MATCH :match"),
+        {"match": match},
+    ).scalar()
+    results = []
+    for r in rows:
+        result = dict(r)
+        result["snippet"] = highlight(result["snippet"])
+        # bm25 is lower for better matches, flip it so higher is better
+        result["score"] = -result["score"]
+        results.append(result)
+    return results, total
+
+
+def search_questions(db, match: str, limit: int, offset: int):
+    return _search(
+        db,
+        "questions_fts",
+        "qanta_id",
+        "answer, page",
+        QUESTION_WEIGHTS,
+        match,
+        limit,
+        offset,
+    )
+
+
+def search_dialogs(db, match: str, limit: int, offset: int):
+    return _search(
+        db, "dialog_fts", "dialog_id", "topic", DIALOG_WEIGHTS, match, limit, offset
+    )
+
+
+def search_facts(db, match: str, limit: int, offset: int):
+    return _search(
+        db,
+        "fact_fts",
+        "fact_id",
+        "page, section_title",
+        FACT_WEIGHTS,
+        match,
+        limit,
+        offset,
+    )
+
+
+def search_page(db, search: Callable, q: str, limit: int, page: int) -> Dict:
+    """
+    Run one of the search functions for a page of an API response
+    """
+    if not 1 <= limit <= MAX_LIMIT:
+        raise HTTPException(
+            status_code=400, detail=f"limit must be between 1 and {MAX_LIMIT}"
+        )
+    if page < 1:
+        raise HTTPException(status_code=400, detail="page must be at least 1")
+    match = to_match_query(q)
+    if match is None:
+        raise HTTPException(status_code=400, detail="Query has no searchable words")
+    try:
+        results, total = search(db, match, limit, (page - 1) * limit)
+    except OperationalError as e:
+        if "no such table" in str(e.orig):
+            raise HTTPException(
+                status_code=503, detail="Search index is not built"
+            ) from None
+        raise
+    return {
+        "query": q,
+        "results": results,
+        "n_results": total,
+        "n_pages": math.ceil(total / limit),
+        "page": page,
+    }
@@ -0,0 +1,144 @@
+"""
+Connection profiles for the SQLite databases, applied to every new
+connection of an engine with a connect event. SERVE is for the web tier,
+which only reads: connections open the file read only and immutable, so
+SQLite takes no locks and never checks for changes, and reads go through
+memory mapped IO and a larger page cache. BUILD is for writers and uses a
+write ahead log with fewer syncs. Both pool connections, with a check that
+drops connections inherited from a parent process so each worker process
+keeps its own pool. Settings come from the environment:
+- EXPLORER_SQLITE_MMAP_BYTES, bytes of a database memory mapped per connection
+- EXPLORER_SQLITE_CACHE_KB, page cache per connection
+- EXPLORER_SQLITE_IMMUTABLE, set to 0 if served files may be written in place
+- EXPLORER_SQLITE_JOURNAL_MODE, journal mode of BUILD connections
+- EXPLORER_DB_POOL_SIZE and EXPLORER_DB_POOL_OVERFLOW, connections kept
+  open and opened on top of those under load
+"""
+from typing import List, NamedTuple, Optional, Tuple
+import os
+import sqlite3
+from urllib.parse import quote
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+
+MMAP_BYTES = int(os.environ.get("EXPLORER_SQLITE_MMAP_BYTES", str(256 * 1024**2)))
+CACHE_KB = int(os.environ.get("EXPLORER_SQLITE_CACHE_KB", str(16 * 1024)))
+IMMUTABLE = os.environ.get("EXPLORER_SQLITE_IMMUTABLE", "1") not in ("", "0")
+JOURNAL_MODE = os.environ.get("EXPLORER_SQLITE_JOURNAL_MODE", "WAL")
+POOL_SIZE = int(os.environ.get("EXPLORER_DB_POOL_SIZE", "8"))
+POOL_OVERFLOW = int(os.environ.get("EXPLORER_DB_POOL_OVERFLOW", "32"))
+
+
+class SqliteProfile(NamedTuple):
+    read_only: bool = False
+    # Rebuilds replace database files rather than write to them, and
+    # connections to a replaced file keep reading the old one, so served
+    # files never change under a connection
+    immutable: bool = False
+    journal_mode: Optional[str] = None
+    synchronous: Optional[str] = None
+    mmap_size: Optional[int] = None
+    # Pages if positive, KiB if negative
+    cache_size: Optional[int] = None
+    temp_store: Optional[str] = None
+    pool_size: int = 5
+    max_overflow: int = 10
+
+    def pragmas(self) -> List[Tuple[str, object]]:
+        values = [
+            ("journal_mode", self.journal_mode),
+            ("synchronous", self.synchronous),
+            ("mmap_size", self.mmap_size),
+            ("cache_size", self.cache_size),
+            ("temp_store", self.temp_store),
+        ]
+        return [(name, value) for name, value in values if value is not None]
+
+
+SERVE = SqliteProfile(
+    read_only=True,
+    immutable=IMMUTABLE,
+    mmap_size=MMAP_BYTES,
+    cache_size=-CACHE_KB,
+    temp_store="MEMORY",
+    pool_size=POOL_SIZE,
+    max_overflow=POOL_OVERFLOW,
+)
+BUILD = SqliteProfile(
+    journal_mode=JOURNAL_MODE,
+    # Safe with a write ahead log, and a failed build is thrown away anyway
+    synchronous="NORMAL",
+    mmap_size=MMAP_BYTES,
+    cache_size=-CACHE_KB,
+    temp_store="MEMORY",
+)
+
+
+def sqlite_uri(path: str, profile: SqliteProfile) -> str:
+    params = []
+    if profile.read_only:
+        params.append("mode=ro")
+    if profile.immutable:
+        params.append("immutable=1")
+    query = "?" + "&".join(params) if len(params) != 0 else ""
+    return f"file:{quote(path)}{query}"
+
+
+def apply_pragmas(dbapi_connection, profile: SqliteProfile):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in profile.pragmas():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def create_sqlite_engine(path: str, profile: SqliteProfile) -> Engine:
+    """
+    Engine for the SQLite database at path with profile applied to each of
+    its connections
+    """
+    uri = sqlite_uri(path, profile)
+
+    def connect():
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    # The url is only descriptive, connections come from connect
+    db_engine = create_engine(
+        f"sqlite:///{path}",
+        creator=connect,
+        poolclass=QueuePool,
+        pool_size=profile.pool_size,
+        max_overflow=profile.max_overflow,
+    )
+
+    @event.listens_for(db_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info["pid"] = os.getpid()
+        apply_pragmas(dbapi_connection, profile)
+
+    @event.listens_for(db_engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        # pylint: disable=unused-argument
+        # A forked child must not use, or close, its parent's connections
+        if connection_record.info["pid"] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError("Connection belongs to another process")
+
+    return db_engine
+
+
+def close_journal(path: str):
+    """
+    Switch the database at path back to a rollback journal, which folds in
+    and removes its write ahead log. Immutable readers ignore the log, so
+    built files must be self contained before they are served.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        conn.close()
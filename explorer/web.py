@@ -1,24 +1,44 @@
-import random
+from typing import Dict, Optional
+import functools
 import os
 
 import toml
-import uvicorn
 
 from fastapi import FastAPI, Request, Depends
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse
 
+from explorer.cache import ResponseCache
 from explorer.jinja import ConfigurableJinja2Templates
-from explorer.database import SessionLocal, get_db
-from explorer.qanta.api import qanta_app, get_all_qanta_ids, get_html_qanta_question
-from explorer.curiosity.api import curiosity_app
+from explorer.database import AsyncDB, get_db
+from explorer.metrics import CONTENT_TYPE, RequestMetrics, render
+from explorer.qanta.api import qanta_app, random_qanta_id, get_html_qanta_question
+from explorer.curiosity.api import curiosity_app, get_fact_lookup
+from explorer.sampling import warm_sampling_tables
 
 
-with open("data.toml") as f:
-    data = toml.load(f)
+app = FastAPI()
+app.add_middleware(ResponseCache)
+# Added last so it is outermost and also times responses served from the cache
+app.add_middleware(RequestMetrics, name="web")
 
 
-app = FastAPI()
+@functools.lru_cache()
+def get_datasets() -> Dict:
+    with open("data.toml") as f:
+        return toml.load(f)["datasets"]
+
+
+@app.on_event("startup")
+def load_resources():
+    """
+    Load what the first requests need once the server is up rather than at
+    import, so importing the app stays fast. Mounted apps do not get startup
+    events, so this loads their resources too.
+    """
+    get_datasets()
+    get_fact_lookup()
+    warm_sampling_tables()
 
 
 GTAG = os.environ.get("GTAG")
@@ -33,7 +53,7 @@ templates = ConfigurableJinja2Templates(
 @app.get("/")
 async def home(request: Request):
     return templates.TemplateResponse(
-        "index.html.jinja2", {"request": request, "datasets": data["datasets"].values()}
+        "index.html.jinja2", {"request": request, "datasets": get_datasets().values()}
     )
 
 
@@ -50,10 +70,16 @@ async def redirect_curiosity():
 
 
 @app.get("/dataset/qanta")
-async def qanta_dataset(request: Request, db: SessionLocal = Depends(get_db)):
+async def qanta_dataset(
+    request: Request,
+    fold: Optional[str] = None,
+    category: Optional[str] = None,
+    difficulty: Optional[str] = None,
+    db: AsyncDB = Depends(get_db),
+):
     # TODO: make this a real homepage
-    qanta_id = random.choice(get_all_qanta_ids(db))
-    return get_html_qanta_question(db, request, qanta_id)
+    qanta_id = await db.run(random_qanta_id, fold, category, difficulty)
+    return await db.run(get_html_qanta_question, request, qanta_id)
 
 
 @app.get("/dataset/curiosity")
@@ -63,10 +89,17 @@ async def curiosity_dataset(request: Request):
     )
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(render(), media_type=CONTENT_TYPE)
+
+
 app.mount("/qanta", qanta_app)
 app.mount("/curiosity", curiosity_app)
 app.mount("/", StaticFiles(directory="files"), name="files")
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run(app, host="0.0.0.0", port=8000)
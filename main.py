@@ -1,12 +1,20 @@
+from typing import List, Optional
 import os
-import json
 import subprocess
 
 import typer
 
 from pedroai.io import eprint
 
-from explorer.database import build_db, build_curiosity
+from explorer import paths
+from explorer.build import build_db
+from explorer.compression import DICTIONARY_BYTES, measure_levels
+from explorer.database import create_db_engine
+from explorer.export import export_dialogs, export_questions, write_export
+from explorer.curiosity.fact_store import build_fact_store
+from explorer.curiosity.prominence import build_prominence
+from explorer.json_stream import iter_json_array
+from explorer.sqlite_profile import SERVE
 
 DATA_PATH = "data/"
 FILES = [
@@ -60,24 +68,86 @@ app = typer.Typer()
 
 
 @app.command()
-def populate():
-    build_db()
+def populate(
+    incremental: bool = False,
+    workers: int = 1,
+    compression_level: Optional[int] = None,
+):
+    build_db(
+        incremental=incremental, workers=workers, compression_level=compression_level
+    )
+
+
+@app.command()
+def populate_curiosity(
+    incremental: bool = False,
+    workers: int = 1,
+    compression_level: Optional[int] = None,
+):
+    build_db(
+        incremental=incremental,
+        qanta=False,
+        workers=workers,
+        compression_level=compression_level,
+    )
+
+
+@app.command()
+def compression_report(
+    levels: List[int] = typer.Option([3, 10, 19]),
+    dictionary_bytes: int = DICTIONARY_BYTES,
+):
+    results = measure_levels(
+        create_db_engine(paths.QANTA_DB, SERVE), levels, dictionary_bytes
+    )
+    for r in results:
+        dictionary = "dictionary" if r["dictionary"] else "no dictionary"
+        eprint(
+            f"level {r['level']:>2} {dictionary:>13}: {r['ratio']:.2f}x, "
+            f"compress {r['compress_mb_per_s']:.1f}MB/s, "
+            f"decode p50 {r['decode_p50_us']:.0f}us p99 {r['decode_p99_us']:.0f}us"
+        )
+
+
+@app.command()
+def populate_facts():
+    build_fact_store(paths.WIKI_DB, paths.FACT_STORE)
+    build_prominence(paths.WIKI_DB, paths.PROMINENCE_DB)
+
+
+@app.command()
+def export_qanta(
+    output: str,
+    fold: List[str] = typer.Option(None),
+    category: List[str] = typer.Option(None),
+    plays: bool = False,
+    format: str = "ndjson",  # pylint: disable=redefined-builtin
+):
+    values = {"fold": fold, "category": category}
+    filters = {f: v for f, v in values.items() if v}
+    db_engine = create_db_engine(paths.QANTA_DB, SERVE)
+    size = write_export(export_questions(db_engine, format, filters, plays), output)
+    eprint(f"Wrote {size} bytes to {output}")
 
 
 @app.command()
-def populate_curiosity():
-    build_curiosity()
+def export_curiosity(
+    output: str,
+    topic: str = None,
+    format: str = "ndjson",  # pylint: disable=redefined-builtin
+):
+    db_engine = create_db_engine(paths.QANTA_DB, SERVE)
+    size = write_export(export_dialogs(db_engine, format, topic), output)
+    eprint(f"Wrote {size} bytes to {output}")
 
 
 @app.command()
 def qb_stats():
-    with open("data/qanta.mapped.2018.04.18.json") as f:
-        questions = json.load(f)["questions"]
-        pages = set()
-        for q in questions:
-            if q["page"] is not None:
-                pages.add(q["page"])
-        eprint(f"Number of pages/classes: {len(pages)}")
+    pages = set()
+    for q in iter_json_array(paths.QANTA_QUESTIONS, "questions"):
+        if q["page"] is not None:
+            pages.add(q["page"])
+    eprint(f"Number of pages/classes: {len(pages)}")
 
 
 @app.command()
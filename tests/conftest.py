@@ -0,0 +1,42 @@
+import pytest
+
+from benchmarks.synthetic import generate, source_path
+from explorer import build, paths
+from explorer.database import create_db_engine
+from explorer.sqlite_profile import SERVE
+
+
+DATA_PATHS = [
+    "QANTA_DB",
+    "QANTA_QUESTIONS",
+    "PROTOBOWL_LOG",
+    "CURIOSITY_DIR",
+    "WIKI_DB",
+    "FACT_STORE",
+    "PROMINENCE_DB",
+]
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """
+    A small synthetic dataset, with explorer.paths and the served engine
+    builds check pointed at it
+    """
+    data_dir = str(tmp_path / "data")
+    generate(
+        data_dir,
+        questions=60,
+        plays=600,
+        dialogs=10,
+        pages=8,
+        facts_per_page=4,
+        mentions_per_fact=2,
+    )
+    for name in DATA_PATHS:
+        monkeypatch.setattr(paths, name, source_path(data_dir, getattr(paths, name)))
+    monkeypatch.setattr(paths, "DATA_DIR", data_dir)
+    served = create_db_engine(paths.QANTA_DB, SERVE)
+    monkeypatch.setattr(build, "engine", served)
+    yield data_dir
+    served.dispose()
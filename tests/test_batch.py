@@ -0,0 +1,56 @@
+import json
+
+from sqlalchemy.orm import sessionmaker
+
+from explorer import batch, database
+from explorer.database import Base, Question, create_db_engine
+from explorer.curiosity.api import get_dialog_batch
+from explorer.qanta.api import get_question_batch
+
+
+def test_batch_in_order_with_missing(tmp_path, monkeypatch):
+    db_engine = create_db_engine(str(tmp_path / "batch.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    with db_engine.begin() as conn:
+        conn.execute(
+            Base.metadata.tables["questions"].insert(),
+            [
+                {"qanta_id": i, "text": f"q{i}", "tokenizations": "[]"}
+                for i in range(10)
+            ],
+        )
+    # Several queries per batch
+    monkeypatch.setattr(batch, "MAX_QUERY_IDS", 3)
+    db = sessionmaker(bind=db_engine)()
+    queries = []
+    original = db.query
+    monkeypatch.setattr(db, "query", lambda *a: queries.append(a) or original(*a))
+
+    ids = [7, 42, 1, 7, 9, 0, 5, 3, 2, 11]
+    response = get_question_batch(db, ids)
+    assert [q["qanta_id"] for q in response["questions"]] == [7, 1, 7, 9, 0, 5, 3, 2]
+    assert response["questions"][0]["text"] == "q7"
+    assert response["missing"] == [42, 11]
+    # 9 distinct ids, 3 at a time
+    assert queries == [(Question,)] * 3
+    db.close()
+    db_engine.dispose()
+
+
+def test_dialog_batch_spliced(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "get_build_id", lambda: "build-1")
+    db_engine = create_db_engine(str(tmp_path / "batch.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    with db_engine.begin() as conn:
+        conn.execute(
+            Base.metadata.tables["curiosity_dialog"].insert(),
+            [{"dialog_id": i, "data": json.dumps({"dialog_id": i})} for i in range(3)],
+        )
+    db = sessionmaker(bind=db_engine)()
+    response = get_dialog_batch(db, [2, 7, 0])
+    assert json.loads(response.body) == {
+        "dialogs": [{"dialog_id": 2}, {"dialog_id": 0}],
+        "missing": [7],
+    }
+    db.close()
+    db_engine.dispose()
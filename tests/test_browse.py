@@ -0,0 +1,100 @@
+from collections import Counter
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from explorer.build import precompute_facet_counts
+from explorer.database import QUESTION_FACETS, Base, create_db_engine
+from explorer.pagination import decode_cursor
+from explorer.qanta.api import browse_questions
+
+
+FOLDS = ["train", "dev", "test"]
+CATEGORIES = ["History", "Science", "Literature", None]
+DIFFICULTIES = ["HS", "College"]
+
+
+def question(qanta_id):
+    return {
+        "qanta_id": qanta_id,
+        "text": f"Question {qanta_id}",
+        "first_sentence": f"Question {qanta_id}",
+        "answer": "answer",
+        "page": "Page",
+        "fold": FOLDS[qanta_id % 3],
+        "category": CATEGORIES[qanta_id % 4],
+        "subcategory": None,
+        "tournament": f"Tournament {qanta_id % 5}",
+        "difficulty": DIFFICULTIES[qanta_id % 7 % 2],
+        "year": 2000 + qanta_id % 5,
+        "dataset": "qanta",
+        "tokenizations": "[]",
+    }
+
+
+QUESTIONS = [question(i) for i in range(1, 101)]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db_engine = create_db_engine(str(tmp_path / "browse.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    with db_engine.begin() as conn:
+        conn.execute(Base.metadata.tables["questions"].insert(), QUESTIONS)
+    precompute_facet_counts(db_engine)
+    session = sessionmaker(bind=db_engine)()
+    yield session
+    session.close()
+    db_engine.dispose()
+
+
+def matches(q, filters, exclude=None):
+    return all(q[f] in v for f, v in filters.items() if f != exclude)
+
+
+def expected_counts(filters):
+    counts = {}
+    for facet in QUESTION_FACETS:
+        counter = Counter(q[facet] for q in QUESTIONS if matches(q, filters, facet))
+        counts[facet] = sorted(counter.items(), key=lambda c: (c[0] is None, c[0]))
+    return counts
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {},
+        {"fold": ["train"]},
+        {"year": [2001, 2003]},
+        {"category": ["History", "Science"], "fold": ["dev"]},
+        {"category": ["History"], "difficulty": ["HS"], "year": [2002]},
+        {"tournament": ["Missing"]},
+        {"tournament": ["Tournament 1", "Tournament 2"], "fold": ["train", "dev"]},
+        {"fold": ["test"], "difficulty": ["HS"], "dataset": ["qanta"]},
+    ],
+)
+def test_facet_counts(db, filters):
+    response = browse_questions(db, filters, limit=10)
+    assert response["n_questions"] == sum(matches(q, filters) for q in QUESTIONS)
+    expected = expected_counts(filters)
+    for facet, counts in response["facets"].items():
+        # Largest counts first
+        assert [c["count"] for c in counts] == sorted(
+            [c["count"] for c in counts], reverse=True
+        )
+        actual = [(c["value"], c["count"]) for c in counts]
+        assert sorted(actual, key=lambda c: (c[0] is None, c[0])) == expected[facet]
+
+
+def test_cursor_pages_through_matches(db):
+    filters = {"fold": ["train", "test"], "category": ["Science"]}
+    seen = []
+    after = None
+    while True:
+        page = browse_questions(db, filters, limit=4, after=after, facets=False)
+        assert "facets" not in page
+        seen.extend(q["qanta_id"] for q in page["questions"])
+        if page["next"] is None:
+            break
+        after = decode_cursor(page["next"])
+    assert seen == [q["qanta_id"] for q in QUESTIONS if matches(q, filters)]
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import sqlite3
+
+import pytest
+from sqlalchemy import text
+
+from explorer import build, paths
+from explorer.build import (
+    build_db,
+    delete_missing,
+    record_source,
+    source_changed,
+    upsert_rows,
+)
+from explorer.database import SCHEMA_VERSION, Base, create_db_engine
+
+
+def read_db(query: str):
+    conn = sqlite3.connect(paths.QANTA_DB)
+    try:
+        return conn.execute(query).fetchall()
+    finally:
+        conn.close()
+
+
+def build_info():
+    return dict(read_db("SELECT key, value FROM build_info"))
+
+
+def count(table: str) -> int:
+    return read_db(f"SELECT COUNT(*) FROM {table}")[0][0]
+
+
+def test_upsert_and_delete_missing(tmp_path):
+    db_engine = create_db_engine(str(tmp_path / "upsert.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    table = Base.metadata.tables["build_info"]
+    rows = [{"key": "a", "value": "1"}, {"key": "b", "value": "2"}]
+    assert upsert_rows(db_engine, table, rows) == 2
+    assert upsert_rows(db_engine, table, rows) == 0
+    assert upsert_rows(db_engine, table, [{"key": "a", "value": "3"}]) == 1
+    assert delete_missing(db_engine, table, "key", {"a"}) == 1
+    with db_engine.connect() as conn:
+        assert conn.execute(text("SELECT * FROM build_info")).fetchall() == [("a", "3")]
+    db_engine.dispose()
+
+
+def test_source_changed(tmp_path, data_dir):
+    db_engine = create_db_engine(str(tmp_path / "sources.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    path = paths.QANTA_QUESTIONS
+    assert source_changed(db_engine, path)
+    record_source(db_engine, path)
+    assert not source_changed(db_engine, path)
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    assert not source_changed(db_engine, path, record=False)
+    mtime = Base.metadata.tables["source_file"].c.mtime
+    with db_engine.connect() as conn:
+        assert conn.execute(mtime.table.select()).first().mtime == stat.st_mtime
+    assert not source_changed(db_engine, path)
+    with db_engine.connect() as conn:
+        assert conn.execute(mtime.table.select()).first().mtime == stat.st_mtime + 10
+    with open(path, "a") as f:
+        f.write(" ")
+    assert source_changed(db_engine, path)
+    db_engine.dispose()
+
+
+def test_full_and_noop_builds(data_dir):
+    build_db()
+    info = build_info()
+    assert info["schema_version"] == str(SCHEMA_VERSION)
+    assert count("questions") == 60
+    assert count("curiosity_dialog") == 10 * len(paths.CURIOSITY_FOLDS)
+    assert count("play_event") != 0
+    inode = os.stat(paths.QANTA_DB).st_ino
+
+    build_db(incremental=True)
+    assert build_info() == info
+    assert os.stat(paths.QANTA_DB).st_ino == inode
+
+    # Touched but unchanged, the served file is only read
+    stat = os.stat(paths.QANTA_QUESTIONS)
+    os.utime(paths.QANTA_QUESTIONS, (stat.st_atime, stat.st_mtime + 10))
+    build_db(incremental=True)
+    assert build_info() == info
+    assert os.stat(paths.QANTA_DB).st_ino == inode
+
+
+def test_edited_source(data_dir, caplog):
+    build_db()
+    with open(paths.QANTA_QUESTIONS) as f:
+        questions = json.load(f)
+    edited = questions["questions"][0]
+    edited["answer"] = "edited answer"
+    deleted = questions["questions"].pop()
+    with open(paths.QANTA_QUESTIONS, "w") as f:
+        json.dump(questions, f)
+    n_dialogs = count("curiosity_dialog")
+    build_id = build_info()["build_id"]
+
+    with caplog.at_level(logging.INFO, logger=build.__name__):
+        build_db(incremental=True)
+    assert "Questions: 1 written or changed, 1 deleted" in caplog.messages
+    assert "Curiosity dialogs are unchanged, skipping" in caplog.messages
+    assert build_info()["build_id"] != build_id
+    assert count("questions") == 59
+    assert read_db(
+        f"SELECT answer FROM questions WHERE qanta_id = {edited['qanta_id']}"
+    ) == [("edited answer",)]
+    assert (
+        read_db(f"SELECT * FROM questions WHERE qanta_id = {deleted['qanta_id']}") == []
+    )
+    assert count("curiosity_dialog") == n_dialogs
+
+
+def test_partial_build_keeps_qanta(data_dir):
+    build_db()
+    n_questions = count("questions")
+    n_plays = count("play_event")
+    # Like a database built before build_info was recorded
+    conn = sqlite3.connect(paths.QANTA_DB)
+    conn.execute("DROP TABLE build_info")
+    conn.commit()
+    conn.close()
+
+    build_db(qanta=False)
+    assert count("questions") == n_questions
+    assert count("play_event") == n_plays
+    assert count("curiosity_dialog") == 10 * len(paths.CURIOSITY_FOLDS)
+    # The kept tables are not known to be current, so the next build is full
+    assert "schema_version" not in build_info()
+
+
+def test_incremental_compressed_dialogs(data_dir, caplog):
+    pytest.importorskip("zstandard")
+    build_db(compression_level=3)
+    dictionary = read_db("SELECT dictionary FROM dialog_dictionary")
+    fold_path = paths.curiosity_dialogs(paths.CURIOSITY_FOLDS[0])
+    with open(fold_path) as f:
+        dialogs = json.load(f)
+    edited = dialogs["dialogs"][0]
+    edited["messages"][0]["message"] = "zanzibar"
+    with open(fold_path, "w") as f:
+        json.dump(dialogs, f)
+
+    with caplog.at_level(logging.INFO):
+        build_db(incremental=True, compression_level=3)
+    assert "Dialogs: 1 written or changed, 0 deleted" in caplog.messages
+    assert "Compressed 1 new dialogs with the stored dictionary" in caplog.messages
+    assert read_db("SELECT dictionary FROM dialog_dictionary") == dictionary
+    assert read_db("SELECT COUNT(data) FROM curiosity_dialog") == [(0,)]
+    # Dialogs stored compressed are still searchable
+    assert count("dialog_fts") == count("curiosity_dialog")
+    assert read_db(
+        "SELECT rowid FROM dialog_fts WHERE dialog_fts MATCH 'zanzibar'"
+    ) == [(edited["dialog_id"],)]
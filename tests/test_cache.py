@@ -0,0 +1,117 @@
+import threading
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from explorer.cache import ResponseCache
+
+
+def make_client(version, max_bytes=1 << 20, version_ttl=0):
+    app = FastAPI()
+    calls = []
+
+    @app.get("/item/random")
+    def random_item():
+        calls.append("random")
+        return {"item": len(calls)}
+
+    @app.get("/item/{item_id}")
+    def item(item_id: int, q: str = ""):
+        calls.append(item_id)
+        return {"item": item_id, "q": q, "padding": "x" * 1000}
+
+    app.add_middleware(
+        ResponseCache,
+        max_bytes=max_bytes,
+        max_entry_bytes=max_bytes,
+        routes=[r"/item/\d+"],
+        version=lambda: version[0],
+        version_ttl=version_ttl,
+    )
+    return TestClient(app), calls
+
+
+def test_cached_and_revalidated():
+    version = ["build-1"]
+    client, calls = make_client(version)
+    first = client.get("/item/1?q=a&z=b")
+    etag = first.headers["etag"]
+    assert first.headers["cache-control"].startswith("public")
+    # Query order does not matter
+    second = client.get("/item/1?z=b&q=a")
+    assert second.json() == first.json()
+    assert second.headers["etag"] == etag
+    assert calls == [1]
+
+    not_modified = client.get("/item/1?q=a&z=b", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+
+    # A new build changes the ETag and empties the cache
+    version[0] = "build-2"
+    assert (
+        client.get("/item/1?q=a&z=b", headers={"If-None-Match": etag}).status_code
+        == 200
+    )
+    assert calls == [1, 1]
+
+
+def test_uncached_routes():
+    client, calls = make_client(["build-1"])
+    client.get("/item/random")
+    response = client.get("/item/random")
+    assert "etag" not in response.headers
+    assert calls == ["random", "random"]
+    assert client.get("/item/x").status_code == 422
+    assert "etag" not in client.get("/item/x").headers
+
+
+def test_evicts_least_recently_used():
+    # Room for about three responses
+    client, calls = make_client(["build-1"], max_bytes=3 * 1200)
+    for item_id in [1, 2, 3, 1, 4, 5, 1]:
+        client.get(f"/item/{item_id}")
+    assert calls.count(1) == 1
+    assert calls.count(2) == 1
+    client.get("/item/2")
+    assert calls.count(2) == 2
+
+
+def test_revalidation():
+    client, calls = make_client(["build-1"])
+    etag = client.get("/item/1").headers["etag"]
+    # Marked weak by a proxy
+    weak = client.get("/item/1", headers={"If-None-Match": f'"other", W/{etag}'})
+    assert weak.status_code == 304
+
+    # Not answered until the route has produced the response
+    client, calls = make_client(["build-1"])
+    assert client.get("/item/1", headers={"If-None-Match": etag}).status_code == 200
+    assert calls == [1]
+    assert client.get("/item/1", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_version_checked_off_loop():
+    threads = []
+    version = ["build-1"]
+
+    def current_version():
+        threads.append(threading.current_thread().name)
+        return version[0]
+
+    app = FastAPI()
+
+    @app.get("/item/{item_id}")
+    def item(item_id: int):
+        return {"item": item_id}
+
+    app.add_middleware(
+        ResponseCache, routes=[r"/item/\d+"], version=current_version, version_ttl=60
+    )
+    client = TestClient(app)
+    first = client.get("/item/1").headers["etag"]
+    version[0] = "build-2"
+    # Within the TTL the build id is not checked again
+    assert client.get("/item/1").headers["etag"] == first
+    assert len(threads) == 1
+    assert threads[0].startswith("db")
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from explorer.compression import (
+    DICTIONARY_BYTES,
+    MIN_DICTIONARY_BYTES,
+    dialog_json,
+    measure_level,
+    read_decoder,
+    store_dialogs,
+    stored_level,
+    train_dictionary,
+)
+from explorer.database import Base, create_db_engine
+
+
+pytest.importorskip("zstandard")
+
+
+def dialog(dialog_id):
+    messages = [
+        {"message": f"Message {i} of {dialog_id}", "facts": [], "dialog_acts": []}
+        for i in range(5)
+    ]
+    return json.dumps({"dialog_id": dialog_id, "messages": messages})
+
+
+def read_dialogs(db_engine):
+    with db_engine.connect() as conn:
+        decoder = read_decoder(conn)
+        rows = conn.execute(
+            Base.metadata.tables["curiosity_dialog"].select().order_by("dialog_id")
+        )
+        return [dialog_json(decoder, r.data, r.data_zstd) for r in rows]
+
+
+def test_compress_and_restore(tmp_path):
+    db_engine = create_db_engine(str(tmp_path / "dialogs.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    dialogs = [dialog(i) for i in range(200)]
+    with db_engine.begin() as conn:
+        conn.execute(
+            Base.metadata.tables["curiosity_dialog"].insert(),
+            [{"dialog_id": i, "data": d} for i, d in enumerate(dialogs)],
+        )
+
+    store_dialogs(db_engine, 3)
+    assert stored_level(db_engine) == 3
+    with db_engine.connect() as conn:
+        plain, compressed = conn.execute(
+            "SELECT COUNT(data), SUM(LENGTH(data_zstd)) FROM curiosity_dialog"
+        ).first()
+    assert plain == 0
+    assert compressed < sum(len(d) for d in dialogs) / 3
+    assert read_dialogs(db_engine) == dialogs
+
+    # Recompressing at another level decompresses with the old dictionary
+    store_dialogs(db_engine, 5)
+    assert stored_level(db_engine) == 5
+    assert read_dialogs(db_engine) == dialogs
+
+    store_dialogs(db_engine, None)
+    assert stored_level(db_engine) is None
+    with db_engine.connect() as conn:
+        assert (
+            conn.execute("SELECT COUNT(data_zstd) FROM curiosity_dialog").scalar() == 0
+        )
+    assert read_dialogs(db_engine) == dialogs
+    db_engine.dispose()
+
+
+def test_compressed_without_dictionary():
+    with pytest.raises(ValueError):
+        dialog_json(None, None, b"compressed")
+
+
+def test_dictionary_sized_to_samples():
+    samples = [dialog(i).encode() for i in range(200)]
+    dictionary = train_dictionary(samples)
+    assert len(dictionary.as_bytes()) <= max(
+        MIN_DICTIONARY_BYTES, sum(len(s) for s in samples) // 100
+    )
+    assert len(dictionary.as_bytes()) < DICTIONARY_BYTES
+
+
+def test_measure_single_sample():
+    result = measure_level([dialog(0).encode()], 3)
+    assert result["decode_p50_us"] == result["decode_p99_us"]
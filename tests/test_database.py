@@ -0,0 +1,81 @@
+import asyncio
+import contextvars
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from explorer import database
+from explorer.database import AsyncDB, Base, Question, create_db_engine
+from explorer.qanta.api import get_question_plays
+
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+def test_async_db_runs_in_thread_with_context(tmp_path):
+    db_engine = create_db_engine(str(tmp_path / "db.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    with db_engine.begin() as conn:
+        conn.execute(
+            Base.metadata.tables["questions"].insert(),
+            [{"qanta_id": 1, "text": "text"}],
+        )
+
+    def lookup(session, qanta_id):
+        return (
+            session.query(Question.text).filter_by(qanta_id=qanta_id).scalar(),
+            request_id.get(),
+            threading.get_ident(),
+        )
+
+    async def handle():
+        request_id.set("abc")
+        db = AsyncDB(sessionmaker(bind=db_engine)())
+        try:
+            return await db.run(lookup, 1)
+        finally:
+            await db.close()
+
+    text, seen_request_id, thread_id = asyncio.run(handle())
+    assert text == "text"
+    assert seen_request_id == "abc"
+    assert thread_id != threading.get_ident()
+    db_engine.dispose()
+
+
+def test_build_cache_bounded(monkeypatch):
+    build_id = ["build-1"]
+    monkeypatch.setattr(database, "get_build_id", lambda: build_id[0])
+    cache = database.BuildCache(max_size=2)
+    calls = []
+
+    def get(key):
+        return cache.get_or_set(key, lambda: calls.append(key) or key * 2)
+
+    assert [get(k) for k in [1, 2, 1, 3, 1, 2]] == [2, 4, 2, 6, 2, 4]
+    # 2 was least recently used when 3 was added
+    assert calls == [1, 2, 3, 2]
+    build_id[0] = "build-2"
+    get(1)
+    assert calls == [1, 2, 3, 2, 1]
+
+
+def test_question_plays_read_in_index_order(tmp_path):
+    db_engine = create_db_engine(str(tmp_path / "db.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    statements = []
+
+    @event.listens_for(db_engine, "before_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    session = sessionmaker(bind=db_engine)()
+    get_question_plays(session, 1, 50)
+    session.close()
+    statement, parameters = statements[-1]
+    with db_engine.connect() as conn:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+    details = " ".join(row[-1] for row in plan)
+    assert "ix_play_event_qanta_date_result" in details
+    assert "TEMP B-TREE" not in details
@@ -0,0 +1,59 @@
+import logging
+
+from sqlalchemy import create_engine, text
+
+from explorer import metrics
+from explorer.diagnostics import QueryDiagnostics, full_scans, statement_shape
+
+
+def test_statement_shape():
+    assert statement_shape("SELECT *\n  FROM t WHERE a = 'x''y' AND b = 10") == (
+        "SELECT * FROM t WHERE a = ? AND b = ?"
+    )
+    assert statement_shape("SELECT * FROM t WHERE id IN (?, ?, ?)") == statement_shape(
+        "SELECT * FROM t WHERE id IN (?)"
+    )
+    assert full_scans(
+        ["SCAN mention", "SEARCH fact USING INDEX ix_fact_page (page=?)"]
+    ) == ["mention"]
+    assert full_scans(["SCAN fact USING COVERING INDEX ix_fact_page"]) == []
+    # Older SQLite versions
+    assert full_scans(
+        ["SCAN TABLE mention", "SEARCH TABLE fact USING INDEX ix_fact_page (page=?)"]
+    ) == ["mention"]
+    assert full_scans(["SCAN TABLE fact USING COVERING INDEX ix_fact_page"]) == []
+
+
+def test_diagnostics(tmp_path, caplog):
+    db_engine = create_engine(f"sqlite:///{tmp_path / 'diagnostics.sqlite3'}")
+    with db_engine.begin() as conn:
+        conn.execute(text("CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT)"))
+        conn.execute(text("CREATE INDEX ix_item_name ON item (name)"))
+        conn.execute(text("CREATE TABLE tag (item_id INTEGER, tag TEXT)"))
+    QueryDiagnostics(slow_query_ms=float("inf"), repeated_queries=3).instrument(
+        db_engine
+    )
+    with metrics.request_stats(), caplog.at_level(logging.WARNING):
+        with db_engine.connect() as conn:
+            for i in range(5):
+                conn.execute(text("SELECT * FROM item WHERE name = :n"), n=str(i))
+                conn.execute(text("SELECT * FROM tag WHERE item_id = :i"), i=i)
+    messages = [r.getMessage() for r in caplog.records]
+    scans = [m for m in messages if m.startswith("Full table scan")]
+    assert len(scans) == 1
+    assert "of tag in SELECT * FROM tag WHERE item_id = ?" in scans[0]
+    repeated = [m for m in messages if "N+1" in m]
+    assert len(repeated) == 2
+    assert not any(m.startswith("Slow query") for m in messages)
+
+
+def test_slow_queries(tmp_path, caplog):
+    db_engine = create_engine(f"sqlite:///{tmp_path / 'diagnostics.sqlite3'}")
+    QueryDiagnostics(slow_query_ms=0).instrument(db_engine)
+    with caplog.at_level(logging.WARNING, logger="explorer.diagnostics"):
+        with db_engine.connect() as conn:
+            conn.execute(text("CREATE TABLE item (id INTEGER PRIMARY KEY)"))
+            conn.execute(text("SELECT * FROM item WHERE id = 1"))
+    slow = [r.getMessage() for r in caplog.records if "Slow query" in r.getMessage()]
+    assert len(slow) == 2
+    assert "USING INTEGER PRIMARY KEY" in slow[1]
@@ -0,0 +1,92 @@
+import datetime
+import io
+import json
+
+import pytest
+
+from explorer import export
+from explorer.database import Base, create_db_engine
+
+
+@pytest.fixture
+def db_engine(tmp_path):
+    db_engine = create_db_engine(str(tmp_path / "export.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    with db_engine.begin() as conn:
+        conn.execute(
+            Base.metadata.tables["questions"].insert(),
+            [
+                {
+                    "qanta_id": i,
+                    "text": f"Question {i}",
+                    "tokenizations": "[[0, 10]]",
+                    "fold": "train" if i % 2 else "dev",
+                    "proto_id": f"p{i}",
+                    "year": 2000 + i,
+                }
+                for i in range(10)
+            ],
+        )
+        conn.execute(
+            Base.metadata.tables["play_event"].insert(),
+            [
+                {
+                    "qanta_id": i % 3,
+                    "user_id": f"u{i}",
+                    "buzzing_position": 0.5,
+                    "result": "correct",
+                    "date": datetime.datetime(2018, 1, 1 + i),
+                }
+                for i in range(6)
+            ],
+        )
+        conn.execute(
+            Base.metadata.tables["curiosity_dialog"].insert(),
+            [
+                {"dialog_id": i, "topic": "Peru" if i < 2 else "Chile", "data": "{}"}
+                for i in range(5)
+            ],
+        )
+    yield db_engine
+    db_engine.dispose()
+
+
+def test_questions_ndjson(db_engine, monkeypatch):
+    monkeypatch.setattr(export, "BATCH_SIZE", 2)
+    chunks = list(
+        export.export_questions(db_engine, filters={"fold": ["dev"]}, plays=True)
+    )
+    # One chunk per batch
+    assert len(chunks) == 3
+    rows = [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+    assert [r["qanta_id"] for r in rows] == [0, 2, 4, 6, 8]
+    assert rows[0]["tokenizations"] == [[0, 10]]
+    assert [p["user_id"] for p in rows[0]["plays"]] == ["u0", "u3"]
+    assert rows[0]["plays"][0]["date"] == "2018-01-01T00:00:00"
+    assert [p["user_id"] for p in rows[1]["plays"]] == ["u2", "u5"]
+    assert rows[2]["plays"] == []
+
+
+def test_dialogs_ndjson(db_engine):
+    chunks = export.export_dialogs(db_engine, topic="Peru")
+    assert b"".join(chunks) == b"{}\n{}\n"
+
+
+def test_unknown_format(db_engine):
+    with pytest.raises(ValueError):
+        export.export_dialogs(db_engine, "xml")
+
+
+def test_questions_parquet(db_engine, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(export, "BATCH_SIZE", 2)
+    monkeypatch.setattr(export, "ROW_GROUP_SIZE", 4)
+    chunks = list(export.export_questions(db_engine, "parquet", plays=True))
+    # Row groups are sent as they are written
+    assert len(chunks) == 3
+    parquet = pq.ParquetFile(io.BytesIO(b"".join(chunks)))
+    assert parquet.num_row_groups == 3
+    rows = parquet.read().to_pylist()
+    assert [r["qanta_id"] for r in rows] == list(range(10))
+    assert rows[1]["proto_id"] == "p1"
+    assert [p["user_id"] for p in rows[1]["plays"]] == ["u1", "u4"]
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+
+import pytest
+
+from explorer import paths
+from explorer.curiosity import api
+from explorer.curiosity.fact_store import FactStore, build_fact_store
+
+
+@pytest.fixture
+def fact_store(tmp_path):
+    wiki_path = str(tmp_path / "wiki.db")
+    conn = sqlite3.connect(wiki_path)
+    conn.execute("CREATE TABLE fact (id INTEGER PRIMARY KEY, text TEXT NOT NULL)")
+    conn.executemany(
+        "INSERT INTO fact VALUES (?, ?)",
+        [(1, "first"), (2, ""), (5, "naïve café ☕"), (9, "last")],
+    )
+    conn.commit()
+    conn.close()
+    store_path = str(tmp_path / "facts.bin")
+    build_fact_store(wiki_path, store_path)
+    return FactStore(store_path)
+
+
+def test_lookup(fact_store):
+    assert fact_store[1] == "first"
+    assert fact_store[2] == ""
+    assert fact_store[5] == "naïve café ☕"
+    assert fact_store[9] == "last"
+    assert len(fact_store) == 4
+
+
+def test_missing(fact_store):
+    for fid in [-1, 0, 3, 4, 10, 1000]:
+        assert fid not in fact_store
+        assert fact_store.get(fid) is None
+        with pytest.raises(KeyError):
+            fact_store[fid]  # pylint: disable=pointless-statement
+
+
+def test_web_opens_without_building(fact_store, tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "_fact_lookup", None)
+    missing = str(tmp_path / "missing.bin")
+    monkeypatch.setattr(paths, "FACT_STORE", missing)
+    assert api.get_fact_lookup() is None
+    assert not os.path.exists(missing)
+
+    monkeypatch.setattr(paths, "FACT_STORE", str(tmp_path / "facts.bin"))
+    assert api.get_fact_lookup()[9] == fact_store[9]
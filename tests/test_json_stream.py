@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from explorer.json_stream import iter_json_array
+
+
+def write_json(tmp_path, data):
+    path = tmp_path / "data.json"
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1)
+    return str(path)
+
+
+def test_iter_keyed_array(tmp_path):
+    questions = [{"qanta_id": i, "text": "x" * i, "year": 1.5 * i} for i in range(50)]
+    path = write_json(
+        tmp_path, {"version": {"a": [1, 2]}, "questions": questions, "after": 1}
+    )
+    # A tiny chunk size forces values to span many reads
+    assert list(iter_json_array(path, "questions", chunk_size=7)) == questions
+
+
+def test_iter_top_level_array(tmp_path):
+    path = write_json(tmp_path, [1, 22, 333, "four", None, {"five": 5}])
+    assert list(iter_json_array(path, chunk_size=2)) == [
+        1,
+        22,
+        333,
+        "four",
+        None,
+        {"five": 5},
+    ]
+
+
+def test_empty_array(tmp_path):
+    path = write_json(tmp_path, {"dialogs": []})
+    assert list(iter_json_array(path, "dialogs")) == []
+
+
+def test_missing_key(tmp_path):
+    path = write_json(tmp_path, {"questions": [1]})
+    with pytest.raises(KeyError):
+        list(iter_json_array(path, "dialogs"))
+
+
+def test_malformed(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text('{"questions": [{"a": 1}, {"b": ')
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path), "questions", chunk_size=4))
@@ -0,0 +1,66 @@
+import random
+
+from benchmarks.loadtest import (
+    ROUTE_MIX,
+    TrafficIds,
+    User,
+    compare_to_baseline,
+    histogram,
+    percentile,
+)
+
+
+def test_percentile_and_histogram():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([7.0], 99) == 7
+    counts = histogram([0.5, 1, 1.5, 30, 10_000])
+    assert counts["<=1ms"] == 2
+    assert counts["<=2ms"] == 1
+    assert counts["<=50ms"] == 1
+    assert counts[">5000ms"] == 1
+    assert sum(counts.values()) == 5
+
+
+def report(p50, p95, requests_per_s, p99=200):
+    summary = {
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "requests_per_s": requests_per_s,
+    }
+    return {"total": summary, "routes": {"question": summary}}
+
+
+def test_compare_to_baseline():
+    baseline = report(10, 50, 100)
+    assert compare_to_baseline(report(11, 60, 90), baseline, 1.25) == []
+    regressions = compare_to_baseline(report(10, 70, 100), baseline, 1.25)
+    assert len(regressions) == 2
+    assert all("p95_ms" in r for r in regressions)
+    regressions = compare_to_baseline(report(10, 50, 70), baseline, 1.25)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("throughput")
+    # Only the tail regressed
+    regressions = compare_to_baseline(report(10, 50, 100, p99=300), baseline, 1.25)
+    assert len(regressions) == 2
+    assert all("p99_ms" in r for r in regressions)
+    assert (
+        compare_to_baseline(report(10, 50, 100, p99=300), baseline, 1.25, [50, 95])
+        == []
+    )
+
+
+def test_user_follows_dialog_cursors():
+    user = User(TrafficIds([1, 2], [3, 4], 100), random.Random(0))
+    routes = set()
+    for _ in range(200):
+        route, url = user.next_request()
+        routes.add(route)
+        if route == "dialogs":
+            assert url.startswith("/curiosity/dialogs?limit=10&")
+        else:
+            assert url.rsplit("/", 1)[1] in {"random", "1", "2", "3", "4"}
+    assert routes == set(ROUTE_MIX)
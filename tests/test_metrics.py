@@ -0,0 +1,66 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from explorer import metrics
+from explorer.metrics import Histogram, RequestMetrics
+
+
+def test_histogram_render():
+    histogram = Histogram("test_seconds", "Test", ["route"], buckets=[0.1, 1])
+    metrics.REGISTRY.remove(histogram)
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, 'say "hi"')
+    assert histogram.render() == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 2',
+        'test_seconds_sum{route="/a"} 0.55',
+        'test_seconds_count{route="/a"} 2',
+        'test_seconds_bucket{route="say \\"hi\\"",le="0.1"} 0',
+        'test_seconds_bucket{route="say \\"hi\\"",le="1"} 0',
+        'test_seconds_bucket{route="say \\"hi\\"",le="+Inf"} 1',
+        'test_seconds_sum{route="say \\"hi\\""} 5.0',
+        'test_seconds_count{route="say \\"hi\\""} 1',
+    ]
+
+
+def test_request_metrics(tmp_path):
+    db_engine = create_engine(f"sqlite:///{tmp_path / 'metrics_test.sqlite3'}")
+    sub_app = FastAPI()
+    sub_app.add_middleware(RequestMetrics, name="sub_test")
+
+    @sub_app.get("/item/{item_id}")
+    def item(item_id: int):
+        with db_engine.connect() as conn:
+            for _ in range(item_id):
+                conn.execute(text("SELECT 1"))
+        return {"item": item_id}
+
+    app = FastAPI()
+    app.add_middleware(RequestMetrics, name="top_test")
+    app.mount("/sub", sub_app)
+    client = TestClient(app)
+    assert client.get("/sub/item/3").status_code == 200
+    assert client.get("/sub/missing").status_code == 404
+    assert client.get("/missing").status_code == 404
+
+    assert metrics.REQUESTS.value("sub_test", "/item/{item_id}", "GET", "200") == 1
+    assert metrics.REQUESTS.value("top_test", "/sub/item/{item_id}", "GET", "200") == 1
+    assert metrics.REQUESTS.value("sub_test", "unmatched", "GET", "404") == 1
+    assert metrics.REQUESTS.value("top_test", "/sub/{path}", "GET", "404") == 1
+    assert metrics.REQUESTS.value("top_test", "unmatched", "GET", "404") == 1
+    assert metrics.REQUEST_SECONDS.count("top_test", "/sub/item/{item_id}", "GET") == 1
+    assert metrics.IN_FLIGHT.value("top_test") == 0
+    # Both layers see the queries of the one request
+    for name, route in [
+        ("sub_test", "/item/{item_id}"),
+        ("top_test", "/sub/item/{item_id}"),
+    ]:
+        assert metrics.REQUEST_QUERIES.count(name, route) == 1
+        assert metrics.REQUEST_QUERIES.total(name, route) == 3
+    assert metrics.QUERIES.value("metrics_test.sqlite3") == 3
+    assert 'app="top_test",route="/sub/item/{item_id}"' in metrics.render()
@@ -0,0 +1,40 @@
+import shutil
+import sqlite3
+
+from explorer import paths
+from explorer.build import build_db
+
+
+# Columns that are not set by insertion order, to compare builds row for row
+TABLES = {
+    "questions": "*",
+    "play_event": "qanta_id, buzzing_position, user_id, date, guess, result",
+    "curiosity_dialog": "*",
+    "question_facet_pair": "*",
+    "source_file": "path, size, sha256",
+}
+
+
+def table_rows(db_path: str):
+    conn = sqlite3.connect(db_path)
+    try:
+        return {
+            table: sorted(
+                conn.execute(f"SELECT {columns} FROM {table}").fetchall(), key=repr
+            )
+            for table, columns in TABLES.items()
+        }
+    finally:
+        conn.close()
+
+
+def test_parallel_build_matches_serial(data_dir):
+    build_db(workers=3)
+    parallel = table_rows(paths.QANTA_DB)
+    shutil.move(paths.QANTA_DB, f"{paths.QANTA_DB}.parallel")
+    build_db()
+    serial = table_rows(paths.QANTA_DB)
+    assert len(serial["questions"]) == 60
+    assert len(serial["curiosity_dialog"]) == 10 * len(paths.CURIOSITY_FOLDS)
+    assert len(serial["play_event"]) != 0
+    assert parallel == serial
@@ -1,2 +1,58 @@
+import random
+
+from explorer.qanta.buzzes import annotate_buzzes
+
+
 def test_placeholder():
     pass
+
+
+def reference_text_with_buzzes(text, user_ids, positions, results, max_buzzes):
+    # The original per token, per event implementation of Question.text_with_buzzes
+    filtered_events = []
+    seen_players = set()
+    for event in zip(user_ids, positions, results):
+        if event[0] in seen_players:
+            continue
+        filtered_events.append(event)
+        seen_players.add(event[0])
+
+    tokens = text.split()
+    n_tokens = len(tokens)
+    modified_tokens = []
+    buzzed_players = set()
+    for idx, tok in enumerate(tokens):
+        for user_id, position, result in filtered_events:
+            if user_id in buzzed_players or len(buzzed_players) >= max_buzzes:
+                continue
+            if idx / n_tokens > position:
+                buzzed_players.add(user_id)
+                n = len(buzzed_players)
+                if result == "wrong":
+                    modified_tokens.append(
+                        f'<span class="badge badge-pill badge-danger">{n}</span>'
+                    )
+                elif result == "correct":
+                    modified_tokens.append(
+                        f'<span class="badge badge-pill badge-success">{n}</span>'
+                    )
+        modified_tokens.append(tok)
+    return " ".join(modified_tokens)
+
+
+def test_annotate_buzzes_matches_reference():
+    rng = random.Random(0)
+    for _ in range(300):
+        text = " ".join(f"w{i}" for i in range(rng.randint(1, 40)))
+        n_plays = rng.randint(0, 30)
+        user_ids = [f"u{rng.randint(0, 10)}" for _ in range(n_plays)]
+        positions = [rng.choice([rng.random(), 0.0, 0.5, 1.0]) for _ in range(n_plays)]
+        results = [rng.choice(["correct", "wrong", "prompt"]) for _ in range(n_plays)]
+        max_buzzes = rng.randint(0, 8)
+        assert annotate_buzzes(
+            text, user_ids, positions, results, max_buzzes=max_buzzes
+        ) == reference_text_with_buzzes(text, user_ids, positions, results, max_buzzes)
+
+
+def test_annotate_buzzes_without_plays():
+    assert annotate_buzzes("a  b c", [], [], []) == "a b c"
@@ -0,0 +1,52 @@
+import random
+from collections import Counter
+
+import pytest
+
+from explorer.sampling import SamplingTable
+
+
+ROWS = [
+    (1, "train", "History"),
+    (2, "train", "Science"),
+    (5, "test", "History"),
+    (7, "train", "History"),
+    (9, "test", None),
+]
+
+
+def check_table(table: SamplingTable):
+    rng = random.Random(0)
+    assert len(table) == 5
+    assert {table.choice(rng=rng) for _ in range(200)} == {1, 2, 5, 7, 9}
+    assert {
+        table.choice({"fold": "train", "category": "History"}, rng=rng)
+        for _ in range(200)
+    } == {1, 7}
+    assert table.choice({"fold": "test", "category": "Science"}, rng=rng) is None
+    assert table.choice({"fold": "dev"}, rng=rng) is None
+    # Filters set to None are ignored
+    assert table.choice({"fold": "test", "category": None}, rng=rng) in {5, 9}
+    with pytest.raises(KeyError):
+        table.choice({"year": "2010"}, rng=rng)
+
+
+def test_in_memory_table():
+    check_table(SamplingTable.from_rows(ROWS, ["fold", "category"]))
+
+
+def test_file_round_trip(tmp_path):
+    path = str(tmp_path / "table.bin")
+    SamplingTable.from_rows(ROWS, ["fold", "category"], build_id="abc").write(path)
+    table = SamplingTable.open(path)
+    assert table.build_id == "abc"
+    check_table(table)
+
+
+def test_filtered_choice_is_uniform():
+    rows = [(i, "a" if i % 3 else "b", "x" if i % 2 else "y") for i in range(300)]
+    table = SamplingTable.from_rows(rows, ["f", "g"])
+    rng = random.Random(0)
+    counts = Counter(table.choice({"f": "a", "g": "x"}, rng=rng) for _ in range(10_000))
+    assert set(counts) == {i for i in range(300) if i % 3 and i % 2}
+    assert max(counts.values()) < 2 * min(counts.values())
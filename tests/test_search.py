@@ -0,0 +1,112 @@
+import json
+import sqlite3
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.orm import sessionmaker
+
+from explorer.database import Base, create_db_engine
+from explorer.search import (
+    build_dialog_index,
+    build_fact_index,
+    build_question_index,
+    search_dialogs,
+    search_facts,
+    search_page,
+    search_questions,
+    to_match_query,
+)
+
+
+def question(qanta_id, text, answer, page):
+    return {
+        "qanta_id": qanta_id,
+        "text": text,
+        "answer": answer,
+        "page": page,
+        "tokenizations": "[]",
+    }
+
+
+def dialog(dialog_id, topic, messages):
+    return {
+        "dialog_id": dialog_id,
+        "topic": topic,
+        "data": json.dumps({"messages": [{"message": m} for m in messages]}),
+    }
+
+
+@pytest.fixture
+def db(tmp_path):
+    db_engine = create_db_engine(str(tmp_path / "search.sqlite3"))
+    Base.metadata.create_all(bind=db_engine)
+    with db_engine.begin() as conn:
+        conn.execute(
+            Base.metadata.tables["questions"].insert(),
+            [
+                question(1, "This river flows through Cairo", "Nile", "Nile"),
+                question(2, "This painter cut off his ear", "Van Gogh", "Van_Gogh"),
+                question(3, "Name this river in Brazil", "Amazon", "Amazon_River"),
+            ],
+        )
+        conn.execute(
+            Base.metadata.tables["curiosity_dialog"].insert(),
+            [
+                dialog(10, "Egypt", ["Tell me about Egypt", "The Nile floods yearly"]),
+                dialog(11, "Peru", ["What about Peru?", "Lima is the capital"]),
+            ],
+        )
+    wiki_path = str(tmp_path / "wiki.sqlite3")
+    wiki = sqlite3.connect(wiki_path)
+    wiki.execute(
+        "CREATE TABLE fact(id integer primary key, page text, section_title text, "
+        "text text)"
+    )
+    wiki.execute("INSERT INTO fact VALUES (5, 'Egypt', 'Geography', 'Deserts <b>')")
+    wiki.commit()
+    wiki.close()
+
+    build_question_index(db_engine)
+    build_dialog_index(db_engine)
+    build_fact_index(db_engine, wiki_path)
+    session = sessionmaker(bind=db_engine)()
+    yield session
+    session.close()
+    db_engine.dispose()
+
+
+def test_to_match_query():
+    assert to_match_query('river OR "nile') == '"river" "OR" "nile"'
+    assert to_match_query("riv* NEAR(") == '"riv"* "NEAR"'
+    assert to_match_query('")(*') is None
+
+
+def test_search_questions_ranks_answer_matches(db):
+    results, total = search_questions(db, to_match_query("river"), 10, 0)
+    assert total == 2
+    # Amazon matches in the text and the page
+    assert [r["qanta_id"] for r in results] == [3, 1]
+    assert "<mark>river</mark>" in results[0]["snippet"]
+
+
+def test_search_dialogs_and_facts(db):
+    results, total = search_dialogs(db, to_match_query("floods"), 10, 0)
+    assert total == 1
+    assert results[0]["dialog_id"] == 10
+    assert results[0]["topic"] == "Egypt"
+
+    results, _ = search_facts(db, to_match_query("desert"), 10, 0)
+    assert results[0]["fact_id"] == 5
+    # Stemmed match is highlighted and the fact text is escaped
+    assert results[0]["snippet"] == "<mark>Deserts</mark> &lt;b&gt;"
+
+
+def test_search_page(db):
+    response = search_page(db, search_questions, "this", 2, 2)
+    assert response["n_results"] == 3
+    assert response["n_pages"] == 2
+    assert len(response["results"]) == 1
+    with pytest.raises(HTTPException):
+        search_page(db, search_questions, "()", 2, 1)
+    with pytest.raises(HTTPException):
+        search_page(db, search_questions, "this", 0, 1)
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from explorer import sqlite_profile
+from explorer.sqlite_profile import BUILD, SERVE, close_journal, create_sqlite_engine
+
+
+def test_build_then_serve(tmp_path):
+    path = str(tmp_path / "profile.sqlite3")
+    build_engine = create_sqlite_engine(path, BUILD)
+    with build_engine.begin() as conn:
+        conn.execute(text("CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT)"))
+        conn.execute(text("INSERT INTO item (name) VALUES ('a'), ('b')"))
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+    build_engine.dispose()
+    close_journal(path)
+    assert not os.path.exists(f"{path}-wal")
+
+    serve_engine = create_sqlite_engine(path, SERVE)
+    with serve_engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM item")).scalar() == 2
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "delete"
+        assert conn.execute(text("PRAGMA cache_size")).scalar() == SERVE.cache_size
+        # In memory
+        assert conn.execute(text("PRAGMA temp_store")).scalar() == 2
+        with pytest.raises(OperationalError, match="readonly"):
+            conn.execute(text("INSERT INTO item (name) VALUES ('c')"))
+    serve_engine.dispose()
+
+
+def test_connections_not_shared_across_processes(tmp_path, monkeypatch):
+    db_engine = create_sqlite_engine(str(tmp_path / "pool.sqlite3"), BUILD)
+    with db_engine.connect() as conn:
+        parent_connection = conn.connection.connection
+    with db_engine.connect() as conn:
+        assert conn.connection.connection is parent_connection
+    # As if the process forked after the connection was pooled
+    monkeypatch.setattr(sqlite_profile.os, "getpid", lambda: -1)
+    with db_engine.connect() as conn:
+        assert conn.connection.connection is not parent_connection
+    db_engine.dispose()
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Measured around 0.45s locally, importing pandas alone adds about 0.4s
+IMPORT_BUDGET_US = 750_000
+# Only the build commands in main.py should import these
+BUILD_ONLY_MODULES = ["pandas", "numpy", "tqdm", "tables", "explorer.build"]
+
+
+def import_time_us(module: str) -> int:
+    """
+    Cumulative import time of module in a fresh interpreter, from -X importtime
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative)
+    raise ValueError(f"No import time reported for {module}")
+
+
+def test_web_skips_build_dependencies():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, explorer.web; "
+            f"print(' '.join(m for m in {BUILD_ONLY_MODULES!r} if m in sys.modules))",
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_web_import_time():
+    # Best of a few runs, the first may be compiling bytecode
+    elapsed = min(import_time_us("explorer.web") for _ in range(3))
+    assert elapsed < IMPORT_BUDGET_US
@@ -0,0 +1,33 @@
+import json
+import os
+import sqlite3
+
+import pandas as pd
+
+from benchmarks.synthetic import generate
+from explorer.curiosity.data import CuriosityDialog
+
+
+def test_generate(tmp_path):
+    data_dir = str(tmp_path)
+    generate(data_dir, questions=30, plays=200, dialogs=4, pages=5, facts_per_page=6)
+    with open(os.path.join(data_dir, "qanta.mapped.2018.04.18.json")) as f:
+        questions = json.load(f)["questions"]
+    assert [q["qanta_id"] for q in questions] == list(range(30))
+    plays = pd.read_hdf(os.path.join(data_dir, "protobowl-042818.log.h5"))
+    assert len(plays) == 200
+    proto_ids = {q["proto_id"] for q in questions}
+    assert plays["qid"].isin(proto_ids).mean() > 0.5
+
+    dialog_ids = []
+    for fold in ["train", "val", "test", "test_zero"]:
+        path = os.path.join(data_dir, "curiosity", f"curiosity_dialogs.{fold}.json")
+        with open(path) as f:
+            dialogs = [CuriosityDialog(**d) for d in json.load(f)["dialogs"]]
+        dialog_ids.extend(d.dialog_id for d in dialogs)
+    assert dialog_ids == list(range(16))
+
+    conn = sqlite3.connect(os.path.join(data_dir, "curiosity", "wiki_sql.sqlite.db"))
+    assert conn.execute("SELECT COUNT(*) FROM fact").fetchone()[0] == 30
+    assert conn.execute("SELECT COUNT(DISTINCT page) FROM mention").fetchone()[0] == 5
+    conn.close()
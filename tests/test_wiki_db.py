@@ -0,0 +1,131 @@
+import pytest
+from sqlalchemy import create_engine
+
+from explorer.curiosity import wiki_db
+from explorer.curiosity.prominence import to_curriculum
+from explorer.curiosity.wiki_db import CuriosityStore, EntityLink
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = str(tmp_path / "wiki.sqlite3")
+    db_engine = create_engine(f"sqlite:///{path}")
+    wiki_db.Base.metadata.create_all(db_engine)
+    facts = [
+        (1, "Peru", 0, "Body", "Lima is the capital < ref >x< / ref >"),
+        (2, "Peru", 1, "History", "The Inca ruled Peru"),
+        (3, "Chile", 0, "Body", "Santiago is the capital"),
+    ]
+    mentions = [
+        (1, True, 10, "Peru", "Lima", 1),
+        (2, False, 20, "Peru", "Inca", 2),
+        (3, True, 30, "Peru", "Lima", 2),
+        (4, True, 40, "Chile", "Santiago", 3),
+    ]
+    with db_engine.begin() as conn:
+        for fact_id, page, section_idx, section, text in facts:
+            conn.execute(
+                wiki_db.Fact.__table__.insert(),
+                id=fact_id,
+                page=page,
+                section_idx=section_idx,
+                section_title=section,
+                paragraph_idx=0,
+                text=text,
+                pageviews=100,
+            )
+        for mention_id, is_location, views, page, title, fact_id in mentions:
+            conn.execute(
+                wiki_db.Mention.__table__.insert(),
+                id=mention_id,
+                is_location=is_location,
+                pageviews=views,
+                page=page,
+                title=title,
+                fact_id=fact_id,
+            )
+        conn.execute(
+            wiki_db.WikiSummary.__table__.insert(),
+            [
+                {"title": "Peru", "text": " Peru summary ", "is_simple": False},
+                {"title": "Peru", "text": "Second summary", "is_simple": False},
+            ],
+        )
+    db_engine.dispose()
+    return CuriosityStore(path, cache_size=10)
+
+
+def test_links(store):
+    links = store.get_links_batch(["Peru", "Chile", "Missing"])
+    assert [(l.fact_id, l.mention_id) for l in links["Peru"]] == [
+        (1, 1),
+        (2, 2),
+        (2, 3),
+    ]
+    assert links["Chile"] == [
+        EntityLink(
+            "Chile", "Santiago", "Body", 40, "Santiago is the capital", True, 3, 4
+        )
+    ]
+    assert links["Missing"] == []
+    assert store.get_links("Peru") == links["Peru"]
+    # One fact per link, from its first mention
+    assert [(l.fact_id, l.mention_id) for l in store.get_page_facts("Peru")] == [
+        (1, 1),
+        (2, 2),
+    ]
+
+
+def test_facts_and_sections(store):
+    facts = store.get_facts_batch([("Peru", "Lima"), ("Peru", "Santiago")])
+    assert [(l.fact_id, l.mention_id) for l in facts[("Peru", "Lima")]] == [
+        (1, 1),
+        (2, 3),
+    ]
+    assert facts[("Peru", "Lima")][0].context == "Lima is the capital "
+    assert facts[("Peru", "Santiago")] == []
+    assert store.get_sections_batch(["Peru", "Chile"]) == {
+        "Peru": ["Body", "History"],
+        "Chile": ["Body"],
+    }
+    assert [l.fact_id for l in store.get_section_facts("Peru", "History")] == [2]
+    assert store.random_sections("Peru", 1) == ["History"]
+    assert store.get_entity_summaries(["Peru", "Chile"]) == {"Peru": "Peru summary"}
+
+
+def test_cache(store, monkeypatch):
+    first = store.get_links("Peru")
+    first.clear()
+    # Served from the cache, which callers cannot modify
+    monkeypatch.setattr(store, "_session_factory", None)
+    assert len(store.get_links("Peru")) == 3
+
+
+def test_prominence_curriculum(store, tmp_path):
+    curricula = store.prominence_curriculum()
+    assert curricula.path == str(tmp_path / "wiki_prominence.sqlite3")
+    assert len(curricula) == 2
+    assert curricula["Peru"] == {
+        "views": 100,
+        "entities": {("Lima", 30), ("Inca", 20), ("Lima", 10)},
+    }
+    assert list(curricula["Peru"]["entities"]) == [
+        ("Lima", 30),
+        ("Inca", 20),
+        ("Lima", 10),
+    ]
+    assert curricula["Chile"]["entities"] & {("Santiago", 40)}
+    assert "Missing" not in curricula
+    assert curricula["Missing"] == {"views": 0, "entities": set()}
+    assert [page for page, _ in curricula.iter_curricula()] == ["Chile", "Peru"]
+
+
+def test_curriculum_entity_order():
+    # Whatever order json_group_array saw the mentions in
+    entities = '[["Inca", 20], ["Lima", 10], ["Lima", 30], ["Cusco", 20]]'
+    assert list(to_curriculum(100, entities)["entities"]) == [
+        ("Lima", 30),
+        ("Cusco", 20),
+        ("Inca", 20),
+        ("Lima", 10),
+    ]